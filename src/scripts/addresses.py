@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+FELT_SIZE = 32 # Number of bytes of the binary form of a felt (252 bits, big-endian).
+FELT_BOUND = 2**252 # Upper bound of the felts.
+
+
+def normalize_address(address: str) -> str:
+    """
+    Canonical form of an address: lower case, with the prefix '0x' and without leading zeros,
+    e.g. '0x049D36...' -> '0x49d36...'. The address 0 is '0x0'.
+    """
+    digits = address.strip().lower()
+    digits = digits[2:] if digits.startswith('0x') else digits
+    return '0x' + (digits.lstrip('0') or '0')
+
+
+def normalize_addresses(addresses: pd.Series) -> pd.Series:
+    """
+    Vectorized version of normalize_address.
+    """
+    normalized = addresses.astype(str).str.strip().str.lower().str.replace('^(0x)?0*', '0x', regex=True)
+    return normalized.mask(normalized == '0x', '0x0')
+
+
+def to_felt(address) -> int:
+    """
+    The felt of an address given as an integer or as a hexadecimal string, with or without padding.
+    """
+    felt = address if isinstance(address, int) else int(normalize_address(address), 16)
+    if not 0 <= felt < FELT_BOUND:
+        raise ValueError(f'Not a felt: {address!r}')
+    return felt
+
+
+def felt_hex(address, padded=False) -> str:
+    """
+    Canonical hexadecimal form of an address (see normalize_address),
+    or, if 'padded' is True, its form with the 64 hexadecimal digits.
+    """
+    felt = to_felt(address)
+    return f'0x{felt:064x}' if padded else hex(felt)
+
+
+def felt_bytes(address) -> bytes:
+    """
+    Canonical binary form of an address: the 32 bytes of its felt, big-endian.
+    This is the value of the CONTRACT_KEY columns, which are BINARY(32) on the Snowflake server.
+    """
+    return to_felt(address).to_bytes(FELT_SIZE, 'big')
+
+
+def felt_keys(addresses: pd.Series) -> np.ndarray:
+    """
+    Vectorized version of felt_bytes, as an array of dtype 'S32'.
+    The order of the keys is the numeric order of the felts.
+    """
+    digits = normalize_addresses(addresses).str[2:].str.zfill(2 * FELT_SIZE)
+    # A felt is below 2**252, so the first of its 64 digits is 0.
+    invalid = ((digits.str.len() > 2 * FELT_SIZE) | (digits.str[0] != '0')).to_numpy()
+    if invalid.any():
+        raise ValueError(f'Not a felt: {addresses.iloc[np.flatnonzero(invalid)[0]]!r}')
+    return np.frombuffer(bytes.fromhex(''.join(digits)), dtype=f'S{FELT_SIZE}')
+
+
+def felt_key_column(addresses: pd.Series) -> pd.Series:
+    """
+    Column of the binary forms (see felt_bytes) of a column of addresses, with None for the missing addresses,
+    to be written to a BINARY(32) column.
+    """
+    present = addresses.notna().to_numpy()
+    buffer = felt_keys(addresses[present]).tobytes()
+    keys = np.full(len(addresses), None, dtype=object)
+    # The items of an 'S32' array drop their trailing zero bytes, so the keys are cut from the buffer instead.
+    keys[present] = [buffer[i:i + FELT_SIZE] for i in range(0, len(buffer), FELT_SIZE)]
+    return pd.Series(keys, index=addresses.index, dtype=object)
+
+
+def felt_key_array(addresses) -> pa.Array:
+    """
+    Arrow version of felt_key_column: the keys of an Arrow array (or chunked array) of addresses, as a
+    binary(32) array with nulls for the missing addresses. The keys are computed once per distinct address
+    (the dictionary of a dictionary array), with the Arrow compute kernels.
+    """
+    if isinstance(addresses, pa.ChunkedArray):
+        addresses = addresses.combine_chunks()
+    if not pa.types.is_dictionary(addresses.type):
+        addresses = pc.dictionary_encode(addresses)
+    values = addresses.dictionary
+    digits = pc.replace_substring_regex(pc.utf8_lower(pc.utf8_trim_whitespace(values)), '^(0x)?0*', '')
+    digits = pc.utf8_lpad(digits, 2 * FELT_SIZE, '0')
+    # A felt is below 2**252, so the first of its 64 digits is 0.
+    invalid = pc.or_(pc.greater(pc.utf8_length(digits), 2 * FELT_SIZE),
+                     pc.not_equal(pc.utf8_slice_codeunits(digits, 0, 1), '0')).to_numpy(zero_copy_only=False)
+    if invalid.any():
+        raise ValueError(f'Not a felt: {values[int(np.flatnonzero(invalid)[0])].as_py()!r}')
+    joined = pc.binary_join(pa.ListArray.from_arrays([0, len(digits)], digits), pa.scalar('', digits.type))[0].as_py()
+    keys = pa.FixedSizeBinaryArray.from_buffers(pa.binary(FELT_SIZE), len(values), [None, pa.py_buffer(bytes.fromhex(joined))])
+    return keys.take(addresses.indices)
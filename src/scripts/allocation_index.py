@@ -0,0 +1,130 @@
+import argparse
+import os
+import sys
+import numpy as np
+import pandas as pd
+from addresses import FELT_SIZE, felt_bytes, felt_keys
+from tags import ALLOCATIONS_CSV_PATH
+
+
+INDEX_FOLDER_PATH = '../data/allocations_index' # Binary index of allocations.csv, built on first use.
+INDEX_FILES = ('amounts', 'ranks', 'tag_offsets', 'tags', 'keys') # Arrays of the index, saved as '{name}.npy' in this order.
+OUTPUT_COLUMNS = ['ADDRESS', 'AMOUNT', 'RANK', 'TAG']
+
+
+def build_index(csv_path=ALLOCATIONS_CSV_PATH, folder=INDEX_FOLDER_PATH) -> None:
+    """
+    Builds the index of the allocations CSV file in 'folder', as NumPy arrays sorted by the keys
+    of the addresses (see addresses.felt_keys): the keys, the amounts, the ranks (from 1, by decreasing amount)
+    and the tags, stored as a single UTF-8 blob with the offsets of the tag of each key.
+    The keys are written last, so that an interrupted build is seen as missing (see open_index).
+    """
+    df = pd.read_csv(csv_path, usecols=['ADDRESS', 'AMOUNT', 'TAG'])
+    amounts = df['AMOUNT'].to_numpy(np.float64)
+    ranks = np.empty(len(df), dtype=np.int32)
+    ranks[np.argsort(-amounts, kind='stable')] = np.arange(1, len(df) + 1)
+    # As in a scan of the CSV file, the first row of an address is kept.
+    keys, first = np.unique(felt_keys(df['ADDRESS']), return_index=True)
+    tags = [tag.encode() if isinstance(tag, str) else b'' for tag in df['TAG'].to_numpy()[first]]
+    arrays = {
+        'amounts': amounts[first],
+        'ranks': ranks[first],
+        'tag_offsets': np.concatenate(([0], np.cumsum([len(tag) for tag in tags]))).astype(np.int64),
+        'tags': np.frombuffer(b''.join(tags), dtype=np.uint8),
+        'keys': keys
+    }
+    os.makedirs(folder, exist_ok=True)
+    for name in INDEX_FILES:
+        np.save(os.path.join(folder, f'{name}.npy'), arrays[name])
+
+
+class AllocationIndex:
+    """
+    Read-only view of an index built by build_index. The arrays are memory-mapped, so opening the index
+    reads nothing but their headers, and a lookup bisects the sorted keys.
+    """
+
+    def __init__(self, folder=INDEX_FOLDER_PATH):
+        for name in INDEX_FILES:
+            setattr(self, name, np.load(os.path.join(folder, f'{name}.npy'), mmap_mode='r'))
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def positions(self, keys: np.ndarray) -> np.ndarray:
+        """
+        Position in the index of each key (of dtype 'S32'), or -1 for the keys which are not in the index.
+        """
+        if len(self) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self) - 1)
+        return np.where(self.keys[positions] == keys, positions, -1)
+
+    def tag(self, position: int):
+        """
+        Tag of the address at 'position', or None if it has no tag.
+        """
+        start, end = self.tag_offsets[position], self.tag_offsets[position + 1]
+        return self.tags[start:end].tobytes().decode() if end > start else None
+
+    def get(self, address):
+        """
+        Allocation of a single address, as a dict with its AMOUNT, RANK and TAG, or None if it has no allocation.
+        """
+        position = self.positions(np.array([felt_bytes(address)], dtype=f'S{FELT_SIZE}'))[0]
+        if position < 0:
+            return None
+        return {'AMOUNT': float(self.amounts[position]), 'RANK': int(self.ranks[position]), 'TAG': self.tag(position)}
+
+    def lookup(self, addresses) -> pd.DataFrame:
+        """
+        Allocations of the given addresses, in the same order, with a missing AMOUNT and RANK (and no TAG)
+        for the addresses without an allocation.
+        """
+        addresses = pd.Series(addresses, dtype=object).reset_index(drop=True)
+        positions = self.positions(felt_keys(addresses))
+        found = positions >= 0
+        amounts = np.full(len(addresses), np.nan)
+        amounts[found] = self.amounts[positions[found]]
+        ranks = np.zeros(len(addresses), dtype=np.int64)
+        ranks[found] = self.ranks[positions[found]]
+        tags = np.full(len(addresses), None, dtype=object)
+        tags[found] = [self.tag(position) for position in positions[found].tolist()]
+        return pd.DataFrame({'ADDRESS': addresses, 'AMOUNT': amounts, 'RANK': pd.arrays.IntegerArray(ranks, ~found),
+                             'TAG': pd.Series(tags, dtype=object)})
+
+
+def open_index(csv_path=ALLOCATIONS_CSV_PATH, folder=INDEX_FOLDER_PATH, rebuild=False) -> AllocationIndex:
+    """
+    Opens the index of the allocations CSV file, (re)building it first if it is missing,
+    older than the CSV file, or if 'rebuild' is True.
+    """
+    keys_path = os.path.join(folder, 'keys.npy')
+    if rebuild or not os.path.exists(keys_path) or os.path.getmtime(keys_path) < os.path.getmtime(csv_path):
+        build_index(csv_path, folder)
+    return AllocationIndex(folder)
+
+
+def read_addresses(path: str) -> list[str]:
+    """
+    The addresses of a file with one address per line (blank lines are skipped).
+    """
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Look up the allocations of addresses in allocations.csv.')
+    parser.add_argument('addresses', nargs='*', help='Addresses to look up, with or without padding.')
+    parser.add_argument('--file', default=None, help='File with one address to look up per line.')
+    parser.add_argument('--csv', default=ALLOCATIONS_CSV_PATH, help='Allocations CSV file the index is built from.')
+    parser.add_argument('--index', default=INDEX_FOLDER_PATH, help='Folder of the index.')
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild the index even if it is up to date.')
+    parser.add_argument('--output', default=None, help='CSV file where the allocations are written (default: the standard output).')
+    args = parser.parse_args()
+
+    index = open_index(args.csv, args.index, args.rebuild)
+    addresses = args.addresses + (read_addresses(args.file) if args.file else [])
+    if addresses:
+        result = index.lookup(addresses)
+        result.to_csv(args.output if args.output else sys.stdout, index=False, columns=OUTPUT_COLUMNS)
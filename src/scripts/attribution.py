@@ -0,0 +1,188 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import queries.generators
+from addresses import normalize_addresses
+
+
+DATA_FOLDER_PATH = '../data' # Local copies of the per block tables, as Parquet files.
+INPUT_TABLES = {
+    'steps': ('steps_per_contract_per_block', ['BLOCK_NUMBER', 'CONTRACT', 'STEPS_PER_CONTRACT']),
+    'diffs': ('diffs_per_contract_per_block', ['BLOCK_NUMBER', 'CONTRACT', 'DIFFS_PER_CONTRACT']),
+    'builtin_gas': ('builtin_gas_per_block', ['BLOCK_NUMBER', 'BUILTIN_GAS']),
+    'block_fee': ('block_fee', ['BLOCK_NUMBER', 'BLOCK_FEE'])
+}
+RANKING_SIZE = 10000
+
+
+def load_inputs(data_folder=DATA_FOLDER_PATH, start_block=None, end_block=None) -> dict[str, pd.DataFrame]:
+    """
+    Reads the per block inputs of the attribution from the Parquet files of 'data_folder',
+    restricted to the blocks in [start_block, end_block] if a range is given.
+    """
+    filters = None if start_block is None else [('BLOCK_NUMBER', '>=', start_block), ('BLOCK_NUMBER', '<=', end_block)]
+    return {
+        name: pd.read_parquet(os.path.join(data_folder, f'{name}.parquet'), columns=columns, filters=filters)
+        for name, (_, columns) in INPUT_TABLES.items()
+    }
+
+
+def export_inputs(cs, start_block, end_block, data_folder=DATA_FOLDER_PATH) -> None:
+    """
+    Saves the per block tables built on the Snowflake server as Parquet files in 'data_folder'.
+    """
+    os.makedirs(data_folder, exist_ok=True)
+    for name, (table_name, columns) in INPUT_TABLES.items():
+        df = cs.execute(queries.generators.select_block_range(table_name, columns, start_block, end_block)).fetch_pandas_all()
+        df.to_parquet(os.path.join(data_folder, f'{name}.parquet'), index=False)
+
+
+def join_blocks(block_number: np.ndarray, table: pd.DataFrame, column: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Inner join of the rows of the blocks 'block_number' with a table with one row per block.
+    Returns the mask of the rows whose block is in the table, and the values of 'column' for these rows.
+    """
+    table_blocks = table['BLOCK_NUMBER'].to_numpy(np.int64)
+    if len(table_blocks) == 0:
+        return np.zeros(len(block_number), dtype=bool), np.zeros(0)
+    order = np.argsort(table_blocks)
+    position = np.minimum(np.searchsorted(table_blocks[order], block_number), len(table_blocks) - 1)
+    found = table_blocks[order][position] == block_number
+    return found, table[column].to_numpy(np.float64)[order][position[found]]
+
+
+def per_block(block_index: np.ndarray, values: np.ndarray, n_blocks: int) -> np.ndarray:
+    """
+    Sum of 'values' over the rows of each block, broadcast back to the rows.
+    """
+    return np.bincount(block_index, weights=values, minlength=n_blocks)[block_index]
+
+
+def final(steps: pd.DataFrame, diffs: pd.DataFrame, block_fee: pd.DataFrame) -> pd.DataFrame:
+    """
+    Same as the 'final' table: the full outer join of the steps and the diffs per contract per block,
+    restricted to the blocks with a fee, with the per block totals. The 'CONTRACT' column is categorical.
+    """
+    # As the contract keys in the join_steps_and_diffs query, the canonical addresses do not depend on the padding.
+    contracts = normalize_addresses(pd.concat([steps['CONTRACT'], diffs['CONTRACT']], ignore_index=True))
+    codes, names = pd.factorize(contracts)
+    n_contracts = max(len(names), 1)
+    blocks = np.concatenate([steps['BLOCK_NUMBER'].to_numpy(np.int64), diffs['BLOCK_NUMBER'].to_numpy(np.int64)])
+    # The pair (block, contract) is encoded as a single integer key, sorted by block first.
+    keys, rows = np.unique(blocks * n_contracts + codes, return_inverse=True)
+    n_steps = len(steps)
+    steps_per_contract = np.bincount(rows[:n_steps], weights=steps['STEPS_PER_CONTRACT'].to_numpy(np.float64), minlength=len(keys))
+    diffs_per_contract = np.bincount(rows[n_steps:], weights=diffs['DIFFS_PER_CONTRACT'].to_numpy(np.float64), minlength=len(keys))
+    block_number = keys // n_contracts
+    has_fee, fee = join_blocks(block_number, block_fee, 'BLOCK_FEE')
+    keys, block_number = keys[has_fee], block_number[has_fee]
+    steps_per_contract, diffs_per_contract = steps_per_contract[has_fee], diffs_per_contract[has_fee]
+    _, block_index = np.unique(block_number, return_inverse=True)
+    n_blocks = block_index.max() + 1 if len(block_index) else 0
+    return pd.DataFrame({
+        'BLOCK_NUMBER': block_number,
+        'CONTRACT': pd.Categorical.from_codes(keys % n_contracts, categories=names),
+        'STEPS_PER_CONTRACT': steps_per_contract,
+        'STEPS_PER_BLOCK': per_block(block_index, steps_per_contract, n_blocks),
+        'DIFFS_PER_CONTRACT': diffs_per_contract,
+        'DIFFS_PER_BLOCK': per_block(block_index, diffs_per_contract, n_blocks),
+        'CONTRACTS_PER_BLOCK': per_block(block_index, (diffs_per_contract != 0).astype(np.float64), n_blocks),
+        'BLOCK_FEE': fee
+    })
+
+
+def divide(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    """
+    numerator / denominator, with 0 where the denominator is 0.
+    """
+    return np.divide(numerator, denominator, out=np.zeros(len(numerator)), where=denominator != 0)
+
+
+def final_proportions(final_df: pd.DataFrame, builtin_gas: pd.DataFrame, gas_per_step, gas_per_diff) -> pd.DataFrame:
+    """
+    Same as the 'final_proportions' table: 'final' joined with the builtin gas per block,
+    with the proportions of the block fee due to steps and diffs, per block and per contract.
+    """
+    has_builtin_gas, builtin = join_blocks(final_df['BLOCK_NUMBER'].to_numpy(np.int64), builtin_gas, 'BUILTIN_GAS')
+    df = final_df[has_builtin_gas].reset_index(drop=True)
+    df['BUILTIN_GAS'] = builtin
+    steps_gas = builtin + df['STEPS_PER_BLOCK'].to_numpy() * gas_per_step
+    diffs_gas = (df['DIFFS_PER_BLOCK'].to_numpy() + df['CONTRACTS_PER_BLOCK'].to_numpy()) * gas_per_diff
+    df['FEE_PROPORTION_PER_BLOCK_STEPS'] = divide(steps_gas, steps_gas + diffs_gas)
+    df['FEE_PROPORTION_PER_BLOCK_DIFFS'] = divide(diffs_gas, steps_gas + diffs_gas)
+    diffs_per_contract = df['DIFFS_PER_CONTRACT'].to_numpy()
+    df['FEE_PROPORTION_PER_CONTRACT_DIFFS'] = np.where(
+        diffs_per_contract == 0,
+        0,
+        divide(df['FEE_PROPORTION_PER_BLOCK_DIFFS'].to_numpy() * (diffs_per_contract + 1),
+               df['DIFFS_PER_BLOCK'].to_numpy() + df['CONTRACTS_PER_BLOCK'].to_numpy())
+    )
+    df['FEE_PROPORTION_PER_CONTRACT_STEPS'] = divide(
+        df['FEE_PROPORTION_PER_BLOCK_STEPS'].to_numpy() * df['STEPS_PER_CONTRACT'].to_numpy(),
+        df['STEPS_PER_BLOCK'].to_numpy()
+    )
+    return df
+
+
+def final_fee_divided(proportions: pd.DataFrame) -> pd.DataFrame:
+    """
+    Same as the 'final_fee_amounts_divided' table: the fees in wei per contract, summed over all blocks.
+    """
+    codes = proportions['CONTRACT'].cat.codes.to_numpy()
+    names = proportions['CONTRACT'].cat.categories
+    fee = proportions['BLOCK_FEE'].to_numpy()
+    l1 = np.bincount(codes, weights=proportions['FEE_PROPORTION_PER_CONTRACT_DIFFS'].to_numpy() * fee, minlength=len(names))
+    l2 = np.bincount(codes, weights=proportions['FEE_PROPORTION_PER_CONTRACT_STEPS'].to_numpy() * fee, minlength=len(names))
+    present = np.bincount(codes, minlength=len(names)) > 0
+    return pd.DataFrame({
+        'CONTRACT': np.asarray(names)[present],
+        'L1_FEE_PER_CONTRACT': l1[present],
+        'L2_FEE_PER_CONTRACT': l2[present]
+    })
+
+
+def ranking_l1_l2(fee_divided: pd.DataFrame, size=RANKING_SIZE) -> pd.DataFrame:
+    """
+    Same as the ranking_l1_l2 query: the 'size' contracts with the largest fees, in ETH.
+    """
+    df = pd.DataFrame({
+        'CONTRACT': fee_divided['CONTRACT'],
+        'L1_FEE_PER_CONTRACT_ETH': fee_divided['L1_FEE_PER_CONTRACT'] / 10**18,
+        'L2_FEE_PER_CONTRACT_ETH': fee_divided['L2_FEE_PER_CONTRACT'] / 10**18
+    })
+    df['FEE_PER_CONTRACT'] = df['L1_FEE_PER_CONTRACT_ETH'] + df['L2_FEE_PER_CONTRACT_ETH']
+    return df.sort_values('FEE_PER_CONTRACT', ascending=False, kind='stable').head(size).reset_index(drop=True)
+
+
+def attribute(inputs: dict[str, pd.DataFrame], gas_per_step, gas_per_diff) -> pd.DataFrame:
+    """
+    Runs the whole attribution on the per block inputs (see load_inputs),
+    and returns the fees per contract in wei, as in the final_fee_amounts_divided table.
+    """
+    final_df = final(inputs['steps'], inputs['diffs'], inputs['block_fee'])
+    proportions = final_proportions(final_df, inputs['builtin_gas'], gas_per_step, gas_per_diff)
+    return final_fee_divided(proportions)
+
+
+if __name__ == '__main__':
+    from final_tables_script import create_table
+    from queries.pipeline import DEFAULT_PER_DIFF, DEFAULT_PER_STEP
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-folder', default=DATA_FOLDER_PATH, help='Folder of the Parquet inputs.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export', help='Save the per block tables of the Snowflake server locally.')
+    export_parser.add_argument('start_block', type=int)
+    export_parser.add_argument('end_block', type=int)
+    run_parser = commands.add_parser('run', help="Compute 'fee_amounts_v{version}.csv' from the local inputs.")
+    run_parser.add_argument('version', type=str)
+    run_parser.add_argument('--gas-per-step', type=float, default=DEFAULT_PER_STEP)
+    run_parser.add_argument('--gas-per-diff', type=float, default=DEFAULT_PER_DIFF)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        from utils import get_connection
+        export_inputs(get_connection().cursor(), args.start_block, args.end_block, args.data_folder)
+    else:
+        fee_divided = attribute(load_inputs(args.data_folder), args.gas_per_step, args.gas_per_diff)
+        create_table(ranking_l1_l2(fee_divided), args.version)
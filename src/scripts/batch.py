@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+from array import array
+
+
+# Typecodes of the array.array buffers used for the numeric dtypes. Other dtypes are buffered in lists.
+ARRAY_TYPECODES = {
+    'int32': 'i',
+    'int64': 'q',
+    'float64': 'd'
+}
+
+
+class BatchBuilder:
+    """
+    Accumulates rows of a batch in typed per-column buffers, and turns them into
+    a DataFrame once per flush. Appending a row is O(1), as opposed to concatenating
+    a one-row DataFrame to the batch, which copies the whole batch each time.
+    The constructor receives a dict: column name -> dtype (e.g. 'int64', 'object').
+    """
+
+    def __init__(self, columns: dict[str, str]):
+        self.dtypes = dict(columns)
+        self.clear()
+
+    def clear(self) -> None:
+        """
+        Empties all the column buffers.
+        """
+        self.buffers = [
+            array(ARRAY_TYPECODES[dtype]) if dtype in ARRAY_TYPECODES else []
+            for dtype in self.dtypes.values()
+        ]
+
+    def __len__(self) -> int:
+        return len(self.buffers[0])
+
+    def append(self, *row) -> None:
+        """
+        Appends one row, given as one value per column in the order of the constructor.
+        """
+        for buffer, value in zip(self.buffers, row):
+            buffer.append(value)
+
+    def extend(self, *columns) -> None:
+        """
+        Appends several rows, given as one iterable per column in the order of the constructor.
+        """
+        for buffer, values in zip(self.buffers, columns):
+            buffer.extend(values)
+
+    def to_data_frame(self) -> pd.DataFrame:
+        """
+        Builds a DataFrame with the buffered rows, copying each column buffer once.
+        """
+        data = {}
+        for (column, dtype), buffer in zip(self.dtypes.items(), self.buffers):
+            if isinstance(buffer, array):
+                data[column] = np.frombuffer(buffer, dtype=dtype) if len(buffer) else np.empty(0, dtype=dtype)
+            else:
+                data[column] = pd.Series(buffer, dtype=dtype)
+        return pd.DataFrame(data)
+
+    def flush(self) -> pd.DataFrame:
+        """
+        Returns the buffered rows as a DataFrame and empties the buffers.
+        """
+        df = self.to_data_frame()
+        self.clear()
+        return df
@@ -0,0 +1,258 @@
+import argparse
+import io
+import random
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from attribution import attribute
+from batch import BatchBuilder
+from cairo_steps_script import LEAN_DTYPES, ArrayTree, Tree, compact_traces, format_dataframe, infer_arrow_batch, infer_batch
+from metrics import frame_bytes
+
+
+def synthetic_diffs(n_blocks: int, contracts_per_block: int, seed=0) -> list:
+    """
+    Returns a list of rows (block_number, contract, updates_per_block) which resemble
+    the non-empty storage diffs of 'n_blocks' busy blocks.
+    """
+    rng = random.Random(seed)
+    return [
+        (block, hex(rng.getrandbits(251)), rng.randint(1, 20))
+        for block in range(n_blocks)
+        for _ in range(contracts_per_block)
+    ]
+
+
+def synthetic_traces(n_blocks: int, txs_per_block: int, calls_per_tx: int, seed=0) -> pd.DataFrame:
+    """
+    Returns a dataframe with the 'TRACE_ID' and 'STEPS' columns of the traces query,
+    for 'n_blocks' blocks with random call trees.
+    """
+    rng = random.Random(seed)
+    trace_ids = []
+    for block in range(n_blocks):
+        for tx in range(txs_per_block):
+            root = f'{block}_{tx}'
+            frontier = [root]
+            trace_ids += [root, root + '_v', root + '_f']
+            children = {}
+            for _ in range(calls_per_tx):
+                parent = rng.choice(frontier)
+                child = f'{parent}_{children.get(parent, 0)}'
+                children[parent] = children.get(parent, 0) + 1
+                frontier.append(child)
+                trace_ids.append(child)
+    rng.shuffle(trace_ids)
+    return pd.DataFrame({
+        'TRACE_ID': trace_ids,
+        'STEPS': [rng.randint(0, 100000) for _ in trace_ids]
+    })
+
+
+def timed(function, *args) -> float:
+    """
+    Returns the wall-clock time in seconds of function(*args).
+    """
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def concat_rows(rows: list) -> pd.DataFrame:
+    """
+    Row accumulation as previously done in storage_diffs_script: one pd.concat per row.
+    """
+    df = pd.DataFrame(columns = ['BLOCK_NUMBER', 'CONTRACT', 'UPDATES_PER_BLOCK'])
+    for block, contract, updates in rows:
+        new_entry = {'BLOCK_NUMBER': block, 'CONTRACT': contract, 'UPDATES_PER_BLOCK': updates}
+        df = pd.concat([df, pd.DataFrame([new_entry])], ignore_index=True)
+    return df
+
+
+def build_rows(rows: list) -> pd.DataFrame:
+    """
+    Row accumulation with a BatchBuilder, flushed once.
+    """
+    batch = BatchBuilder({'BLOCK_NUMBER': 'int64', 'CONTRACT': 'object', 'UPDATES_PER_BLOCK': 'int64'})
+    for row in rows:
+        batch.append(*row)
+    return batch.flush()
+
+
+def bench_batch_builder(n_blocks=100, contracts_per_block=20) -> None:
+    rows = synthetic_diffs(n_blocks, contracts_per_block)
+    concat_time = timed(concat_rows, rows)
+    builder_time = timed(build_rows, rows)
+    print(f'batch_builder: {len(rows)} rows, pd.concat {concat_time:.3f}s, '
+          f'BatchBuilder {builder_time:.4f}s, speedup x{concat_time / builder_time:.0f}')
+
+
+def split_format_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Formatting as previously done in cairo_steps_script: trace ids split into tuples of strings.
+    """
+    df['STEPS'] = df['STEPS'].fillna(0).astype(int)
+    df['SPLIT_TRACE_ID'] = df['TRACE_ID'].str.split("_").map(lambda x : tuple(x))
+    df.sort_values(by='SPLIT_TRACE_ID', inplace=True)
+    df.reset_index(drop=True, inplace=True)
+    return df
+
+
+def tuple_steps(df: pd.DataFrame):
+    """
+    Step inference as previously done in cairo_steps_script, from the query output.
+    """
+    df = split_format_dataframe(df)
+    tree = Tree(list(zip(df['SPLIT_TRACE_ID'], df['STEPS'])))
+    tree.infer_all()
+    return df, tree.to_data_frame()
+
+
+def encoded_steps(df: pd.DataFrame):
+    """
+    Step inference from the encoded trace ids, as in cairo_steps_script.
+    """
+    df, trace_ids = format_dataframe(df)
+    tree = ArrayTree.from_trace_ids(trace_ids, df['STEPS'])
+    tree.infer_all()
+    return df, trace_ids, tree.to_data_frame()
+
+
+def traced(function, *args) -> tuple[float, int, int]:
+    """
+    Returns the wall-clock time in seconds of function(*args), the peak of memory allocated
+    during the call, and the memory retained by its result, in bytes.
+    """
+    time_taken = timed(function, *args)
+    tracemalloc.start()
+    result = function(*args)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return time_taken, peak, retained
+
+
+def bench_tree(n_blocks=100, txs_per_block=50, calls_per_tx=20) -> None:
+    df = synthetic_traces(n_blocks, txs_per_block, calls_per_tx)
+    df['STEPS'] = df['STEPS'].astype(int)
+    tuple_time, tuple_peak, tuple_retained = traced(tuple_steps, df.copy())
+    encoded_time, encoded_peak, encoded_retained = traced(encoded_steps, df.copy())
+    print(f'tree: {len(df)} calls in {n_blocks} blocks\n'
+          f'    tuples + Tree:          {tuple_time:.3f}s, peak {tuple_peak / 2**20:.1f} MiB, '
+          f'retained {tuple_retained / 2**20:.1f} MiB\n'
+          f'    TraceIds + ArrayTree:   {encoded_time:.3f}s, peak {encoded_peak / 2**20:.1f} MiB, '
+          f'retained {encoded_retained / 2**20:.1f} MiB')
+
+
+def synthetic_attribution_inputs(n_blocks: int, steps_per_block: int, diffs_per_block: int, n_contracts=20000, seed=0) -> dict:
+    """
+    Random per block inputs of the attribution, with a fixed number of rows per block.
+    """
+    rng = np.random.default_rng(seed)
+    contracts = np.array([hex(x) for x in rng.integers(2**40, 2**62, n_contracts)], dtype=object)
+    blocks = np.arange(1, n_blocks + 1)
+
+    def per_contract(rows_per_block, column, high):
+        return pd.DataFrame({
+            'BLOCK_NUMBER': np.repeat(blocks, rows_per_block),
+            'CONTRACT': contracts[rng.zipf(1.5, n_blocks * rows_per_block) % n_contracts],
+            column: rng.integers(0, high, n_blocks * rows_per_block)
+        }).drop_duplicates(['BLOCK_NUMBER', 'CONTRACT'])
+
+    return {
+        'steps': per_contract(steps_per_block, 'STEPS_PER_CONTRACT', 100000),
+        'diffs': per_contract(diffs_per_block, 'DIFFS_PER_CONTRACT', 50),
+        'builtin_gas': pd.DataFrame({'BLOCK_NUMBER': blocks, 'BUILTIN_GAS': rng.uniform(0, 1000, n_blocks)}),
+        'block_fee': pd.DataFrame({'BLOCK_NUMBER': blocks, 'BLOCK_FEE': rng.uniform(1e15, 1e17, n_blocks)})
+    }
+
+
+def bench_attribution(n_blocks=448500, steps_per_block=8, diffs_per_block=5) -> None:
+    inputs = synthetic_attribution_inputs(n_blocks, steps_per_block, diffs_per_block)
+    rows = len(inputs['steps']) + len(inputs['diffs'])
+    attribution_time = timed(attribute, inputs, 0.01, 1024)
+    print(f'attribution: {n_blocks} blocks, {rows} rows of steps and diffs, {attribution_time:.2f}s')
+
+
+def synthetic_trace_batch(n_blocks: int, txs_per_block: int, calls_per_tx: int, n_contracts=2000, seed=0) -> pd.DataFrame:
+    """
+    Returns a dataframe with all the columns of the traces query, as returned by the connector.
+    """
+    df = synthetic_traces(n_blocks, txs_per_block, calls_per_tx, seed)
+    rng = np.random.default_rng(seed)
+    contracts = np.array(['0x' + f'{x:x}'.zfill(63) for x in rng.integers(2**60, 2**62, n_contracts)], dtype=object)
+    tx_index, txs = pd.factorize(df['TRACE_ID'].str.split('_').str[:2].str.join('_'))
+    tx_hashes = np.array(['0x' + rng.bytes(31).hex() for _ in txs], dtype=object)
+    return pd.DataFrame({
+        'BLOCK_NUMBER': df['TRACE_ID'].str.split('_').str[0].astype('int64'),
+        'TRACE_ID': df['TRACE_ID'],
+        'TX_HASH': tx_hashes[tx_index],
+        'TRACE_TYPE': 'CALL',
+        'CALLER': contracts[rng.integers(0, n_contracts, len(df))],
+        'CONTRACT': contracts[rng.zipf(1.5, len(df)) % n_contracts],
+        'FUNCTION': np.array(['__execute__', 'transfer', 'approve', 'swap', '__validate__'], dtype=object)[rng.integers(0, 5, len(df))],
+        'STEPS': df['STEPS'].astype('float64')
+    })
+
+
+def parquet_bytes(df: pd.DataFrame) -> int:
+    """
+    Size of the dataframe as the Parquet file uploaded by write_pandas.
+    """
+    buffer = io.BytesIO()
+    df.to_parquet(buffer, index=False, compression='snappy')
+    return buffer.tell()
+
+
+def bench_trace_batch(n_blocks=100, txs_per_block=50, calls_per_tx=20) -> None:
+    full = synthetic_trace_batch(n_blocks, txs_per_block, calls_per_tx)
+    lean = compact_traces(full[list(LEAN_DTYPES)].copy())
+    full_output, lean_output = infer_batch(full.copy()), infer_batch(lean.copy())
+    print(f'trace batch: {len(full)} calls in {n_blocks} blocks\n'
+          f'    full width: {frame_bytes(full) / 2**20:.1f} MiB fetched, {frame_bytes(full_output) / 2**20:.1f} MiB written, '
+          f'{parquet_bytes(full_output) / 2**20:.1f} MiB uploaded\n'
+          f'    lean:       {frame_bytes(lean) / 2**20:.1f} MiB fetched, {frame_bytes(lean_output) / 2**20:.1f} MiB written, '
+          f'{parquet_bytes(lean_output) / 2**20:.1f} MiB uploaded')
+
+
+def pandas_trace_path(table: pa.Table) -> None:
+    """
+    Fetch, compute and write of a batch through pandas: fetch_pandas_all, infer_batch and write_pandas.
+    """
+    parquet_bytes(infer_batch(compact_traces(table.to_pandas())))
+
+
+def arrow_trace_path(table: pa.Table) -> None:
+    """
+    Compute and write of a batch in the --arrow mode: infer_arrow_batch and the Parquet file of the BulkLoader.
+    """
+    pq.write_table(infer_arrow_batch(table, lean=True), io.BytesIO(), compression='snappy')
+
+
+def bench_arrow_batch(n_blocks=100, txs_per_block=50, calls_per_tx=20) -> None:
+    table = pa.Table.from_pandas(synthetic_trace_batch(n_blocks, txs_per_block, calls_per_tx)[list(LEAN_DTYPES)], preserve_index=False)
+    pandas_time, pandas_peak, _ = traced(pandas_trace_path, table)
+    arrow_time, arrow_peak, _ = traced(arrow_trace_path, table)
+    print(f'arrow batch: {len(table)} calls in {n_blocks} blocks\n'
+          f'    pandas: {pandas_time:.3f}s, peak {pandas_peak / 2**20:.1f} MiB\n'
+          f'    arrow:  {arrow_time:.3f}s, peak {arrow_peak / 2**20:.1f} MiB')
+
+
+BENCHMARKS = {
+    'batch_builder': bench_batch_builder,
+    'tree': bench_tree,
+    'trace_batch': bench_trace_batch,
+    'arrow_batch': bench_arrow_batch,
+    'attribution': bench_attribution
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('names', nargs='*', help='Benchmarks to run (default: all).')
+    args = parser.parse_args()
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name]()
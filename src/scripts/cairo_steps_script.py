@@ -1,10 +1,35 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
 import pandas as pd
-from snowflake.connector.pandas_tools import write_pandas
+import pyarrow as pa
+import pyarrow.compute as pc
 import queries.generators
-from utils import get_connection, parser
+from addresses import felt_key_array, felt_key_column
+from batch import BatchBuilder
+from checkpoint import COMMITTED, FAILED, Manifest, ranges_to_process, split_batches
+from loader import BulkLoader, loader_options
+from metrics import Metrics, frame_bytes, metrics_from_args, profiled
+from pipeline import StageTimer, run_stream
+from scheduling import add_adaptive_arguments, scheduler_from_args
+from trace_ids import TraceIds
+from utils import get_connection, ingestion_parser
+from writers import APPEND, add_contract_key, write_range
 
 
 INCREMENT = 100 # Size of block batches which are processed in the main loop.
+TABLE_NAME = 'CAIRO_STEPS_SCRIPT'
+TREE_COLUMNS = {
+    'SPLIT_TRACE_ID': 'object',
+    'INDIVIDUAL_STEPS': 'int64'
+}
+LEAN_DTYPES = { # Columns of the traces query in the lean mode, with their compact dtypes.
+    'BLOCK_NUMBER': 'int32',
+    'TRACE_ID': 'object',
+    'CONTRACT': 'category',
+    'STEPS': 'int64'
+}
 
 
 class Tree:
@@ -68,57 +93,439 @@ class Tree:
         """
         Transforms a Tree into a dataframe with an 'INDIVIDUAL_STEPS' column.
         """
-        # The elements of _result are pairs of the form (tuple[str], int).
-        _result = list(self.dict_steps.items())
-        result = [x for x in _result if len(x[0]) != 0]
-        df = pd.DataFrame.from_records(data=result, columns=['SPLIT_TRACE_ID', 'INDIVIDUAL_STEPS'])
+        batch = BatchBuilder(TREE_COLUMNS)
+        # The items of dict_steps are pairs of the form (tuple[str], int).
+        for node, steps in self.dict_steps.items():
+            if len(node) != 0:
+                batch.append(node, steps)
+        df = batch.flush()
         df = df.sort_values(by='SPLIT_TRACE_ID')
         return df
 
 
-def format_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+class ArrayTree:
+    """
+    Array-backed version of the Tree class, with the same semantics.
+    The nodes are numbered in the order in which they are given to the constructor,
+    and the tree is stored in three NumPy arrays indexed by node number:
+        - parents: number of the parent node, or -1 for the children of the common ancestor
+        - total_steps: steps of the node as given to the constructor, i.e. including the steps of its children
+        - steps: individual steps of the node, filled by infer_all
+    Inference is a single vectorized pass, so it does not recurse and does not depend on the depth of the calls.
+    """
+    # The constructor receives the same *ordered* list of pairs (tuple(str),int) as Tree.
+    def __init__(self, trace_id_and_steps: list((tuple[str],int))):
+        self.nodes = []
+        node_index = {}
+        parents = []
+        total_steps = []
+        for node, steps in trace_id_and_steps:
+            node = tuple(node)
+            # As in Tree, the validation ('v') and fee payment ('f') calls, and the nodes whose parent
+            # has not been seen before, are children of the common ancestor.
+            if node[-1] in ('v','f'):
+                parents.append(-1)
+            else:
+                parents.append(node_index.get(node[:-1], -1))
+            node_index[node] = len(self.nodes)
+            self.nodes.append(node)
+            total_steps.append(steps)
+        self.set_arrays(parents, total_steps)
+
+    @classmethod
+    def from_trace_ids(cls, trace_ids: TraceIds, steps) -> 'ArrayTree':
+        """
+        Builds the tree of a batch of encoded trace ids, which must be sorted numerically
+        (see TraceIds.sort_order), with the parents looked up in one vectorized pass.
+        """
+        tree = cls.__new__(cls)
+        tree.nodes = trace_ids
+        parents = trace_ids.parents()
+        parents[trace_ids.is_validate_or_fee()] = -1
+        tree.set_arrays(parents, steps)
+        return tree
+
+    def set_arrays(self, parents, total_steps) -> None:
+        self.parents = np.asarray(parents, dtype=np.int64)
+        self.total_steps = np.asarray(total_steps, dtype=np.int64)
+        self.steps = self.total_steps.copy()
+
+    def infer_all(self) -> None:
+        """
+        Infer steps for all nodes in the tree, by subtracting the total steps
+        of every node from the steps of its parent. Must be called only once.
+        """
+        has_parent = self.parents >= 0
+        np.subtract.at(self.steps, self.parents[has_parent], self.total_steps[has_parent])
+
+    @property
+    def dict_steps(self) -> dict:
+        """
+        The steps of each node as a dict, in the same format as Tree.dict_steps.
+        """
+        nodes = self.nodes.to_tuples() if isinstance(self.nodes, TraceIds) else self.nodes
+        dict_steps = {tuple(): -int(self.total_steps[self.parents < 0].sum())}
+        dict_steps.update(zip(nodes, self.steps.tolist()))
+        return dict_steps
+
+    def to_data_frame(self) -> pd.DataFrame:
+        """
+        Transforms an ArrayTree into a dataframe with an 'INDIVIDUAL_STEPS' column,
+        whose rows are in the order of the nodes given to the constructor.
+        """
+        return pd.DataFrame({'INDIVIDUAL_STEPS': self.steps})
+
+
+def format_dataframe(df: pd.DataFrame) -> tuple[pd.DataFrame, TraceIds]:
     """
     Formats the output of an SQL query into a dataframe that
-    can be passed to the Tree class. In particular, it orders the dataframe
-    by the 'TRACE_ID' column.
+    can be passed to the ArrayTree class, together with the encoded trace ids.
+    In particular, it orders the dataframe numerically by the 'TRACE_ID' column.
     """
     df['STEPS'] = df['STEPS'].fillna(0).astype(int)
-    df['SPLIT_TRACE_ID'] = df['TRACE_ID'].str.split("_").map(lambda x : tuple(x))
-    df.sort_values(by='SPLIT_TRACE_ID', inplace=True)
-    df.reset_index(drop=True, inplace=True)
+    trace_ids = TraceIds.from_strings(df['TRACE_ID'])
+    order = trace_ids.sort_order()
+    df = df.take(order).reset_index(drop=True)
+    return df, trace_ids.take(order)
+
+
+def compact_traces(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converts the output of the lean traces query to the compact dtypes of LEAN_DTYPES: the contracts are
+    categorical, so each address is stored once per batch, and the missing steps are 0.
+    """
+    df['STEPS'] = df['STEPS'].fillna(0)
+    return df.astype(LEAN_DTYPES)
+
+
+def contract_keys(contracts: pd.Series) -> pd.Series:
+    """
+    The 32-byte keys of the contracts (see addresses.felt_key_column). The keys of a categorical
+    column are computed once per contract.
+    """
+    if not isinstance(contracts.dtype, pd.CategoricalDtype):
+        return felt_key_column(contracts)
+    keys = felt_key_column(pd.Series(contracts.cat.categories, dtype=object)).to_numpy()
+    # The code -1 of the missing contracts picks the None appended after the keys.
+    keys = np.append(keys, None)[contracts.cat.codes.to_numpy()]
+    return pd.Series(keys, index=contracts.index, dtype=object)
+
+
+def infer_batch(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Adds the 'INDIVIDUAL_STEPS' column, and the 'CONTRACT_KEY' column (see addresses.felt_bytes),
+    to the output of the traces query for a batch of blocks.
+    """
+    df, trace_ids = format_dataframe(df)
+    tree = ArrayTree.from_trace_ids(trace_ids, df['STEPS'])
+    tree.infer_all()
+    output_df = tree.to_data_frame()
+    # Check that the trace is consistent after the running the Tree methods.
+    assert output_df.shape[0] == df.shape[0]
+    df['INDIVIDUAL_STEPS'] = output_df['INDIVIDUAL_STEPS']
+    df['CONTRACT_KEY'] = contract_keys(df['CONTRACT'])
     return df
 
 
+def infer_arrow_batch(table: pa.Table, lean=False) -> pa.Table:
+    """
+    Arrow version of infer_batch, for the Arrow tables of fetch_arrow_all and fetch_arrow_batches:
+    the trace ids are parsed and the contract keys computed with the Arrow compute kernels, and the steps
+    are inferred on the buffers of the columns, so the table is never converted to pandas.
+    In the 'lean' mode, the columns get the compact types of LEAN_DTYPES.
+    """
+    steps = pc.fill_null(pc.cast(table['STEPS'], pa.int64()), 0)
+    table = table.set_column(table.schema.get_field_index('STEPS'), 'STEPS', steps)
+    trace_ids = TraceIds.from_arrow(table['TRACE_ID'])
+    order = trace_ids.sort_order()
+    table = table.take(order)
+    tree = ArrayTree.from_trace_ids(trace_ids.take(order), table['STEPS'].to_numpy())
+    tree.infer_all()
+    if lean:
+        table = table.set_column(table.schema.get_field_index('BLOCK_NUMBER'), 'BLOCK_NUMBER', pc.cast(table['BLOCK_NUMBER'], pa.int32()))
+        table = table.set_column(table.schema.get_field_index('CONTRACT'), 'CONTRACT', pc.dictionary_encode(table['CONTRACT'].combine_chunks()))
+    table = table.append_column('INDIVIDUAL_STEPS', pa.array(tree.steps))
+    return table.append_column('CONTRACT_KEY', felt_key_array(table['CONTRACT']))
+
+
+def complete_transactions(frames):
+    """
+    Regroups dataframes of traces ordered by block and transaction (e.g. the batches of fetch_pandas_batches)
+    into dataframes of complete transactions, identified by the '{block_number}_{tx_index}' prefix of their
+    trace ids. The traces of the last transaction of a dataframe are held back until the next dataframe, where
+    the transaction may continue, so that only one transaction is held besides the current dataframe.
+    """
+    carry = None
+    for df in frames:
+        if carry is not None:
+            df = pd.concat([carry, df], ignore_index=True)
+        if len(df) == 0:
+            carry = df
+            continue
+        prefix = '_'.join(df['TRACE_ID'].iat[-1].split('_')[:2])
+        is_last = ((df['TRACE_ID'] == prefix) | df['TRACE_ID'].str.startswith(prefix + '_')).to_numpy()
+        carry = df[is_last]
+        if not is_last.all():
+            yield df[~is_last].reset_index(drop=True)
+    if carry is not None and len(carry):
+        yield carry.reset_index(drop=True)
+
+
+def complete_arrow_transactions(tables):
+    """
+    Arrow version of complete_transactions, for the tables of fetch_arrow_batches.
+    """
+    carry = None
+    for table in tables:
+        if carry is not None:
+            table = pa.concat_tables([carry, table])
+        if len(table) == 0:
+            carry = table
+            continue
+        prefix = '_'.join(table['TRACE_ID'][-1].as_py().split('_')[:2])
+        is_last = pc.or_(pc.equal(table['TRACE_ID'], prefix), pc.starts_with(table['TRACE_ID'], prefix + '_'))
+        carry = table.filter(is_last)
+        if len(carry) < len(table):
+            yield table.filter(pc.invert(is_last))
+    if carry is not None and len(carry):
+        yield carry
+
+
+def check_lean_table(cnx) -> None:
+    """
+    The lean mode does not write the transaction hash, the trace type, the caller and the function, so it must only
+    write to a table created with all the columns: a table created from its batches would lack them for the later runs.
+    """
+    query = queries.generators.column_count(TABLE_NAME, 'tx_hash')
+    if not cnx.cursor().execute(query).fetch_pandas_all().at[0, 'COLUMN_COUNT']:
+        raise ValueError(f'The {TABLE_NAME} table does not exist or has no TX_HASH column: run without --lean first to create it.')
+
+
+def process_range(cnx, start_block: int, end_block: int, queue_depth=2, manifest=None, write_mode=APPEND, window=INCREMENT, stream=False,
+                  scheduler=None, bulk_load=None, metrics=None, lean=False, arrow=False) -> tuple[list[str], StageTimer]:
+    """
+    Computes and writes the individual steps of the blocks in [start_block, end_block],
+    with one traces query per window of 'window' blocks. The traces of the next batches are fetched, and the
+    previous batches are written, while the steps of a batch are computed; at most
+    'queue_depth' batches wait between two stages. The batches are written with 'write_mode'
+    (see writers.write_range), and the outcome of each window is recorded in the checkpoint
+    manifest, if one is given.
+    In the 'stream' mode, the result of each query is consumed in batches of complete transactions
+    (see complete_transactions) instead of at once, so that the memory is bounded by the batches of
+    the connector and not by the window. The first batch of a window is written with 'write_mode'
+    and the next ones are appended.
+    If a 'scheduler' (see scheduling.AdaptiveWindow) is given, it chooses the size of each window instead,
+    from the number of traces of the window (probed with a count query) and of the previous windows.
+    If 'bulk_load' options are given (see loader.loader_options), the batches are loaded in bulk by
+    a BulkLoader, and the windows are recorded in the manifest when they are loaded.
+    The fetch of each window and the compute and write of each batch are recorded in 'metrics' (see metrics.Metrics).
+    In the 'lean' mode, only the columns read by the later stages are fetched, and kept with compact dtypes
+    (see compact_traces), instead of all the columns of the traces query.
+    In the 'arrow' mode, the traces are fetched as Arrow tables, and stay Arrow tables through the compute
+    (see infer_arrow_batch) and the write: the batches are written as Parquet files and loaded by a BulkLoader,
+    which loads each window on its own if no 'bulk_load' options are given.
+    Returns the list of failed windows and the time spent in each stage.
+    """
+    cs = cnx.cursor()
+    failed_blocks = []
+    window_failed = False
+    metrics = metrics or Metrics()
+    if arrow and bulk_load is None:
+        # The Arrow tables are only written through the Parquet files of the loader, flushed at each new window.
+        bulk_load = {'flush_bytes': 0}
+    loader = None if bulk_load is None else BulkLoader(cnx, TABLE_NAME, mode=write_mode, metrics=metrics, **bulk_load)
+
+    def record(start, end, status):
+        if manifest is not None:
+            manifest.record(TABLE_NAME, start, end, status)
+
+    def record_fetch(start, end, rows, size, seconds):
+        metrics.emit('fetch', start_block=start, end_block=end, rows=rows, bytes=size, seconds=seconds, query_id=getattr(cs, 'sfqid', None))
+
+    def probe(start, end):
+        return int(cs.execute(queries.generators.trace_count(start, end)).fetch_pandas_all().at[0, 'ROWS'])
+
+    def fetch():
+        # Each item is ((start, end), (traces, first batch of the window, last batch of the window)).
+        if scheduler is None:
+            windows = split_batches([(start_block, end_block)], window)
+        else:
+            windows = scheduler.windows(start_block, end_block, probe)
+        for start, end in windows:
+            fetch_start = time.perf_counter()
+            cs.execute(queries.generators.traces(start, end, ordered=stream, lean=lean))
+            if not cs:
+                failed_blocks.append(f'[{start}-{end}]')
+                record(start, end, FAILED)
+                metrics.emit('fetch', start_block=start, end_block=end, error='no result', query_id=getattr(cs, 'sfqid', None))
+                continue
+            if not stream:
+                if arrow:
+                    # The connector returns None instead of an empty table.
+                    df = cs.fetch_arrow_all()
+                else:
+                    df = cs.fetch_pandas_all()
+                    if lean:
+                        df = compact_traces(df)
+                rows = 0 if df is None else len(df)
+                seconds = time.perf_counter() - fetch_start
+                if scheduler is not None:
+                    scheduler.observe(start, end, rows, seconds)
+                record_fetch(start, end, rows, frame_bytes(df), seconds)
+                yield (start, end), (df, True, True)
+                continue
+            # The next batch is read ahead, to know whether a batch is the last one of its window.
+            if arrow:
+                batches = complete_arrow_transactions(cs.fetch_arrow_batches())
+            else:
+                batches = complete_transactions(cs.fetch_pandas_batches())
+            if lean and not arrow:
+                # The batches are compacted once complete, as batches with different categories cannot be concatenated.
+                batches = map(compact_traces, batches)
+            df, first = next(batches, None), True
+            # The time waiting for room in the queue is not part of the fetch time.
+            rows, size, seconds = 0, 0, time.perf_counter() - fetch_start
+            while df is not None:
+                rows += len(df)
+                size += frame_bytes(df)
+                fetch_start = time.perf_counter()
+                next_df = next(batches, None)
+                seconds += time.perf_counter() - fetch_start
+                if next_df is None:
+                    if scheduler is not None:
+                        scheduler.observe(start, end, rows, seconds)
+                    record_fetch(start, end, rows, size, seconds)
+                yield (start, end), (df, first, next_df is None)
+                df, first = next_df, False
+            if first:
+                if scheduler is not None:
+                    scheduler.observe(start, end, 0, seconds)
+                record_fetch(start, end, 0, 0, seconds)
+                yield (start, end), (None, True, True)
+
+    def compute(start, end, data):
+        df, first, last = data
+        if df is None:
+            return None, first, last
+        with metrics.stage('compute', start, end, rows=len(df)):
+            return infer_arrow_batch(df, lean) if arrow else infer_batch(df), first, last
+
+    def record_loads(results):
+        for start, end, success in results:
+            if not success:
+                failed_blocks.append(f'[{start}:{end}]')
+            record(start, end, COMMITTED if success else FAILED)
+
+    def write(start, end, data):
+        df, first, last = data
+        if df is None:
+            write_batch(start, end, df, first, last)
+            return
+        with metrics.stage('write', start, end, rows=len(df), bytes=frame_bytes(df), bulk_load=loader is not None) as fields:
+            fields['success'] = write_batch(start, end, df, first, last)
+
+    def write_batch(start, end, df, first, last):
+        # Returns whether the batch was written, or buffered by the loader, and the window did not fail before.
+        nonlocal window_failed
+        if loader is not None:
+            if df is None:
+                record(start, end, COMMITTED)
+            else:
+                record_loads(loader.add(df, start, end))
+            return True
+        if first:
+            window_failed = False
+        if df is not None and not window_failed:
+            success = write_range(cnx, df, TABLE_NAME, start, end, mode=write_mode if first else APPEND)
+            if not success:
+                window_failed = True
+                failed_blocks.append(f'[{start}:{end}]')
+                record(start, end, FAILED)
+        if last and not window_failed:
+            record(start, end, COMMITTED)
+        return not window_failed
+
+    try:
+        timer = run_stream(fetch(), compute, write, queue_depth=queue_depth)
+    finally:
+        if loader is not None:
+            record_loads(loader.close())
+    return failed_blocks, timer
+
+
+worker_connection = None # Snowflake connection of a worker process, in the --workers mode.
+worker_manifest = None # Checkpoint manifest of a worker process, in the --workers mode.
+worker_scheduler = None # Window scheduler of a worker process, kept across its shards, in the --workers --adaptive mode.
+
+
+def init_worker(manifest_path: str, scheduler) -> None:
+    global worker_connection, worker_manifest, worker_scheduler
+    worker_connection = get_connection()
+    worker_manifest = Manifest(manifest_path)
+    worker_scheduler = scheduler
+
+
+def process_shard(shard: tuple[int, int], **options) -> tuple[list[str], StageTimer]:
+    return process_range(worker_connection, *shard, manifest=worker_manifest, scheduler=worker_scheduler, **options)
+
+
 def main():
-    args = parser().parse_args()
+    arg_parser = ingestion_parser()
+    arg_parser.add_argument('--workers', type=int, default=1, help='Number of processes computing the steps.')
+    arg_parser.add_argument('--shard-size', type=int, default=10 * INCREMENT, help='Blocks per task in the --workers mode.')
+    arg_parser.add_argument('--queue-depth', type=int, default=2, help='Batches waiting between two pipeline stages.')
+    arg_parser.add_argument('--window', type=int, default=INCREMENT, help='Blocks per traces query.')
+    arg_parser.add_argument('--stream', action='store_true',
+                            help='Consume the traces of each query in batches of complete transactions, to allow larger windows.')
+    arg_parser.add_argument('--lean', action='store_true',
+                            help='Only fetch and write the block number, trace id, contract and steps of the traces, with compact dtypes. '
+                                 'The other columns are stored as NULL, so the table must already exist with all its columns.')
+    arg_parser.add_argument('--arrow', action='store_true',
+                            help='Fetch, compute and load the traces as Arrow tables, without pandas (implies the loading of Parquet files).')
+    add_adaptive_arguments(arg_parser)
+    args = arg_parser.parse_args()
+    scheduler = scheduler_from_args(args, initial=args.window)
+    metrics = metrics_from_args(args, 'cairo_steps_script')
+    options = {
+        'queue_depth': args.queue_depth,
+        'write_mode': args.write_mode,
+        'window': args.window,
+        'stream': args.stream,
+        'bulk_load': loader_options(args),
+        'metrics': metrics,
+        'lean': args.lean,
+        'arrow': args.arrow
+    }
     start_block, end_block = args.start_block, args.end_block
-    cnx = get_connection()
-    cs = cnx.cursor()
+    manifest = Manifest(args.manifest)
+    ranges = ranges_to_process(args, TABLE_NAME, manifest)
+    timer = StageTimer()
     failed_blocks = []
-    for start in range(start_block, end_block + 1, INCREMENT):
-        end = min(end_block, start + INCREMENT - 1)
-        cs.execute(queries.generators.traces(start, end))
-        if not cs:
-            failed_blocks.append(f'[{start}-{end}]')
-            continue
-        df = format_dataframe(cs.fetch_pandas_all())
-
-        tree = Tree(list(zip(df['SPLIT_TRACE_ID'], df['STEPS'])))
-        tree.infer_all()
-        output_df = tree.to_data_frame()
-        df['INDIVIDUAL_STEPS'] = output_df['INDIVIDUAL_STEPS']
-        df['SPLIT_TRACE_ID_TEST'] = output_df['SPLIT_TRACE_ID']
-        # Check that the trace is consistent after the running the Tree methods.
-        assert all(df['SPLIT_TRACE_ID'] == df['SPLIT_TRACE_ID_TEST'])
-        # Drop the testing columns.
-        df.drop(columns=['SPLIT_TRACE_ID', 'SPLIT_TRACE_ID_TEST'], inplace=True)
-        success, _, _, _ = write_pandas(cnx, df, 'CAIRO_STEPS_SCRIPT', auto_create_table=True)
-        if not success:
-            failed_blocks.append(f'[{start}:{end}]')
+    cnx = get_connection()
+    # The column is added once, before the writes of the workers.
+    add_contract_key(cnx, TABLE_NAME)
+    if args.lean:
+        check_lean_table(cnx)
+    with profiled(args.profile, f'./cairo_script_profile_{start_block}_{end_block}'), \
+            metrics.stage('run', start_block, end_block, workers=args.workers) as run:
+        if args.workers > 1:
+            # Each worker opens its own connection, and the shards are handed out as the workers become free,
+            # so that the busier recent blocks do not all land on the same worker.
+            with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(args.manifest, scheduler)) as executor:
+                task = partial(process_shard, **options)
+                for shard_failures, shard_timer in executor.map(task, split_batches(ranges, args.shard_size)):
+                    failed_blocks += shard_failures
+                    timer.merge(shard_timer)
+        else:
+            for start, end in ranges:
+                range_failures, range_timer = process_range(cnx, start, end, manifest=manifest, scheduler=scheduler, **options)
+                failed_blocks += range_failures
+                timer.merge(range_timer)
+        run.update(failed=len(failed_blocks), stage_seconds=timer.seconds, stage_batches=timer.batches)
+    print(timer.report())
     if failed_blocks:
         with open(f'./cairo_script_failed_blocks_{start_block}_{end_block}', 'w') as f:
             f.write(','.join(failed_blocks))
 
-
 if __name__ == '__main__':
     main()
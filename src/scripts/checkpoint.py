@@ -0,0 +1,141 @@
+import sqlite3
+import threading
+import time
+
+
+MANIFEST_PATH = './ingestion_manifest.sqlite' # Default location of the checkpoint manifest.
+COMMITTED = 'committed'
+FAILED = 'failed'
+
+
+def merge_ranges(ranges) -> list[tuple[int, int]]:
+    """
+    Merges a list of inclusive block ranges into sorted, disjoint and non-adjacent ranges.
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def subtract_ranges(ranges, removed) -> list[tuple[int, int]]:
+    """
+    Returns the blocks of 'ranges' which are not in 'removed', as merged ranges.
+    """
+    result = []
+    removed = merge_ranges(removed)
+    for start, end in merge_ranges(ranges):
+        for removed_start, removed_end in removed:
+            if removed_end < start or removed_start > end:
+                continue
+            if removed_start > start:
+                result.append((start, removed_start - 1))
+            start = removed_end + 1
+        if start <= end:
+            result.append((start, end))
+    return result
+
+
+def split_batches(ranges, batch_size: int) -> list[tuple[int, int]]:
+    """
+    Splits each range into consecutive batches of at most 'batch_size' blocks.
+    """
+    return [
+        (start, min(end, start + batch_size - 1))
+        for range_start, end in ranges
+        for start in range(range_start, end + 1, batch_size)
+    ]
+
+
+class Manifest:
+    """
+    Durable local record (an SQLite file) of the block ranges which were committed to,
+    or failed to be written to, each table. It lets an interrupted ingestion resume
+    with only the missing or failed ranges. It can be shared by several processes.
+    """
+
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('pragma journal_mode=wal')
+            self.connection.execute("""
+                create table if not exists ranges (
+                    table_name text not null,
+                    start_block integer not null,
+                    end_block integer not null,
+                    status text not null,
+                    updated_at real not null
+                )
+                """)
+            self.connection.execute('create index if not exists ranges_table on ranges (table_name, status)')
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def record(self, table: str, start_block: int, end_block: int, status: str) -> None:
+        """
+        Records that the blocks in [start_block, end_block] were committed to, or failed to be written to, 'table'.
+        A committed range clears the failures of its blocks.
+        """
+        with self.lock, self.connection:
+            if status == COMMITTED:
+                failed = self.connection.execute(
+                    'select start_block, end_block from ranges where table_name = ? and status = ? and end_block >= ? and start_block <= ?',
+                    (table, FAILED, start_block, end_block)).fetchall()
+                self.connection.execute(
+                    'delete from ranges where table_name = ? and status = ? and end_block >= ? and start_block <= ?',
+                    (table, FAILED, start_block, end_block))
+                # Keep the failed blocks on either side of the committed range.
+                remaining = subtract_ranges(failed, [(start_block, end_block)])
+                self.connection.executemany(
+                    'insert into ranges values (?, ?, ?, ?, ?)',
+                    [(table, start, end, FAILED, time.time()) for start, end in remaining])
+            self.connection.execute(
+                'insert into ranges values (?, ?, ?, ?, ?)', (table, start_block, end_block, status, time.time()))
+
+    def ranges(self, table: str, status: str) -> list[tuple[int, int]]:
+        with self.lock:
+            rows = self.connection.execute(
+                'select start_block, end_block from ranges where table_name = ? and status = ?', (table, status)).fetchall()
+        return merge_ranges(rows)
+
+    def commits(self, table: str) -> int:
+        """
+        Number of commits recorded for 'table', which changes whenever a range is committed again,
+        e.g. by a rerun in the REPLACE mode, even if the committed ranges stay the same.
+        """
+        with self.lock:
+            return self.connection.execute(
+                'select count(*) from ranges where table_name = ? and status = ?', (table, COMMITTED)).fetchone()[0]
+
+    def missing_ranges(self, table: str, start_block: int, end_block: int) -> list[tuple[int, int]]:
+        """
+        Ranges of blocks in [start_block, end_block] which were not committed to 'table'.
+        """
+        return subtract_ranges([(start_block, end_block)], self.ranges(table, COMMITTED))
+
+    def failed_ranges(self, table: str, start_block: int, end_block: int) -> list[tuple[int, int]]:
+        """
+        Ranges of blocks in [start_block, end_block] whose last attempt failed.
+        """
+        return [
+            (max(start, start_block), min(end, end_block))
+            for start, end in self.ranges(table, FAILED)
+            if end >= start_block and start <= end_block
+        ]
+
+
+def ranges_to_process(args, table: str, manifest: Manifest) -> list[tuple[int, int]]:
+    """
+    The block ranges an ingestion script must process, given the --resume and --retry-failed options.
+    """
+    if args.resume:
+        return manifest.missing_ranges(table, args.start_block, args.end_block)
+    if args.retry_failed:
+        return manifest.failed_ranges(table, args.start_block, args.end_block)
+    return [(args.start_block, args.end_block)]
@@ -0,0 +1,112 @@
+import asyncio
+import random
+import time
+from collections import deque
+from itertools import islice
+from starknet_py.net.full_node_client import ClientError
+
+
+RETRYABLE_ERRORS = (asyncio.TimeoutError, ClientError) # Errors after which a request is retried.
+
+
+class RateLimiter:
+    """
+    Spaces out the start of requests so that at most 'requests_per_second'
+    requests are started in any second. A value of None disables the limit.
+    """
+
+    def __init__(self, requests_per_second=None):
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        """
+        Waits until the next request is allowed to start.
+        """
+        if not self.interval:
+            return
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class StateUpdateFetcher:
+    """
+    Fetches state updates from a FullNodeClient with a bounded number of requests in flight.
+    Failed requests are retried with exponential backoff and full jitter; a block whose
+    retries are exhausted is reported with the last exception instead of a state update.
+    """
+
+    def __init__(self, client, concurrency=16, max_retries=5, base_delay=0.5, max_delay=30.0, requests_per_second=None):
+        self.client = client
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.retries = 0 # Total number of retried requests, for reporting.
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Delay before retry number 'attempt' (starting at 0).
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def fetch_block(self, block: int):
+        """
+        Returns the state update of 'block', raising the last error if all retries fail.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.semaphore:
+                    await self.rate_limiter.wait()
+                    return await self.client.get_state_update(block_number=block)
+            except RETRYABLE_ERRORS:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+            # Sleep outside of the semaphore so that other blocks can use the slot.
+            await asyncio.sleep(self.backoff(attempt))
+
+    def fetch_batches(self, start_block: int, end_block: int, batch_size: int):
+        """
+        Asynchronous generator over the blocks in [start_block, end_block], in batches of 'batch_size' blocks
+        (see fetch_windows).
+        """
+        return self.fetch_windows((start, min(end_block, start + batch_size - 1)) for start in range(start_block, end_block + 1, batch_size))
+
+    async def fetch_windows(self, windows):
+        """
+        Asynchronous generator over the blocks of the consecutive windows (start, end) of the iterable 'windows'.
+        Each item is a tuple (start, end, results) where results is a list of pairs (block, state update or exception),
+        ordered by block number. Requests for the following windows are already in flight while a window is consumed,
+        and 'windows' is only read as they are scheduled, so it can choose their sizes from the windows consumed so far.
+        If the generator is closed early (or the consumer raises), the requests still in flight are cancelled.
+        """
+        windows = iter(windows)
+        pending = deque()
+        try:
+            while True:
+                # Enough windows are scheduled after the first one to keep all the request slots busy.
+                while len(pending) < 2 or sum(end - start + 1 for start, end, _ in islice(pending, 1, None)) < self.concurrency:
+                    window = next(windows, None)
+                    if window is None:
+                        break
+                    start, end = window
+                    pending.append((start, end, [asyncio.ensure_future(self.fetch_block(block)) for block in range(start, end + 1)]))
+                if not pending:
+                    break
+                start, end, tasks = pending[0]
+                results = await asyncio.gather(*tasks, return_exceptions=True)
+                pending.popleft()
+                yield start, end, list(zip(range(start, end + 1), results))
+        finally:
+            tasks = [task for _, _, window_tasks in pending for task in window_tasks]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
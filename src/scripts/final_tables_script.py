@@ -1,45 +1,93 @@
 import pandas as pd
 import queries.generators
+from metrics import Metrics, metrics_from_args, profiled
+from orchestrator import DONE, pipeline_stages, run_stages
+from queries.pipeline import backfill_queries, pipeline_queries
+from tags import NAMED_CONTRACTS_CSV_PATH, TagIndex
 from utils import get_connection, parser
 
 
-DEFAULT_PER_STEP = 0.01 # Gas per Cairo step.
-DEFAULT_PER_DIFF = 1024 # Gas per key-value: 16 gas per byte, i.e. 512 gas per word (32B), multiplied by 2.
-NAMED_CONTRACTS_CSV_PATH = '../csv/names.csv' # Contains addresses with their tag.
 CSV_FOLDER_PATH = '../csv'
 
 
 def create_table(df, version):
-    names = pd.read_csv(NAMED_CONTRACTS_CSV_PATH)
-    tag_list = []
-    for contract in df['CONTRACT']:
-        res = names[names['CONTRACT'] == contract]['NAMES']
-        tag_list.append(res.values[0] if res.shape[0] else 0)
-    df['NAMES'] = pd.Series(tag_list)
+    names = TagIndex.from_csv(NAMED_CONTRACTS_CSV_PATH, 'CONTRACT', 'NAMES')
+    df['NAMES'] = names.lookup(df['CONTRACT'], default=0)
     df.to_csv(f"{CSV_FOLDER_PATH}/fee_amounts_v{version}.csv", float_format='{:.20f}'.format)
 
 
+def check_new_range(cs, start_block) -> None:
+    """
+    The incremental mode adds the fees of the new blocks to the per contract totals, so it must
+    only be run on blocks that are not in the tables yet, otherwise their fees would be counted twice.
+    The totals are merged on their 'contract_key' column, so the tables must have been built with it
+    (the tables built before the contract keys must be rebuilt once without the incremental mode).
+    """
+    has_key = cs.execute(queries.generators.column_count('final_fee_amounts_divided', 'contract_key')).fetch_pandas_all().at[0, 'COLUMN_COUNT']
+    if not has_key:
+        raise ValueError('The final_fee_amounts_divided table has no contract_key column: '
+                         'rebuild the tables without the incremental mode first.')
+    last_block = cs.execute(queries.generators.max_block_number('final')).fetch_pandas_all().at[0, 'MAX_BLOCK_NUMBER']
+    if not pd.isna(last_block) and start_block <= last_block:
+        raise ValueError(f'The tables already contain blocks up to {last_block}: '
+                         f'the incremental range must start after it, not at {start_block}.')
+
+
+def build_tables(cnx, start_block, end_block, incremental=False, backfill_keys=False, async_queries=False, jobs=4, metrics=None) -> pd.DataFrame:
+    """
+    Builds the tables of pipeline_queries (see the options of the script), and returns the result of the ranking query.
+    In the incremental mode, the ranking is only queried once the new blocks are committed.
+    Each query is recorded in 'metrics' (see metrics.Metrics).
+    """
+    cs = cnx.cursor()
+    metrics = metrics or Metrics()
+
+    def execute(query):
+        with metrics.stage('query', statement=' '.join(query.split())[:100]) as fields:
+            cs.execute(query)
+            fields['query_id'] = getattr(cs, 'sfqid', None)
+
+    if backfill_keys:
+        for query in backfill_queries():
+            execute(query)
+    if async_queries:
+        statuses = run_stages(cnx, pipeline_stages(start_block, end_block), jobs=jobs, force=True, async_queries=True, metrics=metrics)
+        if any(status != DONE for status in statuses.values()):
+            raise SystemExit('Some queries failed: the ranking was not computed.')
+    else:
+        *build_queries, _ = pipeline_queries(start_block, end_block, incremental=incremental)
+        if incremental:
+            check_new_range(cs, start_block)
+            # The appends and the update of the totals are committed together, so that a failed run can be rerun.
+            cs.execute('begin')
+        try:
+            for query in build_queries:
+                execute(query)
+        except Exception:
+            if incremental:
+                cs.execute('rollback')
+            raise
+        if incremental:
+            cs.execute('commit')
+    execute(queries.generators.ranking_l1_l2())
+    return cs.fetch_pandas_all()
+
+
 if __name__ == '__main__':
     parser = parser()
     parser.add_argument('version', type=str)
+    parser.add_argument('--incremental', action='store_true',
+                        help='Append the blocks in [start_block, end_block] to the existing tables instead of rebuilding them.')
+    parser.add_argument('--backfill-keys', action='store_true',
+                        help="Fill the 'contract_key' column of the rows ingested before it existed, before building the tables.")
+    parser.add_argument('--async-queries', action='store_true',
+                        help='Submit the independent queries at once with the asynchronous query execution of the connector.')
+    parser.add_argument('--jobs', type=int, default=4, help='Maximum number of queries run at once, with --async-queries.')
     args = parser.parse_args()
-    start_block, end_block, version = args.start_block, args.end_block, args.version
-    cs = get_connection().cursor()
-
-    # Pipeline to build all the tables except the 'cairo_steps_script' and 'storage_diffs_script' tables.
-    pipe_queries = [
-        queries.generators.block_fee(start_block=start_block, end_block=end_block),
-        queries.generators.builtin_gas(start_block=start_block, end_block=end_block),
-        queries.generators.diffs_per_contract_per_block(),
-        queries.generators.steps_per_contract_per_block(),
-        queries.generators.join_steps_and_diffs(),
-        queries.generators.final(),
-        queries.generators.final_proportions(gas_per_step=DEFAULT_PER_STEP, gas_per_diff=DEFAULT_PER_DIFF),
-        queries.generators.final_fee_divided(),
-        queries.generators.ranking_l1_l2()
-    ]
-
-    for query in pipe_queries:
-        cs.execute(query)
-    df = cs.fetch_pandas_all()
-    create_table(df, version)
\ No newline at end of file
+    if args.async_queries and args.incremental:
+        parser.error('--async-queries rebuilds the tables, it cannot be combined with --incremental.')
+    start_block, end_block = args.start_block, args.end_block
+    with profiled(args.profile, f'./final_tables_profile_{start_block}_{end_block}'):
+        df = build_tables(get_connection(), start_block, end_block, incremental=args.incremental, backfill_keys=args.backfill_keys,
+                          async_queries=args.async_queries, jobs=args.jobs, metrics=metrics_from_args(args, 'final_tables_script'))
+    create_table(df, args.version)
@@ -0,0 +1,140 @@
+import os
+import shutil
+import tempfile
+import time
+import uuid
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import queries.generators
+from checkpoint import merge_ranges
+from metrics import Metrics
+from writers import APPEND
+
+
+FLUSH_BYTES = 256 * 2**20 # Size of the buffered Parquet files after which the loader loads them.
+FLUSH_SECONDS = 600.0 # Age of the oldest buffered file after which the loader loads the files.
+
+
+def loader_options(args) -> dict | None:
+    """
+    Options of the BulkLoader given by the --bulk-load options of utils.ingestion_parser,
+    or None if the batches are written one by one.
+    """
+    if not args.bulk_load:
+        return None
+    return {'flush_bytes': int(args.flush_mb * 2**20), 'flush_seconds': args.flush_seconds}
+
+
+class BulkLoader:
+    """
+    Loads the batches of an ingestion script into a table in bulk: the batches are written as local
+    Parquet files, and each flush uploads all the buffered files to a temporary stage with a single PUT
+    and loads them with a single COPY INTO, instead of one write_pandas call (and one stage and COPY cycle)
+    per batch. The files are flushed when their total size reaches 'flush_bytes', or when the oldest one
+    is 'flush_seconds' old.
+    In the REPLACE mode (see writers.write_range), the rows of the block ranges of the flush are deleted
+    and the files loaded in a single transaction, so reruns never duplicate rows.
+    Each flush is recorded in 'metrics' (see metrics.Metrics).
+    """
+
+    def __init__(self, cnx, table_name: str, mode=APPEND, flush_bytes=FLUSH_BYTES, flush_seconds=FLUSH_SECONDS, metrics=None):
+        self.cnx = cnx
+        self.table_name = table_name
+        self.mode = mode
+        self.flush_bytes = flush_bytes
+        self.flush_seconds = flush_seconds
+        self.metrics = metrics or Metrics()
+        self.stage_name = f'{table_name}_LOAD_{uuid.uuid4().hex[:12].upper()}'
+        self.folder = tempfile.mkdtemp(prefix=f'{table_name.lower()}_load_')
+        self.ranges = [] # Block ranges of the buffered files, in the order they were added.
+        self.buffered_bytes = 0
+        self.first_added_at = None
+        self.flushes = 0 # Number of flushes, for reporting.
+        self.last_error = None # Error of the last failed load, for reporting.
+
+    def due(self) -> bool:
+        """
+        Whether the buffered files reached the size or the time threshold.
+        """
+        if not self.ranges:
+            return False
+        return self.buffered_bytes >= self.flush_bytes or time.monotonic() - self.first_added_at >= self.flush_seconds
+
+    def add(self, df: pd.DataFrame | pa.Table, start_block: int, end_block: int) -> list[tuple[int, int, bool]]:
+        """
+        Buffers the rows (of a dataframe or of an Arrow table) of the blocks in [start_block, end_block]. Consecutive calls with the same range
+        add rows to that range (e.g. the batches of a window in the stream mode). The thresholds are only
+        checked when a new range starts, so that a range is never split between two loads.
+        Returns the outcomes (start, end, success) of the ranges loaded by this call, if it flushed.
+        """
+        results = []
+        if self.ranges and self.ranges[-1] != (start_block, end_block) and self.due():
+            results = self.flush()
+        if not self.ranges:
+            self.first_added_at = time.monotonic()
+        path = os.path.join(self.folder, f'{start_block}_{end_block}_{uuid.uuid4().hex[:8]}.parquet')
+        if isinstance(df, pa.Table):
+            pq.write_table(df, path, compression='snappy')
+        else:
+            df.to_parquet(path, index=False, compression='snappy')
+        self.buffered_bytes += os.path.getsize(path)
+        if not self.ranges or self.ranges[-1] != (start_block, end_block):
+            self.ranges.append((start_block, end_block))
+        return results
+
+    def flush(self) -> list[tuple[int, int, bool]]:
+        """
+        Loads all the buffered files with one PUT and one COPY INTO, and returns the outcome (start, end, success)
+        of each buffered range. The buffered files are removed, whether the load succeeded or not.
+        """
+        if not self.ranges:
+            return []
+        cs = self.cnx.cursor()
+        ranges, self.ranges = self.ranges, []
+        success = False
+        with self.metrics.stage('flush', table=self.table_name, ranges=len(ranges), bytes=self.buffered_bytes,
+                                start_block=min(start for start, _ in ranges), end_block=max(end for _, end in ranges)) as fields:
+            try:
+                cs.execute(queries.generators.create_load_stage(self.stage_name))
+                cs.execute(queries.generators.put_files(os.path.join(self.folder, '*.parquet'), self.stage_name))
+                cs.execute(queries.generators.create_parquet_file_format(self.stage_name))
+                cs.execute(queries.generators.create_table_from_stage(self.table_name, self.stage_name))
+                cs.execute('begin')
+                try:
+                    if self.mode != APPEND:
+                        for start, end in merge_ranges(ranges):
+                            cs.execute(queries.generators.delete_block_range(self.table_name, start, end))
+                    cs.execute(queries.generators.copy_from_stage(self.table_name, self.stage_name))
+                    fields['query_id'] = getattr(cs, 'sfqid', None)
+                    cs.execute('commit')
+                except Exception:
+                    cs.execute('rollback')
+                    raise
+                success = True
+            except Exception as error:
+                self.last_error = error
+                fields['error'] = repr(error)
+                # The files of a failed load must not be loaded by the next flush.
+                try:
+                    cs.execute(queries.generators.remove_stage_files(self.stage_name))
+                except Exception as cleanup_error:
+                    # The next flushes use a new stage instead, and the outcomes of the ranges are still returned.
+                    fields['cleanup_error'] = repr(cleanup_error)
+                    self.stage_name = f'{self.table_name}_LOAD_{uuid.uuid4().hex[:12].upper()}'
+            finally:
+                for name in os.listdir(self.folder):
+                    os.remove(os.path.join(self.folder, name))
+                self.buffered_bytes = 0
+                self.flushes += 1
+            fields['success'] = success
+        return [(start, end, success) for start, end in ranges]
+
+    def close(self) -> list[tuple[int, int, bool]]:
+        """
+        Flushes the buffered files and removes the local folder. Returns the outcomes of the last flush.
+        """
+        try:
+            return self.flush()
+        finally:
+            shutil.rmtree(self.folder, ignore_errors=True)
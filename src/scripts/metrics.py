@@ -0,0 +1,133 @@
+import cProfile
+import json
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+import pyarrow as pa
+
+
+PROFILERS = ('cpu', 'memory') # cProfile, or tracemalloc.
+REPORT_LINES = 50 # Functions, or allocation sites, in the text reports of the profilers.
+_LOCK = threading.Lock() # Serializes the records of the threads of a process.
+
+
+def peak_rss() -> int:
+    """
+    Peak resident set size of the process, in bytes.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, and macOS bytes.
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def frame_bytes(df) -> int:
+    """
+    Memory used by a dataframe (or 0 for None), including the strings of its object columns, or by an Arrow table.
+    """
+    if df is None:
+        return 0
+    if isinstance(df, pa.Table):
+        return df.nbytes
+    return int(df.memory_usage(index=False, deep=True).sum())
+
+
+class Metrics:
+    """
+    Writes the metrics of the stages of a script to the file 'path', one JSON object per line,
+    with the time, the script, the process and its peak RSS, the event (e.g. 'fetch', 'write', 'query')
+    and its fields (e.g. the block range, the rows, the bytes, the query id, the number of retries).
+    Without 'path', nothing is written. The file is opened in append mode for each record, so that the
+    threads and the worker processes of a script can share it.
+    """
+
+    def __init__(self, path=None, script=None):
+        self.path = path
+        self.script = script
+
+    def emit(self, event: str, **fields) -> None:
+        """
+        Writes a record of 'event'. The records with a block range and a duration in seconds get their blocks per second.
+        """
+        if self.path is None:
+            return
+        if fields.get('start_block') is not None and fields.get('seconds'):
+            fields['blocks_per_second'] = (fields['end_block'] - fields['start_block'] + 1) / fields['seconds']
+        record = {'time': time.time(), 'script': self.script, 'pid': os.getpid(), 'event': event, **fields, 'peak_rss': peak_rss()}
+        line = json.dumps(record, default=str) + '\n'
+        with _LOCK, open(self.path, 'a') as f:
+            f.write(line)
+
+    @contextmanager
+    def stage(self, event: str, start_block=None, end_block=None, **fields):
+        """
+        Times the body of the with statement, and emits it as 'event' with its duration in seconds
+        (see emit). The body can add fields to the yielded dict, and the error which interrupted it, if any, is recorded.
+        """
+        record = dict(fields)
+        if start_block is not None:
+            record.update(start_block=start_block, end_block=end_block)
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException as error:
+            record['error'] = repr(error)
+            raise
+        finally:
+            self.emit(event, seconds=time.perf_counter() - start, **record)
+
+
+@contextmanager
+def profiled(profiler, prefix: str):
+    """
+    Runs the body of the with statement under cProfile ('cpu') or tracemalloc ('memory'), or as is if 'profiler'
+    is None. The cpu profile is saved to '{prefix}.prof' (for pstats or snakeviz) with a text report of the
+    functions of largest cumulative time in '{prefix}.txt', and the memory report of the largest allocation
+    sites, with the peak of the traced memory, to '{prefix}_memory.txt'.
+    """
+    if profiler is None:
+        yield
+        return
+    if profiler == 'cpu':
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(prefix + '.prof')
+            with open(prefix + '.txt', 'w') as f:
+                pstats.Stats(profile, stream=f).sort_stats('cumulative').print_stats(REPORT_LINES)
+        return
+    tracemalloc.start(25)
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        with open(prefix + '_memory.txt', 'w') as f:
+            f.write(f'peak traced memory: {peak / 2**20:.1f} MiB\n')
+            for statistic in snapshot.statistics('lineno')[:REPORT_LINES]:
+                f.write(f'{statistic}\n')
+
+
+def add_metrics_arguments(parser) -> None:
+    """
+    Adds the options of the metrics and of the profilers to the parser of a script.
+    """
+    parser.add_argument('--metrics', default=None, help='JSON-lines file where the metrics of each stage and batch are appended.')
+    parser.add_argument('--profile', choices=PROFILERS, default=None,
+                        help='Profile the run (of the main process) with cProfile or tracemalloc, and save the reports '
+                             'next to the failed blocks files.')
+
+
+def metrics_from_args(args, script: str) -> Metrics:
+    """
+    The Metrics given by the options of add_metrics_arguments.
+    """
+    return Metrics(args.metrics, script)
@@ -0,0 +1,305 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import queries.generators
+from checkpoint import COMMITTED, MANIFEST_PATH, Manifest
+from metrics import Metrics, metrics_from_args, profiled
+from queries.pipeline import BUILTIN_PRICES, DEFAULT_PER_DIFF, DEFAULT_PER_STEP, INGESTION_TABLES
+
+
+DONE = 'done'
+SKIPPED = 'skipped' # Up to date: the table was built from the same query and the same upstream tables.
+FAILED = 'failed'
+CANCELLED = 'cancelled' # Not run, because an upstream stage failed.
+POLL_INTERVAL = 2.0 # Seconds between two polls of the status of the asynchronous queries.
+
+
+class Stage:
+    """
+    Node of the DAG of the pipeline: the query which builds the table 'name' from the tables 'upstream',
+    with the parameters 'params' it was generated from. A stage without query is a source, a table
+    built outside of the DAG (e.g. by an ingestion script), whose 'params' describe the content.
+    """
+
+    def __init__(self, name: str, query=None, upstream=(), params=None):
+        self.name = name
+        self.query = query
+        self.upstream = tuple(upstream)
+        self.params = params or {}
+
+
+def topological_order(stages: list[Stage]) -> list[Stage]:
+    """
+    The stages ordered so that each stage comes after its upstream stages.
+    Raises a ValueError if an upstream stage is missing or if the stages have a cycle.
+    """
+    by_name = {stage.name: stage for stage in stages}
+    order, visiting, visited = [], set(), set()
+
+    def visit(stage):
+        if stage.name in visited:
+            return
+        if stage.name in visiting:
+            raise ValueError(f'The stages have a cycle through {stage.name}.')
+        visiting.add(stage.name)
+        for name in stage.upstream:
+            if name not in by_name:
+                raise ValueError(f'Unknown upstream stage {name} of {stage.name}.')
+            visit(by_name[name])
+        visiting.remove(stage.name)
+        visited.add(stage.name)
+        order.append(stage)
+
+    for stage in stages:
+        visit(stage)
+    return order
+
+
+def fingerprints(stages: list[Stage]) -> dict[str, str]:
+    """
+    Fingerprint (sha256) of each stage, which changes whenever its query (up to whitespace), its parameters
+    or the fingerprint of one of its upstream stages changes.
+    """
+    result = {}
+    for stage in topological_order(stages):
+        content = {
+            'name': stage.name,
+            'query': None if stage.query is None else ' '.join(stage.query.split()),
+            'params': stage.params,
+            'upstream': [result[name] for name in stage.upstream]
+        }
+        result[stage.name] = hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+    return result
+
+
+class FingerprintStore:
+    """
+    Fingerprints of the stages whose table was last built successfully, in the checkpoint manifest file.
+    """
+
+    def __init__(self, path=MANIFEST_PATH):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("""
+                create table if not exists stages (
+                    name text primary key,
+                    fingerprint text not null,
+                    updated_at real not null
+                )
+                """)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def get(self) -> dict[str, str]:
+        with self.lock:
+            return dict(self.connection.execute('select name, fingerprint from stages').fetchall())
+
+    def record(self, name: str, fingerprint: str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute('insert or replace into stages values (?, ?, ?)', (name, fingerprint, time.time()))
+
+
+def pipeline_stages(start_block, end_block, manifest=None, gas_per_step=DEFAULT_PER_STEP, gas_per_diff=DEFAULT_PER_DIFF,
+                    builtin_prices=BUILTIN_PRICES) -> list[Stage]:
+    """
+    The DAG of queries.pipeline.pipeline_queries (without the ranking, which is always run).
+    The tables of the ingestion scripts are sources, described by their committed ranges and their number
+    of commits in 'manifest' (if one is given), so that the stages which read them are stale once blocks
+    are ingested, whether they are new blocks or blocks which were rewritten.
+    Before they are read, the 'contract_key' column is added to them and filled for the rows ingested
+    before it existed (see queries.pipeline.backfill_queries), by the '{table}_contract_key_column'
+    and '{table}_contract_keys' stages.
+    """
+    block_range = {'start_block': start_block, 'end_block': end_block}
+    weights = {'gas_per_step': gas_per_step, 'gas_per_diff': gas_per_diff}
+    sources = [
+        Stage(table_name, params={} if manifest is None else {
+            'committed': manifest.ranges(table_name.upper(), COMMITTED),
+            'commits': manifest.commits(table_name.upper())
+        })
+        for table_name in INGESTION_TABLES
+    ]
+    contract_keys = [
+        stage
+        for table_name in INGESTION_TABLES
+        for stage in (
+            Stage(f'{table_name}_contract_key_column', queries.generators.add_contract_key(table_name), [table_name]),
+            Stage(f'{table_name}_contract_keys', queries.generators.backfill_contract_key(table_name),
+                  [f'{table_name}_contract_key_column'])
+        )
+    ]
+    return sources + [
+        Stage('block_fee', queries.generators.block_fee(**block_range), params=block_range),
+        Stage('builtin_gas_per_block', queries.generators.builtin_gas(builtin_prices, **block_range),
+              params={**block_range, 'builtin_prices': builtin_prices}),
+        *contract_keys,
+        Stage('steps_per_contract_per_block', queries.generators.steps_per_contract_per_block(),
+              ['cairo_steps_script', 'cairo_steps_script_contract_keys']),
+        Stage('diffs_per_contract_per_block', queries.generators.diffs_per_contract_per_block(),
+              ['storage_diffs_script', 'storage_diffs_script_contract_keys']),
+        Stage('join_steps_and_diffs', queries.generators.join_steps_and_diffs(),
+              ['steps_per_contract_per_block', 'diffs_per_contract_per_block']),
+        Stage('final', queries.generators.final(), ['join_steps_and_diffs', 'block_fee']),
+        Stage('final_proportions', queries.generators.final_proportions(**weights), ['final', 'builtin_gas_per_block'], params=weights),
+        Stage('final_fee_amounts_divided', queries.generators.final_fee_divided(), ['final_proportions'])
+    ]
+
+
+class ThreadQueries:
+    """
+    Runs each query on its own cursor in a pool of 'jobs' threads.
+    """
+
+    def __init__(self, cnx, jobs: int):
+        self.cnx = cnx
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+
+    def submit(self, query: str):
+        return self.executor.submit(lambda: self.cnx.cursor().execute(query))
+
+    def wait(self, running) -> dict:
+        """
+        Waits until at least one of the 'running' queries finishes, and returns the error (or None) of each finished query.
+        """
+        finished, _ = wait(running, return_when=FIRST_COMPLETED)
+        return {future: future.exception() for future in finished}
+
+    @staticmethod
+    def query_id(future):
+        return None if future.exception() else getattr(future.result(), 'sfqid', None)
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+
+class AsyncQueries:
+    """
+    Runs the queries with the asynchronous query execution of the connector: the queries are submitted
+    with execute_async, so they run at the same time on the warehouse from a single connection,
+    and their status is polled every 'poll_interval' seconds.
+    """
+
+    def __init__(self, cnx, poll_interval=POLL_INTERVAL):
+        self.cnx = cnx
+        self.poll_interval = poll_interval
+
+    def submit(self, query: str) -> str:
+        cs = self.cnx.cursor()
+        cs.execute_async(query)
+        return cs.sfqid
+
+    def wait(self, running) -> dict:
+        """
+        Waits until at least one of the 'running' queries (given by their ids) finishes,
+        and returns the error (or None) of each finished query.
+        """
+        while True:
+            finished = {}
+            for query_id in running:
+                try:
+                    status = self.cnx.get_query_status_throw_if_error(query_id)
+                except Exception as error:
+                    finished[query_id] = error
+                    continue
+                if not self.cnx.is_still_running(status):
+                    finished[query_id] = None
+            if finished:
+                return finished
+            time.sleep(self.poll_interval)
+
+    @staticmethod
+    def query_id(query_id):
+        return query_id
+
+    def close(self) -> None:
+        pass
+
+
+def run_stages(cnx, stages: list[Stage], store=None, jobs=1, force=False, dry_run=False, async_queries=False,
+               poll_interval=POLL_INTERVAL, metrics=None, log=print) -> dict[str, str]:
+    """
+    Runs the stale stages of the DAG, i.e. the stages whose fingerprint differs from the one recorded in 'store'
+    (all the stages if 'force' is True, or if there is no store), with at most 'jobs' queries at once: a stage
+    is started as soon as its upstream stages are built, so the independent branches run concurrently,
+    in threads, or with the asynchronous query execution of the connector if 'async_queries' is True
+    (polling the status of the queries every 'poll_interval' seconds).
+    The fingerprint of a stage is recorded once its query succeeds. When a stage fails, its downstream stages
+    are cancelled, and the other branches still run. Each query run is recorded in 'metrics' (see metrics.Metrics).
+    Returns the status of each stage which is not a source: DONE, SKIPPED, FAILED or CANCELLED
+    (or the stale stages, with the status 'stale', if 'dry_run' is True).
+    """
+    current = fingerprints(stages)
+    recorded = {} if store is None else store.get()
+    stages = [stage for stage in topological_order(stages) if stage.query is not None]
+    stale = {stage.name for stage in stages if force or recorded.get(stage.name) != current[stage.name]}
+    if dry_run:
+        return {stage.name: 'stale' if stage.name in stale else SKIPPED for stage in stages}
+    statuses = {name: SKIPPED for name in {stage.name for stage in stages} - stale}
+    pending = [stage for stage in stages if stage.name in stale]
+    metrics = metrics or Metrics()
+    runner = AsyncQueries(cnx, poll_interval) if async_queries else ThreadQueries(cnx, jobs)
+    running = {} # The running stages and their start time, by query.
+    try:
+        while pending or running:
+            for stage in list(pending):
+                upstream = [statuses.get(name, None if name in stale else DONE) for name in stage.upstream]
+                if any(status in (FAILED, CANCELLED) for status in upstream):
+                    statuses[stage.name] = CANCELLED
+                    pending.remove(stage)
+                    log(f'{stage.name}: cancelled')
+                elif all(status in (DONE, SKIPPED) for status in upstream) and len(running) < jobs:
+                    running[runner.submit(stage.query)] = (stage, time.time())
+                    pending.remove(stage)
+            if not running:
+                continue
+            for query, error in runner.wait(list(running)).items():
+                stage, started_at = running.pop(query)
+                metrics.emit('stage', stage=stage.name, seconds=time.time() - started_at, query_id=runner.query_id(query),
+                             success=error is None, error=None if error is None else repr(error))
+                if error is None:
+                    if store is not None:
+                        store.record(stage.name, current[stage.name])
+                    log(f'{stage.name}: built in {time.time() - started_at:.1f}s')
+                    statuses[stage.name] = DONE
+                else:
+                    log(f'{stage.name}: failed ({error})')
+                    statuses[stage.name] = FAILED
+    finally:
+        runner.close()
+    return statuses
+
+
+if __name__ == '__main__':
+    from final_tables_script import create_table
+    from utils import get_connection, parser
+    parser = parser()
+    parser.add_argument('version', type=str)
+    parser.add_argument('--jobs', type=int, default=4, help='Maximum number of queries run at once.')
+    parser.add_argument('--manifest', default=MANIFEST_PATH, help='Checkpoint manifest of the ingestion scripts, where the fingerprints are kept.')
+    parser.add_argument('--force', action='store_true', help='Rebuild all the tables, even the up to date ones.')
+    parser.add_argument('--dry-run', action='store_true', help='Only print the stale stages.')
+    parser.add_argument('--async-queries', action='store_true',
+                        help='Submit the queries with the asynchronous query execution of the connector instead of threads.')
+    args = parser.parse_args()
+
+    manifest = Manifest(args.manifest)
+    store = FingerprintStore(args.manifest)
+    stages = pipeline_stages(args.start_block, args.end_block, manifest)
+    cnx = None if args.dry_run else get_connection()
+    with profiled(args.profile, f'./orchestrator_profile_{args.start_block}_{args.end_block}'):
+        statuses = run_stages(cnx, stages, store, jobs=args.jobs, force=args.force, dry_run=args.dry_run,
+                              async_queries=args.async_queries, metrics=metrics_from_args(args, 'orchestrator'))
+    store.close()
+    manifest.close()
+    for name, status in statuses.items():
+        print(f'{name}: {status}')
+    if not args.dry_run:
+        if any(status in (FAILED, CANCELLED) for status in statuses.values()):
+            raise SystemExit('Some stages failed: the ranking was not computed.')
+        cs = cnx.cursor()
+        create_table(cs.execute(queries.generators.ranking_l1_l2()).fetch_pandas_all(), args.version)
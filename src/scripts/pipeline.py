@@ -0,0 +1,135 @@
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+
+STAGES = ('fetch', 'compute', 'write')
+_DONE = object() # Marks the end of a queue.
+
+
+class StageTimer:
+    """
+    Accumulates the busy time and the number of batches of each stage of a pipeline.
+    Each stage is timed by a single thread, so no lock is needed.
+    """
+
+    def __init__(self, stages=STAGES):
+        self.seconds = {stage: 0.0 for stage in stages}
+        self.batches = {stage: 0 for stage in stages}
+
+    @contextmanager
+    def time(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.seconds[stage] += seconds
+        self.batches[stage] += 1
+
+    def merge(self, other: 'StageTimer') -> None:
+        for stage in other.seconds:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + other.seconds[stage]
+            self.batches[stage] = self.batches.get(stage, 0) + other.batches[stage]
+
+    def report(self) -> str:
+        """
+        One line per stage with its busy time; the stage with the largest busy time is the bottleneck.
+        """
+        bottleneck = max(self.seconds, key=self.seconds.get)
+        lines = []
+        for stage, seconds in self.seconds.items():
+            batches = self.batches[stage]
+            mean = seconds / batches if batches else 0.0
+            mark = ' (bottleneck)' if stage == bottleneck else ''
+            lines.append(f'{stage}: {seconds:.2f}s over {batches} batches, {mean:.3f}s per batch{mark}')
+        return '\n'.join(lines)
+
+
+def _produce(items, output: queue.Queue, errors: list, stop: threading.Event, timer: StageTimer) -> None:
+    """
+    Puts the items in 'output', followed by _DONE, timing the production of each item as the fetch stage.
+    """
+    try:
+        items = iter(items)
+        while not stop.is_set():
+            start = time.perf_counter()
+            item = next(items, _DONE)
+            if item is _DONE:
+                break
+            timer.add('fetch', time.perf_counter() - start)
+            output.put(item)
+    except BaseException as error:
+        errors.append(error)
+    finally:
+        output.put(_DONE)
+
+
+def run_pipeline(batches, fetch, compute, write, queue_depth=2, timer=None) -> StageTimer:
+    """
+    Runs fetch(start, end), compute(start, end, fetched) and write(start, end, computed) over the
+    (start, end) pairs of 'batches', as three stages running at the same time: a prefetch thread,
+    the calling thread and a writer thread. The stages are connected by queues of at most
+    'queue_depth' batches, which bounds the number of batches held in memory.
+    The first exception raised by a stage is re-raised once the threads are stopped.
+    """
+    fetched = (((start, end), fetch(start, end)) for start, end in batches)
+    return run_stream(fetched, compute, write, queue_depth=queue_depth, timer=timer)
+
+
+def run_stream(items, compute, write, queue_depth=2, timer=None) -> StageTimer:
+    """
+    Same as run_pipeline, where the fetch stage is the iteration over 'items', pairs ((start, end), data),
+    in the prefetch thread. Several items may have the same (start, end).
+    """
+    timer = timer or StageTimer()
+    fetched = queue.Queue(maxsize=queue_depth)
+    computed = queue.Queue(maxsize=queue_depth)
+    errors = []
+    stop = threading.Event()
+
+    def write_all():
+        try:
+            while (item := computed.get()) is not _DONE:
+                (start, end), df = item
+                if not stop.is_set():
+                    with timer.time('write'):
+                        write(start, end, df)
+        except BaseException as error:
+            errors.append(error)
+            stop.set()
+            # Keep draining the queue so that the compute stage is never blocked.
+            while computed.get() is not _DONE:
+                pass
+
+    fetcher = threading.Thread(target=_produce, args=(items, fetched, errors, stop, timer), daemon=True)
+    writer = threading.Thread(target=write_all, daemon=True)
+    fetcher.start()
+    writer.start()
+    try:
+        while (item := fetched.get()) is not _DONE:
+            (start, end), data = item
+            if stop.is_set():
+                continue
+            with timer.time('compute'):
+                result = compute(start, end, data)
+            computed.put(((start, end), result))
+    except BaseException as error:
+        errors.append(error)
+        stop.set()
+        # Unblock the fetch thread, which may be waiting for room in the queue.
+        while fetcher.is_alive():
+            try:
+                fetched.get(timeout=0.1)
+            except queue.Empty:
+                pass
+    finally:
+        computed.put(_DONE)
+        fetcher.join()
+        writer.join()
+    if errors:
+        raise errors[0]
+    return timer
@@ -1,34 +1,151 @@
-def traces(start_block, end_block) -> str:
+def traces(start_block, end_block, ordered=False, lean=False) -> str:
     """
     Get the relevant columns from the 'traces' database to be used
-    in the cairo_steps_script.
+    in the cairo_steps_script. If 'ordered' is True, the traces are ordered
+    by block and by transaction index (the second component of the trace id),
+    so that the traces of a transaction are consecutive. If 'lean' is True,
+    only the columns read by the later stages (block number, trace id, contract
+    and steps) are selected.
     """
 
+    order = "order by tokenflow.decoded.traces.block_number, to_number(split_part(tokenflow.decoded.traces.trace_id, '_', 2))" if ordered else ''
+    details = '' if lean else """
+            tokenflow.decoded.traces.tx_hash,
+            tokenflow.decoded.traces.trace_type,
+            tokenflow.decoded.traces.caller,"""
+    function = '' if lean else """
+            tokenflow.decoded.traces.function,"""
     return  f"""
         select 
             tokenflow.decoded.traces.block_number,
-            tokenflow.decoded.traces.trace_id,
-            tokenflow.decoded.traces.tx_hash,
-            tokenflow.decoded.traces.trace_type,
-            tokenflow.decoded.traces.caller,
-            tokenflow.decoded.traces.contract,
-            tokenflow.decoded.traces.function,
+            tokenflow.decoded.traces.trace_id,{details}
+            tokenflow.decoded.traces.contract,{function}
             tokenflow.decoded.traces.execution_resources['n_steps'] as "STEPS"
         from tokenflow.decoded.traces
         where tokenflow.decoded.traces.block_number <= {end_block}
         and tokenflow.decoded.traces.block_number >= {start_block}
         and tokenflow.decoded.traces.chain_id = 'mainnet'
+        {order}
         """
 
-def builtin_gas(start_block, end_block) -> str:
+def trace_count(start_block, end_block) -> str:
+    """
+    Get the number of traces in the blocks [start_block, end_block],
+    to size the windows of the cairo_steps_script before fetching them.
+    """
+
+    return f"""
+        select
+            count(*) as "ROWS"
+        from tokenflow.decoded.traces
+        where tokenflow.decoded.traces.block_number <= {end_block}
+        and tokenflow.decoded.traces.block_number >= {start_block}
+        and tokenflow.decoded.traces.chain_id = 'mainnet'
+        """
+
+def materialize(table_name, select, incremental=False) -> str:
+    """
+    Create (or replace) the table 'table_name' with the rows returned by 'select',
+    or, if 'incremental' is True, append these rows to the existing table.
+    """
+
+    if incremental:
+        return f"""
+    insert into {table_name}
+    select * from (
+    {select}
+    )
+    ;
+    """
+    return f"""
+    create or replace table {table_name} as (
+    {select}
+    )
+    ;
+    """
+
+def block_range_filter(column, start_block, end_block, incremental, keyword='where') -> str:
+    """
+    Condition restricting 'column' to [start_block, end_block] in the incremental mode,
+    and the empty string otherwise.
+    """
+
+    if not incremental:
+        return ''
+    return f"{keyword} {column} >= {start_block} and {column} <= {end_block}"
+
+def max_block_number(table_name) -> str:
+    """
+    Get the largest block number in the table 'table_name'.
+    """
+
+    return f"""
+    select
+        max(block_number) as "MAX_BLOCK_NUMBER"
+    from {table_name}
+    ;
+    """
+
+def column_count(table_name, column_name) -> str:
+    """
+    Count the columns named 'column_name' of the table 'table_name' of the current schema (0 or 1).
+    """
+
+    return f"""
+    select
+        count(*) as "COLUMN_COUNT"
+    from information_schema.columns
+    where table_schema = current_schema()
+    and table_name = upper('{table_name}')
+    and column_name = upper('{column_name}')
+    ;
+    """
+
+def contract_hex(column) -> str:
+    """
+    Canonical hexadecimal form ('0x' followed by the digits without leading zeros)
+    of the BINARY(32) contract key 'column'.
+    """
+
+    return f"'0x' || coalesce(nullif(ltrim(lower(hex_encode({column})), '0'), ''), '0')"
+
+def add_contract_key(table_name) -> str:
+    """
+    Add the column 'contract_key' (the 32 bytes of the contract address, big-endian)
+    to the table 'table_name', if the table exists and does not have it yet.
+    """
+
+    return f"""
+    alter table if exists {table_name} add column if not exists contract_key binary(32)
+    ;
+    """
+
+def backfill_contract_key(table_name) -> str:
+    """
+    Fill the 'contract_key' column of the rows of 'table_name' written before the column existed,
+    from the 'contract' column. The leading '0x' and zeros are trimmed, and the 64 digits are padded back.
+    """
+
+    return f"""
+    update {table_name}
+    set contract_key = to_binary(lpad(ltrim(lower(contract), '0x'), 64, '0'), 'HEX')
+    where contract_key is null
+    and contract is not null
+    ;
+    """
+
+def builtin_gas(builtin_prices, start_block, end_block, incremental=False) -> str:
     """
     Create a table with columns 'block_number' and 'builtin_gas'
     where builtin_gas contains the total gas due to builtins in the block
-    of number 'block_number'
+    of number 'block_number', with the gas per instance of each builtin given
+    by 'builtin_prices' (the instances of the other builtins are free)
     """
 
-    return f""" 
-    create or replace table builtin_gas_per_block as (
+    costs = '\n        '.join(
+        f"when tx_and_builtins.key = '{builtin}' then {price} * tx_and_builtins.value" for builtin, price in builtin_prices.items()
+    )
+    return materialize('builtin_gas_per_block', f"""
     with tx_and_builtins as (
     select
         *
@@ -40,13 +157,7 @@ def builtin_gas(start_block, end_block) -> str:
     tx_and_builtins_v2 as (
     select
         block_number,
-        case when tx_and_builtins.key = 'pedersen_builtin' then 0.32 * tx_and_builtins.value
-        when tx_and_builtins.key = 'range_check_builtin' then 0.16 * tx_and_builtins.value
-        when tx_and_builtins.key = 'bitwise_builtin' then 0.64 * tx_and_builtins.value
-        when tx_and_builtins.key = 'poseidon_builtin' then 0.32 * tx_and_builtins.value
-        when tx_and_builtins.key = 'ecdsa_builtin' then 20.48 * tx_and_builtins.value
-        when tx_and_builtins.key = 'ec_op_builtin' then 10.24 * tx_and_builtins.value
-        when tx_and_builtins.key = 'keccak_builtin' then 20.48 * tx_and_builtins.value
+        case {costs}
         end "BUILTIN_COST"
     from tx_and_builtins
     )
@@ -55,17 +166,14 @@ def builtin_gas(start_block, end_block) -> str:
         sum(tx_and_builtins_v2.builtin_cost) as "BUILTIN_GAS"
     from tx_and_builtins_v2
     group by block_number
-    )
-    ;
-    """
+    """, incremental)
 
-def block_fee(start_block, end_block) -> str:
+def block_fee(start_block, end_block, incremental=False) -> str:
     """
     Create a table with columns 'block_number' and 'block_fee'
     where block_fee is the total actual fee paid in that block
     """
-    return f""" 
-    create or replace table block_fee as 
+    return materialize('block_fee', f"""
     select
         tokenflow.decoded.transactions.block_number,
         sum(tokenflow.decoded.transactions.actual_fee) as "BLOCK_FEE"
@@ -75,84 +183,87 @@ def block_fee(start_block, end_block) -> str:
     and tokenflow.decoded.transactions.block_number <= {end_block}
     group by tokenflow.decoded.transactions.block_number
     order by tokenflow.decoded.transactions.block_number asc
-    ;
-    """
+    """, incremental)
 
-def steps_per_contract_per_block() -> str:
+def steps_per_contract_per_block(start_block=None, end_block=None, incremental=False) -> str:
     """
     From the cairo_steps_script table deduce the steps per contract per block
-    and create a table for it
+    and create a table for it. In the incremental mode, only the blocks
+    in [start_block, end_block] are computed and appended to the table.
     """
 
-    return f""" 
-    create or replace table steps_per_contract_per_block as (
+    return materialize('steps_per_contract_per_block', f"""
     with main_query as (
         select
             cairo_steps_script.block_number,
-            replace(cairo_steps_script.contract,'0x0','0x') as "CONTRACT", 
+            cairo_steps_script.contract_key,
             sum(cairo_steps_script.individual_steps) as "STEPS_PER_CONTRACT"
         from cairo_steps_script
-        group by cairo_steps_script.block_number, cairo_steps_script.contract
+        {block_range_filter('cairo_steps_script.block_number', start_block, end_block, incremental)}
+        group by cairo_steps_script.block_number, cairo_steps_script.contract_key
     )
     select 
         main_query.block_number,
-        main_query.contract,
+        main_query.contract_key,
+        {contract_hex('main_query.contract_key')} as "CONTRACT",
         main_query.steps_per_contract,
         sum(main_query.steps_per_contract) over (partition by main_query.block_number) as "STEPS_PER_BLOCK"
     from main_query
     order by main_query.block_number asc
-    )
-    ;
-    """
+    """, incremental)
 
-def diffs_per_contract_per_block() -> str:
+def diffs_per_contract_per_block(start_block=None, end_block=None, incremental=False) -> str:
     """
     From the storage_diffs_script table deduce the diffs per contract per block
-    and create a table for it
+    and create a table for it. In the incremental mode, only the blocks
+    in [start_block, end_block] are computed and appended to the table.
     """
     
-    return f""" 
-    create or replace table diffs_per_contract_per_block as (
+    return materialize('diffs_per_contract_per_block', f"""
     select
         storage_diffs_script.block_number,
-        storage_diffs_script.contract,
+        storage_diffs_script.contract_key,
+        {contract_hex('storage_diffs_script.contract_key')} as "CONTRACT",
         storage_diffs_script.updates_per_block as "DIFFS_PER_CONTRACT",
         sum(storage_diffs_script.updates_per_block) over (partition by storage_diffs_script.block_number) as "DIFFS_PER_BLOCK"
     from storage_diffs_script
+    {block_range_filter('storage_diffs_script.block_number', start_block, end_block, incremental)}
     order by block_number asc
-    )
-    ;
-    """
+    """, incremental)
 
-def join_steps_and_diffs() -> str:
+def join_steps_and_diffs(start_block=None, end_block=None, incremental=False) -> str:
     """
     Join the table steps_per_contract_per_block with the table
-    diffs_per_contract_per_block
+    diffs_per_contract_per_block. In the incremental mode, only the blocks
+    in [start_block, end_block] are joined and appended to the table.
     """
     
-    return f""" 
-    create or replace table join_steps_and_diffs as (
+    return materialize('join_steps_and_diffs', f"""
     with temp_left as (
     select
         steps_per_contract_per_block.block_number,
-        regexp_replace(steps_per_contract_per_block.contract,'0x0+','0x') as "CONTRACT",
+        steps_per_contract_per_block.contract_key,
+        steps_per_contract_per_block.contract,
         steps_per_contract_per_block.steps_per_contract,
         case when diffs_per_contract_per_block.diffs_per_contract is null then 0
         else diffs_per_contract_per_block.diffs_per_contract end as "DIFFS_PER_CONTRACT"
     from steps_per_contract_per_block
-    left outer join diffs_per_contract_per_block on regexp_replace(steps_per_contract_per_block.contract,'0x0+','0x') = diffs_per_contract_per_block.contract
+    left outer join diffs_per_contract_per_block on steps_per_contract_per_block.contract_key = diffs_per_contract_per_block.contract_key
     and steps_per_contract_per_block.block_number = diffs_per_contract_per_block.block_number
+    {block_range_filter('steps_per_contract_per_block.block_number', start_block, end_block, incremental)}
     ),
     temp_right as (
     select
         diffs_per_contract_per_block.block_number,
+        diffs_per_contract_per_block.contract_key,
         diffs_per_contract_per_block.contract,
         case when steps_per_contract_per_block.steps_per_contract is null then 0
         else steps_per_contract_per_block.steps_per_contract end as "STEPS_PER_CONTRACT",
         diffs_per_contract_per_block.diffs_per_contract
     from steps_per_contract_per_block
     right outer join diffs_per_contract_per_block on steps_per_contract_per_block.block_number = diffs_per_contract_per_block.block_number 
-    and regexp_replace(steps_per_contract_per_block.contract,'0x0+','0x') = diffs_per_contract_per_block.contract
+    and steps_per_contract_per_block.contract_key = diffs_per_contract_per_block.contract_key
+    {block_range_filter('diffs_per_contract_per_block.block_number', start_block, end_block, incremental)}
     )
     select
         *
@@ -161,22 +272,21 @@ def join_steps_and_diffs() -> str:
     select
         *
     from temp_left
-    )
-    ;    
-    """
+    """, incremental)
 
-def final() -> str:
+def final(start_block=None, end_block=None, incremental=False) -> str:
     """
     Join the tables
         - steps_per_contract_per_block
         - diffs_per_contract_per_block
         - block_fee
+    In the incremental mode, only the blocks in [start_block, end_block] are appended to the table.
     """
 
-    return f"""
-    create or replace table final as (
+    return materialize('final', f"""
         select
             join_steps_and_diffs.block_number,
+            join_steps_and_diffs.contract_key,
             join_steps_and_diffs.contract,
             join_steps_and_diffs.steps_per_contract,
             sum(join_steps_and_diffs.steps_per_contract) over (partition by join_steps_and_diffs.block_number) as "STEPS_PER_BLOCK",
@@ -186,25 +296,25 @@ def final() -> str:
             block_fee.block_fee
         from join_steps_and_diffs
         inner join block_fee using (block_number)
-    )
-    ;
-    """
+        {block_range_filter('join_steps_and_diffs.block_number', start_block, end_block, incremental)}
+    """, incremental)
 
-def final_proportions(gas_per_step, gas_per_diff) -> str:
+def final_proportions(gas_per_step, gas_per_diff, start_block=None, end_block=None, incremental=False) -> str:
     """
     From the final table, creates a table with four additional columns:
         - 'FEE_PROPORTION_PER_BLOCK_STEPS': proportion (per block) of the total block fee which is due to steps and builtins
         - 'FEE_PROPORTION_PER_BLOCK_DIFFS': proportion (per block) of the total block fee which is due to storage_diffs
         - 'FEE_PROPORTION_PER_CONTRACT_DIFFS': proportion (per contract) of [total block fee due to steps and builtins], which is due to the contract
         - 'FEE_PROPORTION_PER_CONTRACT_STEPS': proportion (per contract) of [total block fee due to storage diffs], which is due to the contract
+    In the incremental mode, only the blocks in [start_block, end_block] are appended to the table.
     """
 
-    return f"""
-    create or replace table final_proportions as (
+    return materialize('final_proportions', f"""
     with temp_query as (
         select
             final.block_fee,
             final.block_number,
+            final.contract_key,
             final.contract,
             final.diffs_per_block,
             final.diffs_per_contract,
@@ -217,6 +327,7 @@ def final_proportions(gas_per_step, gas_per_diff) -> str:
             as "FEE_PROPORTION_PER_BLOCK_DIFFS"
         from final
         inner join builtin_gas_per_block using (block_number)
+        {block_range_filter('final.block_number', start_block, end_block, incremental)}
     )
     select
         *,
@@ -225,33 +336,46 @@ def final_proportions(gas_per_step, gas_per_diff) -> str:
         end "FEE_PROPORTION_PER_CONTRACT_DIFFS",
         (temp_query.fee_proportion_per_block_steps * temp_query.steps_per_contract) / temp_query.steps_per_block as "FEE_PROPORTION_PER_CONTRACT_STEPS"
     from temp_query
-    )
-    ;
-    """
+    """, incremental)
 
 
-def final_fee_divided() -> str:
+def final_fee_divided(start_block=None, end_block=None, incremental=False) -> str:
     """
     Multiplies the proportions computed in the final_proportions table
     with the block fee, thus obtaining the fee in wei per contract.
+    In the incremental mode, the fees of the blocks in [start_block, end_block]
+    are added to the per contract totals of the table.
     """
 
-    return f"""
-    create or replace table final_fee_amounts_divided as (
+    per_contract = f"""
     with temp_query as (
     select
         *,
         final_proportions.fee_proportion_per_contract_diffs * final_proportions.block_fee as "L1_FEE_PER_CONTRACT_PER_BLOCK",
         final_proportions.fee_proportion_per_contract_steps * final_proportions.block_fee as "L2_FEE_PER_CONTRACT_PER_BLOCK"
     from final_proportions
+    {block_range_filter('final_proportions.block_number', start_block, end_block, incremental)}
     )
     select
-        temp_query.contract,
+        temp_query.contract_key,
+        any_value(temp_query.contract) as "CONTRACT",
         sum(temp_query.l1_fee_per_contract_per_block) as "L1_FEE_PER_CONTRACT",
         sum(temp_query.l2_fee_per_contract_per_block) as "L2_FEE_PER_CONTRACT"
     from temp_query
-    group by temp_query.contract
-    )
+    group by temp_query.contract_key
+    """
+    if not incremental:
+        return materialize('final_fee_amounts_divided', per_contract)
+    return f"""
+    merge into final_fee_amounts_divided using (
+    {per_contract}
+    ) as deltas
+    on final_fee_amounts_divided.contract_key = deltas.contract_key
+    when matched then update set
+        l1_fee_per_contract = final_fee_amounts_divided.l1_fee_per_contract + deltas.l1_fee_per_contract,
+        l2_fee_per_contract = final_fee_amounts_divided.l2_fee_per_contract + deltas.l2_fee_per_contract
+    when not matched then insert (contract_key, contract, l1_fee_per_contract, l2_fee_per_contract)
+        values (deltas.contract_key, deltas.contract, deltas.l1_fee_per_contract, deltas.l2_fee_per_contract)
     ;
     """
 
@@ -272,3 +396,129 @@ def ranking_l1_l2() -> str:
     order by fee_per_contract desc
     ;
     """
+
+
+def create_table_like(table_name, template_table) -> str:
+    """
+    Create the table 'table_name', if it does not exist, with the columns of 'template_table'.
+    """
+
+    return f"""
+    create table if not exists {table_name} like {template_table}
+    ;
+    """
+
+
+def delete_block_range(table_name, start_block, end_block) -> str:
+    """
+    Delete the rows of the blocks in [start_block, end_block] from 'table_name'.
+    """
+
+    return f"""
+    delete from {table_name}
+    where block_number >= {start_block}
+    and block_number <= {end_block}
+    ;
+    """
+
+
+def insert_from(table_name, source_table, columns) -> str:
+    """
+    Copy the rows of 'source_table' into 'table_name'.
+    """
+
+    column_list = ', '.join(f'"{column}"' for column in columns)
+    return f"""
+    insert into {table_name} ({column_list})
+    select {column_list} from {source_table}
+    ;
+    """
+
+
+def select_block_range(table_name, columns, start_block, end_block) -> str:
+    """
+    Get the given columns of the rows of 'table_name' in the blocks [start_block, end_block].
+    """
+
+    return f"""
+    select
+        {', '.join(columns)}
+    from {table_name}
+    where block_number >= {start_block}
+    and block_number <= {end_block}
+    ;
+    """
+
+
+def create_load_stage(stage_name) -> str:
+    """
+    Create the temporary stage 'stage_name' for loading Parquet files, if it does not exist.
+    """
+
+    return f"""
+    create temporary stage if not exists {stage_name}
+    file_format = (type = parquet binary_as_text = false)
+    ;
+    """
+
+
+def put_files(pattern, stage_name) -> str:
+    """
+    Upload the local files matching 'pattern' to the stage 'stage_name'.
+    """
+
+    return f"""
+    put 'file://{pattern}' @{stage_name} auto_compress = false overwrite = true parallel = 8
+    ;
+    """
+
+
+def create_table_from_stage(table_name, stage_name) -> str:
+    """
+    Create the table 'table_name', if it does not exist, with the columns of the Parquet files of the stage 'stage_name'.
+    """
+
+    return f"""
+    create table if not exists {table_name} using template (
+        select array_agg(object_construct(*)) within group (order by order_id)
+        from table(infer_schema(location => '@{stage_name}', file_format => '{stage_name}_FORMAT'))
+    )
+    ;
+    """
+
+
+def create_parquet_file_format(stage_name) -> str:
+    """
+    Create the temporary Parquet file format used to infer the columns of the files of the stage 'stage_name'.
+    """
+
+    return f"""
+    create temporary file format if not exists {stage_name}_FORMAT type = parquet binary_as_text = false
+    ;
+    """
+
+
+def copy_from_stage(table_name, stage_name) -> str:
+    """
+    Load all the Parquet files of the stage 'stage_name' into 'table_name', matching the columns by name,
+    and remove the loaded files from the stage.
+    """
+
+    return f"""
+    copy into {table_name} from @{stage_name}
+    match_by_column_name = case_sensitive
+    purge = true
+    on_error = abort_statement
+    ;
+    """
+
+
+def remove_stage_files(stage_name) -> str:
+    """
+    Remove all the files of the stage 'stage_name'.
+    """
+
+    return f"""
+    remove @{stage_name}
+    ;
+    """
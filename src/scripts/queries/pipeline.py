@@ -0,0 +1,47 @@
+import queries.generators
+
+
+DEFAULT_PER_STEP = 0.01 # Gas per Cairo step.
+DEFAULT_PER_DIFF = 1024 # Gas per key-value: 16 gas per byte, i.e. 512 gas per word (32B), multiplied by 2.
+BUILTIN_PRICES = { # Gas per instance of each builtin.
+    'pedersen_builtin': 0.32,
+    'range_check_builtin': 0.16,
+    'bitwise_builtin': 0.64,
+    'poseidon_builtin': 0.32,
+    'ecdsa_builtin': 20.48,
+    'ec_op_builtin': 10.24,
+    'keccak_builtin': 20.48
+}
+INGESTION_TABLES = ('cairo_steps_script', 'storage_diffs_script') # Tables written by the ingestion scripts.
+
+
+def pipeline_queries(start_block, end_block, incremental=False) -> list[str]:
+    """
+    Queries which build all the tables except the 'cairo_steps_script' and 'storage_diffs_script' tables.
+    In the incremental mode, the per block tables are only computed for the blocks in [start_block, end_block]
+    and appended, and the per contract totals are updated with the fees of these blocks.
+    """
+    block_range = {'start_block': start_block, 'end_block': end_block, 'incremental': incremental}
+    return [
+        queries.generators.block_fee(**block_range),
+        queries.generators.builtin_gas(BUILTIN_PRICES, **block_range),
+        queries.generators.diffs_per_contract_per_block(**block_range),
+        queries.generators.steps_per_contract_per_block(**block_range),
+        queries.generators.join_steps_and_diffs(**block_range),
+        queries.generators.final(**block_range),
+        queries.generators.final_proportions(gas_per_step=DEFAULT_PER_STEP, gas_per_diff=DEFAULT_PER_DIFF, **block_range),
+        queries.generators.final_fee_divided(**block_range),
+        queries.generators.ranking_l1_l2()
+    ]
+
+
+def backfill_queries() -> list[str]:
+    """
+    Queries which add the 'contract_key' column to the tables of the ingestion scripts,
+    and fill it for the rows written before the scripts emitted it.
+    """
+    return [
+        query
+        for table_name in INGESTION_TABLES
+        for query in (queries.generators.add_contract_key(table_name), queries.generators.backfill_contract_key(table_name))
+    ]
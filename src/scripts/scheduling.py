@@ -0,0 +1,109 @@
+import time
+
+
+TARGET_ROWS = 500000 # Default number of rows per window in the adaptive mode.
+TARGET_SECONDS = 60.0 # Default time to fetch a window in the adaptive mode.
+MAX_GROWTH = 4.0 # Maximal factor between the sizes of two consecutive windows.
+SMOOTHING = 0.5 # Weight of the last window in the estimates of the rows per block and of the time per row.
+
+
+class AdaptiveWindow:
+    """
+    Chooses the number of blocks of each window of an ingestion so that the windows have about
+    'target_rows' rows and take about 'target_seconds' to fetch, from the rows and the times observed
+    on the previous windows: the early blocks of the chain have a handful of traces, and the recent ones thousands.
+    Each decision is appended to the CSV file 'log_path'.
+    """
+
+    def __init__(self, initial=100, target_rows=TARGET_ROWS, target_seconds=TARGET_SECONDS, min_window=1, max_window=100000,
+                 log_path=None):
+        self.size = initial
+        self.target_rows = target_rows
+        self.target_seconds = target_seconds
+        self.min_window = min_window
+        self.max_window = max_window
+        self.log_path = log_path
+        self.rows_per_block = None # Estimates, updated by observe.
+        self.seconds_per_row = None
+
+    def clamp(self, size: float) -> int:
+        size = min(max(size, self.size / MAX_GROWTH), self.size * MAX_GROWTH)
+        return int(min(max(size, self.min_window), self.max_window))
+
+    def log(self, start_block: int, end_block: int, rows: int, seconds, decision: str) -> None:
+        if self.log_path is None:
+            return
+        with open(self.log_path, 'a') as f:
+            if f.tell() == 0:
+                f.write('time,start_block,end_block,rows,seconds,next_window,decision\n')
+            f.write(f'{time.time():.3f},{start_block},{end_block},{rows},{"" if seconds is None else f"{seconds:.3f}"},{self.size},{decision}\n')
+
+    def observe(self, start_block: int, end_block: int, rows: int, seconds: float) -> None:
+        """
+        Updates the estimates with the rows and the fetch time of the window [start_block, end_block],
+        and chooses the size of the next window.
+        """
+        rows_per_block = rows / (end_block - start_block + 1)
+        seconds_per_row = seconds / rows if rows else None
+        if self.rows_per_block is None:
+            self.rows_per_block = rows_per_block
+        else:
+            self.rows_per_block = SMOOTHING * rows_per_block + (1 - SMOOTHING) * self.rows_per_block
+        if seconds_per_row is not None:
+            if self.seconds_per_row is None:
+                self.seconds_per_row = seconds_per_row
+            else:
+                self.seconds_per_row = SMOOTHING * seconds_per_row + (1 - SMOOTHING) * self.seconds_per_row
+        if self.rows_per_block == 0:
+            # Empty blocks: grow as fast as allowed.
+            size, decision = self.size * MAX_GROWTH, 'empty'
+        else:
+            size, decision = self.target_rows / self.rows_per_block, 'rows'
+            if self.seconds_per_row is not None:
+                latency_size = self.target_seconds / (self.rows_per_block * self.seconds_per_row)
+                if latency_size < size:
+                    size, decision = latency_size, 'latency'
+        self.size = self.clamp(size)
+        self.log(start_block, end_block, rows, seconds, decision)
+
+    def windows(self, start_block: int, end_block: int, probe=None):
+        """
+        Generator over consecutive windows covering [start_block, end_block], whose sizes are chosen
+        when they are requested, so after the observations of the previous windows.
+        If a 'probe' function is given, probe(start, end) returns the number of rows of a window
+        before it is fetched (e.g. with a cheap count query), and a window with too many rows is shrunk.
+        """
+        start = start_block
+        while start <= end_block:
+            end = min(end_block, start + self.size - 1)
+            if probe is not None:
+                rows = probe(start, end)
+                # A window with too many rows is shrunk in proportion, and probed again.
+                while rows > 2 * self.target_rows and end > start:
+                    self.size = max(self.min_window, (end - start + 1) * self.target_rows // rows)
+                    self.log(start, end, rows, None, 'probe')
+                    end = min(end_block, start + self.size - 1)
+                    rows = probe(start, end)
+            yield start, end
+            start = end + 1
+
+
+def add_adaptive_arguments(parser) -> None:
+    """
+    Adds the options of the adaptive window sizing to the parser of an ingestion script.
+    """
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Adapt the number of blocks per window to the rows and the latency of the previous windows.')
+    parser.add_argument('--target-rows', type=int, default=TARGET_ROWS, help='Rows per window in the --adaptive mode.')
+    parser.add_argument('--target-seconds', type=float, default=TARGET_SECONDS,
+                        help='Seconds to fetch a window in the --adaptive mode.')
+    parser.add_argument('--window-log', default=None, help='CSV file where the window decisions are appended, in the --adaptive mode.')
+
+
+def scheduler_from_args(args, initial: int) -> AdaptiveWindow | None:
+    """
+    The window scheduler given by the options of add_adaptive_arguments, or None if the windows have a fixed size.
+    """
+    if not args.adaptive:
+        return None
+    return AdaptiveWindow(initial, target_rows=args.target_rows, target_seconds=args.target_seconds, log_path=args.window_log)
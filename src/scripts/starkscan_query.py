@@ -1,27 +1,178 @@
-import requests
-import pandas as pd
-import json
+import argparse
+import asyncio
 import os
+import random
+import sqlite3
+import threading
+import time
+from email.utils import parsedate_to_datetime
+import aiohttp
+import pandas as pd
+from addresses import felt_hex
 
 
 STARKSCAN_URL = 'https://api.starkscan.co/api/v0/contract/'
 CSV_FOLDER = '../csv'
+CACHE_PATH = './starkscan_cache.sqlite' # Default location of the cache of resolved tags.
+CACHE_TTL = 30 * 24 * 3600 # Seconds after which a cached tag is resolved again.
+RETRY_STATUSES = (429, 500, 502, 503, 504) # Responses after which a request is retried.
+ERROR = 'ERROR' # Tag of the addresses which could not be resolved.
 
 
-if __name__ == '__main__':
+class TagCache:
+    """
+    Durable local record (an SQLite file) of the tags resolved on Starkscan, with the time of resolution.
+    A tag is fresh for 'ttl' seconds; the addresses without a tag are cached with a null tag.
+    """
+
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("""
+                create table if not exists tags (
+                    address text primary key,
+                    tag text,
+                    resolved_at real not null
+                )
+                """)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def fresh(self, addresses) -> dict:
+        """
+        The fresh cached tags of the given canonical addresses.
+        """
+        oldest = time.time() - self.ttl
+        with self.lock:
+            rows = self.connection.execute(
+                'select address, tag from tags where resolved_at >= ?', (oldest,)).fetchall()
+        addresses = set(addresses)
+        return {address: tag for address, tag in rows if address in addresses}
+
+    def store(self, address: str, tag) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                'insert or replace into tags values (?, ?, ?)', (address, tag, time.time()))
+
+
+def retry_after(response) -> float | None:
+    """
+    The delay requested by the Retry-After header of a response, given in seconds or as a date, if any.
+    """
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class StarkscanResolver:
+    """
+    Resolves the name tags of addresses on the Starkscan API through a pooled HTTP session,
+    with a bounded number of requests in flight. Rate limited and failed requests are retried
+    after the delay of their Retry-After header, or else with exponential backoff and full jitter.
+    The resolved tags are cached, so that only the new or stale addresses are requested.
+    """
+
+    def __init__(self, api_key, cache=None, url=STARKSCAN_URL, concurrency=8, max_retries=5, base_delay=0.5, max_delay=30.0):
+        self.api_key = api_key
+        self.cache = cache
+        self.url = url
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.requests = 0 # Total number of requests, for reporting.
+        self.retries = 0 # Total number of retried requests, for reporting.
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Delay before retry number 'attempt' (starting at 0), without a Retry-After header.
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def fetch_tag(self, session, semaphore, address: str) -> tuple:
+        """
+        Returns the tag of the canonical 'address' (None if it has none, ERROR if the API does not know it
+        or rejects the request), and whether it is an answer of the API, which can be cached.
+        If all the attempts fail, returns ERROR and False.
+        """
+        for attempt in range(self.max_retries + 1):
+            delay = None
+            try:
+                async with semaphore:
+                    self.requests += 1
+                    async with session.get(self.url + felt_hex(address, padded=True)) as response:
+                        if response.status == 200:
+                            return (await response.json())['name_tag'], True
+                        if response.status not in RETRY_STATUSES:
+                            return ERROR, True
+                        delay = retry_after(response)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            if attempt == self.max_retries:
+                return ERROR, False
+            self.retries += 1
+            # Sleep outside of the semaphore so that other addresses can use the slot. The delay of the
+            # Retry-After header is capped, so that a single response cannot stall the run.
+            await asyncio.sleep(self.backoff(attempt) if delay is None else min(delay, self.max_delay))
+
+    async def resolve(self, addresses) -> dict:
+        """
+        The tags of the given addresses, keyed by canonical address (see addresses.felt_hex).
+        """
+        addresses = list(dict.fromkeys(felt_hex(address) for address in addresses))
+        tags = self.cache.fresh(addresses) if self.cache is not None else {}
+        missing = [address for address in addresses if address not in tags]
+        if not missing:
+            return tags
+        semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(connector=connector, headers={'x-api-key': self.api_key}) as session:
+
+            async def resolve_one(address):
+                tag, answered = await self.fetch_tag(session, semaphore, address)
+                # The failed requests are not cached, so that they are requested again on the next run.
+                if answered and self.cache is not None:
+                    self.cache.store(address, tag)
+                tags[address] = tag
+
+            await asyncio.gather(*(resolve_one(address) for address in missing))
+        return tags
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--limit', type=int, default=1000, help='Number of contracts of top_contracts.csv to tag.')
+    parser.add_argument('--concurrency', type=int, default=8, help='Maximum number of requests in flight.')
+    parser.add_argument('--max-retries', type=int, default=5, help='Retries per address on rate limits, server errors and timeouts.')
+    parser.add_argument('--cache', default=CACHE_PATH, help='Path of the cache of resolved tags.')
+    parser.add_argument('--ttl-days', type=float, default=CACHE_TTL / (24 * 3600), help='Days after which a cached tag is resolved again.')
+    args = parser.parse_args()
     api_key = os.environ['API_KEY']
     df = pd.read_csv(CSV_FOLDER + '/top_contracts.csv')
-    df = df['CONTRACT']
-    name_tags = []
-    # Search for the names of the top 1000 contracts.
-    for contract in df.iloc[:1000]:
-        contract = '0x' + '0'*(66-len(contract)) + contract[2:]
-        request = requests.get(STARKSCAN_URL + str(contract), headers={'x-api-key': api_key})
-        if request.status_code == 200:
-            name_tags.append(json.loads(request.content)['name_tag'])
-        else:
-            name_tags.append('ERROR')
+    df = df['CONTRACT'].iloc[:args.limit]
+
+    cache = TagCache(args.cache, ttl=args.ttl_days * 24 * 3600)
+    resolver = StarkscanResolver(api_key, cache=cache, concurrency=args.concurrency, max_retries=args.max_retries)
+    tags = await resolver.resolve(df)
+    cache.close()
+    print(f'{resolver.requests} requests, {resolver.retries} retries, '
+          f'{sum(tag == ERROR for tag in tags.values())} addresses not resolved')
 
     df = pd.DataFrame(data=df)
-    df['NAMES'] = pd.Series(data=name_tags)
-    df.to_csv(CSV_FOLDER + '/names.csv')
\ No newline at end of file
+    df['NAMES'] = pd.Series([tags[felt_hex(contract)] for contract in df['CONTRACT']], index=df.index, dtype=object)
+    df.to_csv(CSV_FOLDER + '/names.csv')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import os
+from collections import deque
+from contextlib import aclosing
+import numpy as np
+import pandas as pd
+from starknet_py.net.full_node_client import FullNodeClient
+from addresses import felt_hex
+from batch import BatchBuilder
+from checkpoint import COMMITTED, Manifest, merge_ranges, split_batches, subtract_ranges
+from fetcher import RETRYABLE_ERRORS, StateUpdateFetcher
+from utils import BLAST_API_URL
+
+
+CACHE_FOLDER_PATH = '../data/state_updates' # Default location of the cache of state updates.
+CHUNK_SIZE = 10000 # Number of blocks per Parquet file.
+CACHE_TABLE = 'STATE_UPDATES' # Name of the cached ranges in the metadata of the cache.
+STATE_DIFF_COLUMNS = {
+    'BLOCK_NUMBER': 'int64',
+    'CONTRACT': 'object',
+    'UPDATES_PER_BLOCK': 'int64'
+}
+
+
+class StateCache:
+    """
+    Local cache of the projection (block, contract, number of storage entries) of the state updates.
+    The rows are stored in compressed Parquet files of CHUNK_SIZE blocks, and the block ranges which
+    were fetched (including the blocks without storage diffs) are recorded in a manifest in the same folder.
+    The stored rows are buffered per chunk, and each chunk is written once all its blocks are cached,
+    or when the cache is flushed or closed; the ranges are recorded in the manifest once they are written.
+    The blocks of the cache are final, so they never need to be fetched again.
+    """
+
+    def __init__(self, folder=CACHE_FOLDER_PATH, chunk_size=CHUNK_SIZE):
+        self.folder = folder
+        self.chunk_size = chunk_size
+        os.makedirs(folder, exist_ok=True)
+        self.manifest = Manifest(os.path.join(folder, 'cache.sqlite'))
+        self.pending = {} # Block ranges and rows stored since each chunk was last written, by chunk.
+        self.loaded = None # Last chunk read by load, and its rows.
+
+    def close(self) -> None:
+        self.flush()
+        self.manifest.close()
+
+    def chunk_path(self, chunk: int) -> str:
+        return os.path.join(self.folder, f'blocks_{chunk * self.chunk_size}_{(chunk + 1) * self.chunk_size - 1}.parquet')
+
+    def chunk_range(self, chunk: int) -> tuple[int, int]:
+        return chunk * self.chunk_size, (chunk + 1) * self.chunk_size - 1
+
+    def chunks(self, start_block: int, end_block: int) -> range:
+        return range(start_block // self.chunk_size, end_block // self.chunk_size + 1)
+
+    def cached_ranges(self) -> list[tuple[int, int]]:
+        return self.manifest.ranges(CACHE_TABLE, COMMITTED)
+
+    def missing_ranges(self, start_block: int, end_block: int) -> list[tuple[int, int]]:
+        """
+        Ranges of blocks in [start_block, end_block] which are not in the cache, neither written nor buffered.
+        """
+        pending = [block_range for ranges, _ in self.pending.values() for block_range in ranges]
+        return subtract_ranges(self.manifest.missing_ranges(CACHE_TABLE, start_block, end_block), pending)
+
+    def read_chunk(self, chunk: int, start_block: int, end_block: int) -> pd.DataFrame:
+        path = self.chunk_path(chunk)
+        if not os.path.exists(path):
+            return BatchBuilder(STATE_DIFF_COLUMNS).to_data_frame()
+        return pd.read_parquet(path, filters=[('BLOCK_NUMBER', '>=', start_block), ('BLOCK_NUMBER', '<=', end_block)])
+
+    def store(self, df: pd.DataFrame, start_block: int, end_block: int) -> None:
+        """
+        Stores the rows of the blocks in [start_block, end_block], which must contain all the rows of these blocks,
+        replacing the rows of these blocks which were already cached. The rows are written with their chunk
+        (see write_chunk), once all the blocks of the chunk are cached.
+        """
+        df = df[(df['BLOCK_NUMBER'] >= start_block) & (df['BLOCK_NUMBER'] <= end_block)]
+        for chunk in self.chunks(start_block, end_block):
+            chunk_start, chunk_end = self.chunk_range(chunk)
+            ranges, frames = self.pending.setdefault(chunk, ([], []))
+            ranges.append((max(start_block, chunk_start), min(end_block, chunk_end)))
+            frames.append(df[(df['BLOCK_NUMBER'] >= chunk_start) & (df['BLOCK_NUMBER'] <= chunk_end)])
+            if not self.missing_ranges(chunk_start, chunk_end):
+                self.write_chunk(chunk)
+
+    def write_chunk(self, chunk: int) -> None:
+        """
+        Writes the buffered rows of the chunk with the rows of the other blocks of its file, in a single write,
+        and records their ranges in the manifest.
+        """
+        ranges, frames = self.pending.pop(chunk)
+        chunk_start, chunk_end = self.chunk_range(chunk)
+        # Each block keeps the rows of the last range which stored it, or its cached rows if none did.
+        owner = np.full(self.chunk_size, -1)
+        for i, (start, end) in enumerate(ranges):
+            owner[start - chunk_start:end - chunk_start + 1] = i
+        kept = self.read_chunk(chunk, chunk_start, chunk_end)
+        kept = [kept[owner[kept['BLOCK_NUMBER'].to_numpy() - chunk_start] == -1]]
+        kept += [df[owner[df['BLOCK_NUMBER'].to_numpy() - chunk_start] == i] for i, df in enumerate(frames)]
+        rows = pd.concat(kept, ignore_index=True).sort_values('BLOCK_NUMBER', kind='stable')
+        # The chunk is replaced atomically, so that an interrupted write never loses cached rows.
+        path = self.chunk_path(chunk)
+        rows.to_parquet(path + '.tmp', index=False, compression='zstd')
+        os.replace(path + '.tmp', path)
+        if self.loaded is not None and self.loaded[0] == chunk:
+            self.loaded = None
+        for start, end in merge_ranges(ranges):
+            self.manifest.record(CACHE_TABLE, start, end, COMMITTED)
+
+    def flush(self) -> None:
+        """
+        Writes the chunks whose rows are buffered.
+        """
+        for chunk in sorted(self.pending):
+            self.write_chunk(chunk)
+
+    def load(self, start_block: int, end_block: int) -> pd.DataFrame:
+        """
+        The cached rows of the blocks in [start_block, end_block], ordered by block.
+        The last chunk read is kept in memory, so the consecutive batches of a chunk read its file once.
+        """
+        frames = []
+        for chunk in self.chunks(start_block, end_block):
+            if chunk in self.pending:
+                self.write_chunk(chunk)
+            if not os.path.exists(self.chunk_path(chunk)):
+                continue
+            if self.loaded is None or self.loaded[0] != chunk:
+                self.loaded = chunk, self.read_chunk(chunk, *self.chunk_range(chunk))
+            rows = self.loaded[1]
+            frames.append(rows[(rows['BLOCK_NUMBER'] >= start_block) & (rows['BLOCK_NUMBER'] <= end_block)])
+        if not frames:
+            return BatchBuilder(STATE_DIFF_COLUMNS).to_data_frame()
+        return pd.concat(frames, ignore_index=True).astype(STATE_DIFF_COLUMNS)
+
+    def stats(self) -> dict:
+        """
+        Number of files, bytes, rows and blocks of the cache, and its cached ranges.
+        """
+        paths = [os.path.join(self.folder, name) for name in os.listdir(self.folder) if name.endswith('.parquet')]
+        ranges = self.cached_ranges()
+        return {
+            'files': len(paths),
+            'bytes': sum(os.path.getsize(path) for path in paths),
+            'rows': sum(len(pd.read_parquet(path, columns=['BLOCK_NUMBER'])) for path in paths),
+            'blocks': sum(end - start + 1 for start, end in ranges),
+            'ranges': ranges
+        }
+
+
+def project(batch: BatchBuilder, results) -> list[tuple[int, int]]:
+    """
+    Appends the (block, contract, number of storage entries) rows of the state updates 'results',
+    pairs (block, state update or exception), to 'batch'. Returns the ranges of the blocks whose
+    retries were exhausted.
+    """
+    failures = []
+    for block, call_result in results:
+        # Handle timeout failure and client error, once the retries are exhausted.
+        if isinstance(call_result, RETRYABLE_ERRORS):
+            failures.append((block, block))
+            continue
+        if isinstance(call_result, BaseException):
+            raise call_result
+        for item in call_result.state_diff.storage_diffs:
+            # Check that the storage diffs entries are non-empty;
+            # (some are empty due to a contract nonce update without storage updates).
+            if len(item.storage_entries):
+                batch.append(block, felt_hex(item.address), len(item.storage_entries))
+    return failures
+
+
+async def state_diff_batches(fetcher, cache, start_block: int, end_block: int, batch_size: int, scheduler=None):
+    """
+    Asynchronous generator over the blocks in [start_block, end_block], in batches of at most 'batch_size' blocks,
+    or in the windows of 'scheduler' (a scheduling.AdaptiveWindow) if it is given, ordered by block.
+    Each item is a tuple (start, end, dataframe of the rows of STATE_DIFF_COLUMNS, failed ranges).
+    The cached blocks are read from 'cache', and the other blocks are fetched and added to 'cache'
+    (if 'cache' is None, all the blocks are fetched). All the fetched batches go through a single stream
+    of fetcher.fetch_windows, so the requests of the next batches are in flight while a batch is consumed;
+    the scheduler is asked for a window when its requests are sent, so after the observations of the consumed batches.
+    """
+    batch = BatchBuilder(STATE_DIFF_COLUMNS)
+    missing = [(start_block, end_block)] if cache is None else cache.missing_ranges(start_block, end_block)
+    cached = subtract_ranges([(start_block, end_block)], missing)
+    order = deque() # Batches (start, end, cached) read by the fetcher stream, and not yielded yet.
+
+    def fetched_windows():
+        if scheduler is None:
+            windows = split_batches(sorted(missing + cached), batch_size)
+        else:
+            windows = scheduler.windows(start_block, end_block)
+        for window_start, window_end in windows:
+            window_missing = subtract_ranges([(window_start, window_end)], cached)
+            window_cached = subtract_ranges([(window_start, window_end)], missing)
+            for start, end in sorted(window_missing + window_cached):
+                order.append((start, end, (start, end) in window_cached))
+                if (start, end) in window_missing:
+                    yield start, end
+
+    def cached_batches():
+        while order and order[0][2]:
+            start, end, _ = order.popleft()
+            yield start, end, cache.load(start, end), []
+
+    # The fetches are closed with this generator, so that no request stays in flight after it.
+    async with aclosing(fetcher.fetch_windows(fetched_windows())) as batches:
+        async for start, end, results in batches:
+            for cached_batch in cached_batches():
+                yield cached_batch
+            order.popleft()
+            failures = project(batch, results)
+            df = batch.flush()
+            if cache is not None:
+                for fetched_start, fetched_end in subtract_ranges([(start, end)], failures):
+                    cache.store(df, fetched_start, fetched_end)
+            yield start, end, df, failures
+    # The cached blocks after the last fetched batch.
+    for cached_batch in cached_batches():
+        yield cached_batch
+
+
+async def warm(args) -> None:
+    fetcher = StateUpdateFetcher(
+        FullNodeClient(node_url=BLAST_API_URL),
+        concurrency=args.concurrency,
+        max_retries=args.max_retries,
+        requests_per_second=args.requests_per_second
+        )
+    cache = StateCache(args.cache)
+    failed_blocks = []
+    try:
+        async for _, _, _, failures in state_diff_batches(fetcher, cache, args.start_block, args.end_block, args.batch_size):
+            failed_blocks.extend(start for start, _ in failures)
+    finally:
+        cache.close()
+    if failed_blocks:
+        print(f'{len(failed_blocks)} blocks could not be fetched: {",".join(map(str, failed_blocks))}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cache', default=CACHE_FOLDER_PATH, help='Folder of the cache.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    warm_parser = commands.add_parser('warm', help='Fetch the state updates of the blocks which are not cached yet.')
+    warm_parser.add_argument('start_block', type=int)
+    warm_parser.add_argument('end_block', type=int)
+    warm_parser.add_argument('--batch-size', type=int, default=1000, help='Number of blocks written to the cache at once.')
+    warm_parser.add_argument('--concurrency', type=int, default=16, help='Maximum number of RPC requests in flight.')
+    warm_parser.add_argument('--max-retries', type=int, default=5, help='Retries per block on timeouts and client errors.')
+    warm_parser.add_argument('--requests-per-second', type=float, default=None, help='Cap on the RPC request rate.')
+    commands.add_parser('stats', help='Print the size and the cached ranges of the cache.')
+    args = parser.parse_args()
+
+    if args.command == 'warm':
+        asyncio.run(warm(args))
+    else:
+        cache = StateCache(args.cache)
+        stats = cache.stats()
+        cache.close()
+        print(f"{stats['files']} files, {stats['bytes'] / 2**20:.1f} MiB, {stats['rows']} rows, {stats['blocks']} blocks")
+        print('cached ranges: ' + ', '.join(f'[{start}:{end}]' for start, end in stats['ranges']))
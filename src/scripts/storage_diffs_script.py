@@ -1,47 +1,120 @@
 import asyncio
-import pandas as pd
-from snowflake.connector.pandas_tools import write_pandas
-from starknet_py.net.full_node_client import FullNodeClient, ClientError
-from starknet_py.utils.typed_data import get_hex
-from utils import get_connection, parser, BLAST_API_URL
+import time
+from starknet_py.net.full_node_client import FullNodeClient
+from addresses import felt_key_column
+from checkpoint import COMMITTED, FAILED, Manifest, ranges_to_process, subtract_ranges
+from fetcher import StateUpdateFetcher
+from loader import BulkLoader, loader_options
+from metrics import frame_bytes, metrics_from_args, profiled
+from scheduling import add_adaptive_arguments, scheduler_from_args
+from state_cache import CACHE_FOLDER_PATH, StateCache, state_diff_batches
+from utils import get_connection, ingestion_parser, BLAST_API_URL
+from writers import APPEND, add_contract_key, write_range
 
 
 INCREMENT = 100 # Size of block batches which are processed in the main loop.
+TABLE_NAME = 'STORAGE_DIFFS_SCRIPT'
+
+
+def write_parts(start: int, end: int, batch_failures, write_mode=APPEND) -> list[tuple[int, int, list]]:
+    """
+    Block ranges (start, end, failed ranges) in which the batch of the blocks in [start, end] is written.
+    In the REPLACE mode, the blocks which failed to be fetched are left out of the ranges, so that their rows
+    are not deleted (see writers.write_range); otherwise the batch is written at once.
+    """
+    if write_mode == APPEND or not batch_failures:
+        return [(start, end, batch_failures)]
+    return [(part_start, part_end, []) for part_start, part_end in subtract_ranges([(start, end)], batch_failures)]
 
 
 async def main():
-    args = parser().parse_args()
+    arg_parser = ingestion_parser()
+    arg_parser.add_argument('--concurrency', type=int, default=16, help='Maximum number of RPC requests in flight.')
+    arg_parser.add_argument('--max-retries', type=int, default=5, help='Retries per block on timeouts and client errors.')
+    arg_parser.add_argument('--requests-per-second', type=float, default=None, help='Cap on the RPC request rate.')
+    arg_parser.add_argument('--cache', nargs='?', const=CACHE_FOLDER_PATH, default=None,
+                            help='Read the cached blocks from, and add the fetched blocks to, the state update cache in this folder.')
+    add_adaptive_arguments(arg_parser)
+    args = arg_parser.parse_args()
     start_block, end_block = args.start_block, args.end_block
     cnx = get_connection()
+    add_contract_key(cnx, TABLE_NAME)
 
     full_node_client = FullNodeClient(node_url=BLAST_API_URL)
+    fetcher = StateUpdateFetcher(
+        full_node_client,
+        concurrency=args.concurrency,
+        max_retries=args.max_retries,
+        requests_per_second=args.requests_per_second
+        )
+    manifest = Manifest(args.manifest)
+    cache = StateCache(args.cache) if args.cache else None
+    scheduler = scheduler_from_args(args, initial=INCREMENT)
+    metrics = metrics_from_args(args, 'storage_diffs_script')
+    bulk_load = loader_options(args)
+    loader = None if bulk_load is None else BulkLoader(cnx, TABLE_NAME, mode=args.write_mode, metrics=metrics, **bulk_load)
+    pending_failures = {} # Blocks which failed to be fetched, per batch buffered by the loader.
     failed_blocks = []
-    for start in range(start_block, end_block + 1, INCREMENT):
-        # Empty dataframe.
-        df = pd.DataFrame(columns = ['BLOCK_NUMBER', 'CONTRACT', 'UPDATES_PER_BLOCK'])
-        end = min(end_block + 1, start + INCREMENT)
-        for block in range(start, end):
-            try:
-                call_result = await full_node_client.get_state_update(block_number=block)
-                diffs = call_result.state_diff.storage_diffs
-                for item in diffs:
-                    # Check that the storage diffs entries are non-empty;
-                    # (some are empty due to a contract nonce update without storage updates).
-                    if len(item.storage_entries):
-                        new_entry = {
-                            'BLOCK_NUMBER': block, 
-                            'CONTRACT': get_hex(item.address), 
-                            'UPDATES_PER_BLOCK': len(item.storage_entries)
-                        }
-                        df = pd.concat([df, pd.DataFrame([new_entry])], ignore_index=True)
-            # Handle timeout failure and client error.
-            except (asyncio.TimeoutError, ClientError):
-                failed_blocks.append(f'{block}')
-                continue
-        success, _, _, _ = write_pandas(cnx, df, 'STORAGE_DIFFS_SCRIPT', auto_create_table=True)
+
+    def record(start, end, success, batch_failures):
         # Handle failure due to writing to snowflake server.
         if not success:
             failed_blocks.append(f'[{start}:{end}]')
+            manifest.record(TABLE_NAME, start, end, FAILED)
+            return
+        for committed_start, committed_end in subtract_ranges([(start, end)], batch_failures):
+            manifest.record(TABLE_NAME, committed_start, committed_end, COMMITTED)
+        for block, _ in batch_failures:
+            manifest.record(TABLE_NAME, block, block, FAILED)
+
+    def record_loads(results):
+        for start, end, success in results:
+            record(start, end, success, pending_failures.pop((start, end)))
+
+    try:
+        with profiled(args.profile, f'./storage_script_profile_{start_block}_{end_block}'), \
+                metrics.stage('run', start_block, end_block) as run:
+            try:
+                for range_start, range_end in ranges_to_process(args, TABLE_NAME, manifest):
+                    fetch_start, retries = time.perf_counter(), fetcher.retries
+                    # The batches are yielded in block order, read from the cache or fetched with the requests
+                    # of the next batches already in flight (in the adaptive mode, the next windows of the scheduler).
+                    batches = state_diff_batches(fetcher, cache, range_start, range_end, INCREMENT, scheduler)
+                    async for start, end, df, batch_failures in batches:
+                        seconds = time.perf_counter() - fetch_start
+                        if scheduler is not None:
+                            scheduler.observe(start, end, len(df), seconds)
+                        metrics.emit('fetch', start_block=start, end_block=end, rows=len(df), bytes=frame_bytes(df), seconds=seconds,
+                                     failed=len(batch_failures), retries=fetcher.retries - retries)
+                        failed_blocks.extend(f'{block}' for block, _ in batch_failures)
+                        df.insert(2, 'CONTRACT_KEY', felt_key_column(df['CONTRACT']))
+                        parts = write_parts(start, end, batch_failures, args.write_mode)
+                        if not any(part_failures for _, _, part_failures in parts):
+                            # The failed blocks left out of the written ranges are recorded at once.
+                            for block, _ in batch_failures:
+                                manifest.record(TABLE_NAME, block, block, FAILED)
+                        with metrics.stage('write', start, end, rows=len(df), bytes=frame_bytes(df), bulk_load=loader is not None) as fields:
+                            successes = []
+                            for part_start, part_end, part_failures in parts:
+                                rows = df if (part_start, part_end) == (start, end) else df[df['BLOCK_NUMBER'].between(part_start, part_end)]
+                                if loader is None:
+                                    successes.append(write_range(cnx, rows, TABLE_NAME, part_start, part_end, mode=args.write_mode))
+                                    record(part_start, part_end, successes[-1], part_failures)
+                                else:
+                                    pending_failures[(part_start, part_end)] = part_failures
+                                    record_loads(loader.add(rows, part_start, part_end))
+                            if loader is None:
+                                fields['success'] = all(successes)
+                        fetch_start, retries = time.perf_counter(), fetcher.retries
+            finally:
+                # The buffered batches are loaded even if the run stops on an error.
+                if loader is not None:
+                    record_loads(loader.close())
+                run.update(failed=len(failed_blocks), retries=fetcher.retries)
+    finally:
+        # The rows buffered by the cache for its incomplete chunks are written, so they are not fetched again.
+        if cache is not None:
+            cache.close()
     if failed_blocks:
         with open(f'./storage_script_failed_blocks_{start_block}_{end_block}', 'w') as f:
             f.write(','.join(failed_blocks))
@@ -0,0 +1,130 @@
+import argparse
+import itertools
+import os
+import numpy as np
+import pandas as pd
+from attribution import DATA_FOLDER_PATH, divide, final, join_blocks, load_inputs
+
+
+SCENARIO_COLUMNS = ['GAS_PER_STEP', 'GAS_PER_DIFF', 'BUILTIN_SCALE']
+CHUNK_ROWS = 1000000 # Rows of the 'final' table aggregated at once, for all the scenarios.
+TOP = 100 # Contracts compared: the ones in the top TOP of at least one scenario.
+
+
+def scenario_grid(gas_per_step, gas_per_diff, builtin_scale) -> pd.DataFrame:
+    """
+    All the combinations of the given gas per step, gas per diff and factors of the builtin prices,
+    one scenario per row (the first one being the combination of the first values).
+    """
+    return pd.DataFrame(list(itertools.product(gas_per_step, gas_per_diff, builtin_scale)), columns=SCENARIO_COLUMNS)
+
+
+def block_proportions(builtin_gas: np.ndarray, steps: np.ndarray, diffs: np.ndarray, scenarios: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Proportions of the block fee due to steps (and builtins) and to diffs, per scenario and per block,
+    as two (scenarios, blocks) arrays, from the builtin gas, the steps and the diffs (plus contracts) per block.
+    """
+    steps_gas = np.outer(scenarios['BUILTIN_SCALE'], builtin_gas) + np.outer(scenarios['GAS_PER_STEP'], steps)
+    diffs_gas = np.outer(scenarios['GAS_PER_DIFF'], diffs)
+    total = steps_gas + diffs_gas
+    nonzero = total != 0
+    return (np.divide(steps_gas, total, out=np.zeros(total.shape), where=nonzero),
+            np.divide(diffs_gas, total, out=np.zeros(total.shape), where=nonzero))
+
+
+def sweep(inputs: dict[str, pd.DataFrame], scenarios: pd.DataFrame, chunk_rows=CHUNK_ROWS) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Runs the attribution of each scenario on the per block inputs (see attribution.load_inputs), in a single
+    pass over the 'final' table: only the proportions per block depend on the weights, so the rows are
+    reduced to their scenario independent weights once, and summed per contract for all the scenarios at once.
+    Returns the contracts, and the L1 and L2 fees in wei as (scenarios, contracts) arrays, which match
+    attribution.attribute for each scenario (with the builtin gas multiplied by its BUILTIN_SCALE).
+    """
+    final_df = final(inputs['steps'], inputs['diffs'], inputs['block_fee'])
+    has_builtin_gas, builtin = join_blocks(final_df['BLOCK_NUMBER'].to_numpy(np.int64), inputs['builtin_gas'], 'BUILTIN_GAS')
+    df = final_df[has_builtin_gas]
+    fee = df['BLOCK_FEE'].to_numpy()
+    steps_per_block = df['STEPS_PER_BLOCK'].to_numpy()
+    diff_units = df['DIFFS_PER_BLOCK'].to_numpy() + df['CONTRACTS_PER_BLOCK'].to_numpy()
+    diffs_per_contract = df['DIFFS_PER_CONTRACT'].to_numpy()
+    # Share of the fee of the row's block due to diffs (resp. steps) which goes to the row's contract.
+    diffs_weight = np.where(diffs_per_contract == 0, 0, divide(fee * (diffs_per_contract + 1), diff_units))
+    steps_weight = divide(fee * df['STEPS_PER_CONTRACT'].to_numpy(), steps_per_block)
+    _, first_rows, block_index = np.unique(df['BLOCK_NUMBER'].to_numpy(), return_index=True, return_inverse=True)
+    steps_proportion, diffs_proportion = block_proportions(
+        builtin[first_rows], steps_per_block[first_rows], diff_units[first_rows], scenarios
+    )
+    codes = df['CONTRACT'].cat.codes.to_numpy()
+    names = np.asarray(df['CONTRACT'].cat.categories)
+    l1 = np.zeros((len(scenarios), len(names)))
+    l2 = np.zeros((len(scenarios), len(names)))
+    # The rows are sorted by contract, so that the rows of a contract are summed with a single reduceat.
+    order = np.argsort(codes, kind='stable')
+    for chunk_start in range(0, len(order), chunk_rows):
+        rows = order[chunk_start:chunk_start + chunk_rows]
+        chunk_codes = codes[rows]
+        starts = np.flatnonzero(np.r_[True, chunk_codes[1:] != chunk_codes[:-1]])
+        blocks = block_index[rows]
+        l1[:, chunk_codes[starts]] += np.add.reduceat(diffs_proportion[:, blocks] * diffs_weight[rows], starts, axis=1)
+        l2[:, chunk_codes[starts]] += np.add.reduceat(steps_proportion[:, blocks] * steps_weight[rows], starts, axis=1)
+    present = np.bincount(codes, minlength=len(names)) > 0
+    return names[present], l1[:, present], l2[:, present]
+
+
+def ranks(amounts: np.ndarray) -> np.ndarray:
+    """
+    Rank (from 1) of each contract in each scenario, by decreasing amount, as in attribution.ranking_l1_l2.
+    """
+    order = np.argsort(-amounts, axis=1, kind='stable')
+    result = np.empty(amounts.shape, dtype=np.int64)
+    np.put_along_axis(result, order, np.broadcast_to(np.arange(1, amounts.shape[1] + 1), amounts.shape), axis=1)
+    return result
+
+
+def compare(contracts: np.ndarray, l1: np.ndarray, l2: np.ndarray, scenarios: pd.DataFrame, baseline=0, top=TOP) -> pd.DataFrame:
+    """
+    Comparison of the rank and the amount (in ETH) of the contracts between each scenario and the 'baseline' scenario,
+    with one row per scenario and contract, for the contracts in the 'top' first of at least one scenario.
+    RANK_CHANGE is positive when the contract is ranked higher than in the baseline.
+    """
+    amounts = (l1 + l2) / 10**18
+    contract_ranks = ranks(amounts)
+    kept = np.flatnonzero((contract_ranks <= top).any(axis=0))
+    n_scenarios, n_kept = len(scenarios), len(kept)
+    amounts, contract_ranks = amounts[:, kept], contract_ranks[:, kept]
+    df = scenarios.iloc[np.repeat(np.arange(n_scenarios), n_kept)].reset_index(names='SCENARIO')
+    df['CONTRACT'] = np.tile(contracts[kept], n_scenarios)
+    df['L1_FEE_PER_CONTRACT_ETH'] = (l1[:, kept] / 10**18).ravel()
+    df['L2_FEE_PER_CONTRACT_ETH'] = (l2[:, kept] / 10**18).ravel()
+    df['FEE_PER_CONTRACT'] = amounts.ravel()
+    df['RANK'] = contract_ranks.ravel()
+    df['BASELINE_RANK'] = np.tile(contract_ranks[baseline], n_scenarios)
+    df['RANK_CHANGE'] = df['BASELINE_RANK'] - df['RANK']
+    df['FEE_CHANGE'] = df['FEE_PER_CONTRACT'] - np.tile(amounts[baseline], n_scenarios)
+    return df.sort_values(['SCENARIO', 'RANK'], kind='stable').reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    from final_tables_script import CSV_FOLDER_PATH
+    from queries.pipeline import DEFAULT_PER_DIFF, DEFAULT_PER_STEP
+    from tags import NAMED_CONTRACTS_CSV_PATH, TagIndex
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-folder', default=DATA_FOLDER_PATH, help='Folder of the Parquet inputs (see attribution.py export).')
+    parser.add_argument('--gas-per-step', type=float, nargs='+', default=[DEFAULT_PER_STEP])
+    parser.add_argument('--gas-per-diff', type=float, nargs='+', default=[DEFAULT_PER_DIFF])
+    parser.add_argument('--builtin-scale', type=float, nargs='+', default=[1.0], help='Factors of the builtin prices.')
+    parser.add_argument('--baseline', type=int, default=0, help='Index of the scenario the others are compared to.')
+    parser.add_argument('--top', type=int, default=TOP, help='Compare the contracts in the top TOP of at least one scenario.')
+    parser.add_argument('--output', default=os.path.join(CSV_FOLDER_PATH, 'weight_sweep.csv'))
+    args = parser.parse_args()
+
+    scenarios = scenario_grid(args.gas_per_step, args.gas_per_diff, args.builtin_scale)
+    comparison = compare(*sweep(load_inputs(args.data_folder), scenarios), scenarios, args.baseline, args.top)
+    names = TagIndex.from_csv(NAMED_CONTRACTS_CSV_PATH, 'CONTRACT', 'NAMES')
+    comparison['NAMES'] = names.lookup(comparison['CONTRACT'], default=0)
+    comparison.to_csv(args.output, index=False)
+    for scenario, df in comparison.groupby('SCENARIO'):
+        top = df[df['RANK'] <= args.top]
+        print(f"scenario {scenario} ({', '.join(f'{column}={scenarios.at[scenario, column]}' for column in SCENARIO_COLUMNS)}): "
+              f"{(top['RANK_CHANGE'] != 0).sum()} of the top {len(top)} contracts changed rank, "
+              f"largest move {top['RANK_CHANGE'].abs().max()}")
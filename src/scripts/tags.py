@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+from addresses import normalize_addresses
+
+
+NAMED_CONTRACTS_CSV_PATH = '../csv/names.csv' # Contains addresses with their tag.
+ALLOCATIONS_CSV_PATH = '../csv/allocations.csv' # Contains the allocated addresses with their amount and tag.
+TAG_SOURCES = {
+    'names': (NAMED_CONTRACTS_CSV_PATH, 'CONTRACT', 'NAMES'),
+    'allocations': (ALLOCATIONS_CSV_PATH, 'ADDRESS', 'TAG')
+}
+
+
+class TagIndex:
+    """
+    Index from addresses to tags. The addresses are normalized (see addresses.normalize_address),
+    so that the lookups do not depend on how the sources pad the addresses with zeros,
+    and a lookup of many addresses is a single hash join.
+    """
+
+    def __init__(self, addresses: pd.Series, tags: pd.Series):
+        tags = pd.Series(tags.to_numpy(), index=normalize_addresses(addresses).to_numpy())
+        # As in a scan of the source, the first tag of an address is kept.
+        self.tags = tags[~tags.index.duplicated(keep='first')]
+
+    @classmethod
+    def from_csv(cls, path: str, address_column: str, tag_column: str) -> 'TagIndex':
+        df = pd.read_csv(path, usecols=[address_column, tag_column])
+        return cls(df[address_column], df[tag_column])
+
+    @classmethod
+    def from_sources(cls, names=tuple(TAG_SOURCES)) -> 'TagIndex':
+        """
+        Index of the sources of TAG_SOURCES with the given names; the earlier sources take precedence.
+        """
+        indexes = [cls.from_csv(*TAG_SOURCES[name]) for name in names]
+        tags = pd.concat([index.tags.dropna() for index in indexes])
+        return cls(pd.Series(tags.index), tags)
+
+    def __len__(self) -> int:
+        return len(self.tags)
+
+    def lookup(self, addresses, default=None) -> pd.Series:
+        """
+        Tags of the given addresses, in the same order, with 'default' for the addresses without a tag.
+        """
+        addresses = pd.Series(addresses)
+        positions = self.tags.index.get_indexer(normalize_addresses(addresses))
+        found = positions >= 0
+        values = np.full(len(addresses), default, dtype=object)
+        values[found] = self.tags.to_numpy()[positions[found]]
+        return pd.Series(values, index=addresses.index, dtype=object)
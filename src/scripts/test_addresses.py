@@ -0,0 +1,63 @@
+import unittest
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from addresses import felt_bytes, felt_hex, felt_key_array, felt_key_column, felt_keys, normalize_address, normalize_addresses, to_felt
+
+
+class AddressesTests(unittest.TestCase):
+
+    def test_normalize_address(self):
+        self.assertEqual(normalize_address('0x049D36570d4e46f48e99674bd3fcc84644ddd6b96f7c741b1562b82f9e004dc7'),
+                         '0x49d36570d4e46f48e99674bd3fcc84644ddd6b96f7c741b1562b82f9e004dc7')
+        self.assertEqual(normalize_address(' 0x00ab '), '0xab')
+        self.assertEqual(normalize_address('ab'), '0xab')
+        self.assertEqual(normalize_address('0x000'), '0x0')
+
+    def test_normalize_addresses(self):
+        addresses = ['0x049D3', ' 0x00ab ', 'ab', '0x000', '0x0']
+        self.assertListEqual(list(normalize_addresses(pd.Series(addresses))), [normalize_address(a) for a in addresses])
+
+
+class FeltTests(unittest.TestCase):
+
+    def test_forms(self):
+        for address in ['0x00ab', '0xAB', 'ab', 171]:
+            self.assertEqual(to_felt(address), 171)
+            self.assertEqual(felt_hex(address), '0xab')
+            self.assertEqual(felt_bytes(address), bytes(31) + b'\xab')
+        self.assertEqual(felt_hex('0xab', padded=True), '0x' + '0' * 62 + 'ab')
+        self.assertEqual(felt_hex(0), '0x0')
+
+    def test_not_a_felt(self):
+        with self.assertRaises(ValueError):
+            to_felt(2**252)
+        with self.assertRaises(ValueError):
+            felt_keys(pd.Series(['0x1', '0x1' + '0' * 63]))
+
+    def test_keys(self):
+        addresses = pd.Series(['0x100', '0x0ff', '0xff00', '0x0', '0x49d36570d4e46f48e99674bd3fcc84644ddd6b96f7c741b1562b82f9e004dc7'])
+        keys = felt_keys(addresses)
+        self.assertEqual(keys.dtype, np.dtype('S32'))
+        # The keys sort as the felts.
+        self.assertListEqual(list(np.argsort(keys)), sorted(range(len(addresses)), key=lambda i: to_felt(addresses[i])))
+
+    def test_key_column(self):
+        addresses = pd.Series(['0xff00', None, '0x0'], index=[3, 4, 5])
+        column = felt_key_column(addresses)
+        # The trailing zero bytes are kept.
+        self.assertListEqual(column.tolist(), [felt_bytes('0xff00'), None, bytes(32)])
+        self.assertListEqual(list(column.index), [3, 4, 5])
+
+    def test_key_array(self):
+        addresses = ['0xff00', None, '0x0', ' 0x0FF00', '0x49d36570d4e46f48e99674bd3fcc84644ddd6b96f7c741b1562b82f9e004dc7']
+        for array in (pa.array(addresses), pa.chunked_array([addresses[:2], addresses[2:]]), pa.array(addresses).dictionary_encode()):
+            keys = felt_key_array(array)
+            self.assertEqual(keys.type, pa.binary(32))
+            self.assertListEqual(keys.to_pylist(), felt_key_column(pd.Series(addresses)).tolist())
+        with self.assertRaises(ValueError):
+            felt_key_array(pa.array(['0x1', '0x' + 'f' * 64]))
+
+
+if __name__ == '__main__':
+    unittest.main()
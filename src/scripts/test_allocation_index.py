@@ -0,0 +1,71 @@
+import os
+import tempfile
+import time
+import unittest
+import numpy as np
+import pandas as pd
+from allocation_index import AllocationIndex, build_index, open_index, read_addresses
+
+
+class AllocationIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.csv_path = os.path.join(self.directory.name, 'allocations.csv')
+        self.folder = os.path.join(self.directory.name, 'index')
+        pd.DataFrame({
+            'ADDRESS': ['0x0abc', '0x12', '0xff00', '0xABC', '0x7'],
+            'AMOUNT': [5.0, 3.0, 2.5, 1.0, 4.0],
+            'TAG': ['first', None, 'Ekubo: Core', 'duplicate', None]
+        }).to_csv(self.csv_path, index=False)
+        build_index(self.csv_path, self.folder)
+        self.index = AllocationIndex(self.folder)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_sorted_keys(self):
+        # The duplicate address is dropped, and the keys are sorted for the bisection.
+        self.assertEqual(len(self.index), 4)
+        self.assertTrue(np.all(self.index.keys[:-1] < self.index.keys[1:]))
+        self.assertIsInstance(self.index.keys, np.memmap)
+
+    def test_get(self):
+        self.assertDictEqual(self.index.get('0xABC'), {'AMOUNT': 5.0, 'RANK': 1, 'TAG': 'first'})
+        self.assertDictEqual(self.index.get('0x0000000012'), {'AMOUNT': 3.0, 'RANK': 3, 'TAG': None})
+        # The trailing zero bytes of the key are significant.
+        self.assertDictEqual(self.index.get('0xff00'), {'AMOUNT': 2.5, 'RANK': 4, 'TAG': 'Ekubo: Core'})
+        self.assertIsNone(self.index.get('0xff'))
+        self.assertIsNone(self.index.get('0x1'))
+
+    def test_lookup(self):
+        result = self.index.lookup(['0x7', '0x1234', '0x00ABC'])
+        self.assertListEqual(list(result.columns), ['ADDRESS', 'AMOUNT', 'RANK', 'TAG'])
+        self.assertListEqual(result['ADDRESS'].tolist(), ['0x7', '0x1234', '0x00ABC'])
+        self.assertListEqual(result['AMOUNT'].fillna(-1).tolist(), [4.0, -1, 5.0])
+        self.assertListEqual(result['RANK'].tolist(), [2, pd.NA, 1])
+        self.assertListEqual(result['TAG'].tolist(), [None, None, 'first'])
+        self.assertEqual(len(self.index.lookup([])), 0)
+        with self.assertRaises(ValueError):
+            self.index.lookup(['0x' + 'f' * 64])
+
+    def test_open_index_rebuilds_stale_index(self):
+        keys_path = os.path.join(self.folder, 'keys.npy')
+        index = open_index(self.csv_path, self.folder)
+        self.assertEqual(len(index), 4)
+        built_at = os.path.getmtime(keys_path)
+        pd.DataFrame({'ADDRESS': ['0x1'], 'AMOUNT': [1.0], 'TAG': ['new']}).to_csv(self.csv_path, index=False)
+        os.utime(self.csv_path, (time.time(), built_at + 10))
+        index = open_index(self.csv_path, self.folder)
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.get('0x1')['TAG'], 'new')
+
+    def test_read_addresses(self):
+        path = os.path.join(self.directory.name, 'addresses.txt')
+        with open(path, 'w') as f:
+            f.write('0x7\n\n  0xabc \n')
+        self.assertListEqual(read_addresses(path), ['0x7', '0xabc'])
+
+
+if __name__ == '__main__':
+    unittest.main()
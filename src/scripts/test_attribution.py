@@ -0,0 +1,94 @@
+import random
+import unittest
+import pandas as pd
+from attribution import attribute, ranking_l1_l2
+
+
+def random_inputs(n_blocks: int, n_contracts: int, seed=0) -> dict[str, pd.DataFrame]:
+    """
+    Random per block inputs, where the steps table pads some addresses with zeros.
+    """
+    rng = random.Random(seed)
+    contracts = [hex(rng.getrandbits(160)) for _ in range(n_contracts)]
+    steps, diffs = [], []
+    for block in range(1, n_blocks + 1):
+        for contract in rng.sample(contracts, rng.randint(1, n_contracts)):
+            steps.append((block, '0x' + '0' * rng.randint(0, 3) + contract[2:], rng.randint(0, 5000)))
+        for contract in rng.sample(contracts, rng.randint(0, n_contracts)):
+            diffs.append((block, contract, rng.randint(0, 30)))
+    blocks = range(1, n_blocks + 1)
+    return {
+        'steps': pd.DataFrame(steps, columns=['BLOCK_NUMBER', 'CONTRACT', 'STEPS_PER_CONTRACT']),
+        'diffs': pd.DataFrame(diffs, columns=['BLOCK_NUMBER', 'CONTRACT', 'DIFFS_PER_CONTRACT']),
+        # Some blocks have no builtin gas or no fee, and are dropped by the inner joins.
+        'builtin_gas': pd.DataFrame([(b, rng.uniform(0, 100)) for b in blocks if b % 7], columns=['BLOCK_NUMBER', 'BUILTIN_GAS']),
+        'block_fee': pd.DataFrame([(b, rng.uniform(1e14, 1e16)) for b in blocks if b % 11], columns=['BLOCK_NUMBER', 'BLOCK_FEE'])
+    }
+
+
+def reference_attribution(inputs, gas_per_step, gas_per_diff) -> dict[str, list[float]]:
+    """
+    Row by row implementation of the SQL pipeline, from join_steps_and_diffs to final_fee_amounts_divided.
+    """
+    joined = {}
+    for block, contract, steps in inputs['steps'].itertuples(index=False):
+        contract = '0x' + contract[2:].lstrip('0')
+        joined.setdefault((block, contract), [0, 0])[0] += steps
+    for block, contract, diffs in inputs['diffs'].itertuples(index=False):
+        joined.setdefault((block, contract), [0, 0])[1] += diffs
+    fees = dict(inputs['block_fee'].itertuples(index=False))
+    builtin_gas = dict(inputs['builtin_gas'].itertuples(index=False))
+    totals = {}
+    for (block, _), (steps, diffs) in joined.items():
+        total = totals.setdefault(block, [0, 0, 0])
+        total[0] += steps
+        total[1] += diffs
+        total[2] += diffs != 0
+    result = {}
+    for (block, contract), (steps, diffs) in joined.items():
+        if block not in fees or block not in builtin_gas:
+            continue
+        steps_per_block, diffs_per_block, contracts_per_block = totals[block]
+        denominator = builtin_gas[block] + steps_per_block * gas_per_step + (diffs_per_block + contracts_per_block) * gas_per_diff
+        proportion_steps = (builtin_gas[block] + steps_per_block * gas_per_step) / denominator
+        proportion_diffs = (diffs_per_block + contracts_per_block) * gas_per_diff / denominator
+        l1 = 0 if diffs == 0 else proportion_diffs * (diffs + 1) / (diffs_per_block + contracts_per_block)
+        l2 = proportion_steps * steps / steps_per_block if steps_per_block else 0
+        fee = result.setdefault(contract, [0, 0])
+        fee[0] += l1 * fees[block]
+        fee[1] += l2 * fees[block]
+    return result
+
+
+class AttributionTests(unittest.TestCase):
+
+    def test_matches_reference(self):
+        inputs = random_inputs(200, 30)
+        fee_divided = attribute(inputs, 0.01, 1024)
+        reference = reference_attribution(inputs, 0.01, 1024)
+        self.assertSetEqual(set(fee_divided['CONTRACT']), set(reference))
+        for contract, l1, l2 in fee_divided.itertuples(index=False):
+            self.assertAlmostEqual(l1, reference[contract][0], delta=1e-6 * max(1, l1))
+            self.assertAlmostEqual(l2, reference[contract][1], delta=1e-6 * max(1, l2))
+
+    def test_fees_are_conserved(self):
+        inputs = random_inputs(100, 20, seed=1)
+        fee_divided = attribute(inputs, 0.01, 1024)
+        kept = set(inputs['builtin_gas']['BLOCK_NUMBER']) & set(inputs['block_fee']['BLOCK_NUMBER'])
+        total_fee = inputs['block_fee'][inputs['block_fee']['BLOCK_NUMBER'].isin(kept)]['BLOCK_FEE'].sum()
+        total = fee_divided['L1_FEE_PER_CONTRACT'].sum() + fee_divided['L2_FEE_PER_CONTRACT'].sum()
+        self.assertAlmostEqual(total / total_fee, 1, places=9)
+
+    def test_ranking(self):
+        fee_divided = pd.DataFrame({
+            'CONTRACT': ['0x1', '0x2', '0x3'],
+            'L1_FEE_PER_CONTRACT': [1e18, 0, 3e18],
+            'L2_FEE_PER_CONTRACT': [1e18, 5e18, 0]
+        })
+        ranking = ranking_l1_l2(fee_divided, size=2)
+        self.assertListEqual(list(ranking['CONTRACT']), ['0x2', '0x3'])
+        self.assertListEqual(list(ranking['FEE_PER_CONTRACT']), [5.0, 3.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+import unittest
+from batch import BatchBuilder
+
+
+class BatchBuilderTests(unittest.TestCase):
+
+    def test_flush(self):
+        batch = BatchBuilder({'BLOCK_NUMBER': 'int64', 'CONTRACT': 'object', 'UPDATES_PER_BLOCK': 'int64'})
+        batch.append(1, '0x1', 3)
+        batch.extend([2, 2], ['0x2', '0x3'], [1, 5])
+        self.assertEqual(len(batch), 3)
+        df = batch.flush()
+        self.assertEqual(len(batch), 0)
+        self.assertListEqual(list(df.columns), ['BLOCK_NUMBER', 'CONTRACT', 'UPDATES_PER_BLOCK'])
+        self.assertListEqual(df['BLOCK_NUMBER'].tolist(), [1, 2, 2])
+        self.assertListEqual(df['CONTRACT'].tolist(), ['0x1', '0x2', '0x3'])
+        self.assertEqual(str(df['UPDATES_PER_BLOCK'].dtype), 'int64')
+
+    def test_empty_flush(self):
+        batch = BatchBuilder({'BLOCK_NUMBER': 'int64', 'CONTRACT': 'object'})
+        df = batch.flush()
+        self.assertEqual(df.shape, (0, 2))
+        self.assertEqual(str(df['BLOCK_NUMBER'].dtype), 'int64')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,20 @@
+import glob
+import json
+import os
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import random
+import sys
+import tempfile
 import unittest
-from cairo_steps_script import Tree
+from unittest import mock
+from addresses import felt_bytes
+from cairo_steps_script import (ArrayTree, Tree, check_lean_table, compact_traces, complete_arrow_transactions, complete_transactions,
+                                contract_keys, infer_arrow_batch, infer_batch, process_range)
+from checkpoint import Manifest
+from metrics import Metrics
+from scheduling import AdaptiveWindow
 from utils import get_connection
 
 
@@ -67,6 +81,276 @@ class TreeTests(unittest.TestCase):
             set_tree_true = set(tree_true)
             self.assertSetEqual(set_tree, set_tree_true)
 
+    def test_array_tree_individual_steps(self):
+        for tree, tree_true in self.trees:
+            curr_tree = ArrayTree(tree)
+            curr_tree.infer_all()
+            set_tree = set([x for x in curr_tree.dict_steps.items() if len(x[0])!= 0])
+            set_tree_true = set(tree_true)
+            self.assertSetEqual(set_tree, set_tree_true)
+
+    def test_array_tree_equivalence(self):
+        rng = random.Random(0)
+        for _ in range(50):
+            nodes = []
+            # Random transactions with nested calls and optional validation and fee calls.
+            for tx in range(rng.randint(1, 10)):
+                frontier = [(str(rng.randint(1, 20)), str(tx))]
+                nodes.append(frontier[0])
+                for suffix in ('v', 'f'):
+                    if rng.random() < 0.5:
+                        frontier.append(frontier[0] + (suffix,))
+                        nodes.append(frontier[-1])
+                for _ in range(rng.randint(0, 30)):
+                    parent = rng.choice(frontier)
+                    child = parent + (str(rng.randint(0, 12)),)
+                    if child not in nodes:
+                        frontier.append(child)
+                        nodes.append(child)
+            # Drop some nodes, so that some calls have no parent in the tree.
+            nodes = [node for node in nodes if rng.random() < 0.9]
+            tree = [(node, rng.randint(0, 10000)) for node in sorted(set(nodes))]
+            reference, array_tree = Tree(tree), ArrayTree(tree)
+            reference.infer_all()
+            array_tree.infer_all()
+            self.assertDictEqual(array_tree.dict_steps, reference.dict_steps)
+            reference_df, array_df = reference.to_data_frame(), array_tree.to_data_frame()
+            self.assertListEqual(list(array_df.index), list(reference_df.index))
+            self.assertListEqual(list(array_df['INDIVIDUAL_STEPS']), list(reference_df['INDIVIDUAL_STEPS']))
+
+    def test_array_tree_deep_calls(self):
+        depth = sys.getrecursionlimit() + 100
+        tree = [(('1', '0') + ('0',) * i, depth - i) for i in range(depth)]
+        array_tree = ArrayTree(tree)
+        array_tree.infer_all()
+        self.assertTrue((array_tree.steps == 1).all())
+
+
+class FakeCursor:
+    """
+    Stand-in for a Snowflake cursor, which answers the traces query with a fixed dataframe per batch.
+    """
+
+    def __init__(self, dfs):
+        self.dfs = dfs
+        self.queries = []
+
+    def execute(self, query):
+        self.queries.append(query)
+        return self
+
+    def fetch_pandas_all(self):
+        traces_queries = [query for query in self.queries if 'count(*)' not in query]
+        if 'count(*)' in self.queries[-1]:
+            # The count query of the adaptive mode counts the traces of the next traces query.
+            return pd.DataFrame({'ROWS': [len(self.dfs[len(traces_queries)])]})
+        return self.dfs[len(traces_queries) - 1].copy()
+
+    def fetch_pandas_batches(self):
+        # The rows are split in batches of 3, regardless of the transactions.
+        df = self.fetch_pandas_all()
+        return (df[i:i + 3].reset_index(drop=True) for i in range(0, len(df), 3))
+
+
+class ArrowCursor(FakeCursor):
+    """
+    FakeCursor which answers the traces query with Arrow tables, and keeps the Parquet files uploaded by the loader.
+    """
+
+    def __init__(self, dfs):
+        super().__init__(dfs)
+        self.loaded = []
+
+    def execute(self, query):
+        if query.strip().startswith('put'):
+            self.loaded += [pq.read_table(path) for path in sorted(glob.glob(query.split("'")[1].removeprefix('file://')))]
+        elif 'tokenflow.decoded.traces' in query:
+            self.queries.append(query)
+        return self
+
+    def fetch_arrow_all(self):
+        df = self.fetch_pandas_all()
+        # As the connector, None instead of an empty table.
+        return pa.Table.from_pandas(df, preserve_index=False) if len(df) else None
+
+    def fetch_arrow_batches(self):
+        return (pa.Table.from_pandas(df, preserve_index=False) for df in self.fetch_pandas_batches())
+
+
+class ProcessRangeTests(unittest.TestCase):
+
+    def test_process_range(self):
+        df = pd.DataFrame({
+            'BLOCK_NUMBER': [1, 1, 1, 1],
+            'TRACE_ID': ['1_0_10', '1_0', '1_0_9', '1_0_v'],
+            'CONTRACT': ['0x0a', '0x1', '0xb', '0x01'],
+            'STEPS': [5, 100, 20.0, None]
+        })
+        cursor = FakeCursor([df, df])
+        cnx = mock.Mock(cursor=lambda: cursor)
+        manifest = Manifest(':memory:')
+        with mock.patch('writers.write_pandas', side_effect=[(True, 1, 4, None), (False, 0, 0, None)]) as write:
+            failed_blocks, timer = process_range(cnx, 1, 150, manifest=manifest)
+        self.assertListEqual(failed_blocks, ['[101:150]'])
+        written = write.call_args_list[0].args[1]
+        self.assertListEqual(written['TRACE_ID'].tolist(), ['1_0', '1_0_9', '1_0_10', '1_0_v'])
+        self.assertListEqual(written['INDIVIDUAL_STEPS'].tolist(), [75, 20, 5, 0])
+        self.assertListEqual(written['CONTRACT_KEY'].tolist(), [felt_bytes(x) for x in ['0x1', '0xb', '0xa', '0x1']])
+        self.assertDictEqual(timer.batches, {'fetch': 2, 'compute': 2, 'write': 2})
+        self.assertListEqual(manifest.missing_ranges('CAIRO_STEPS_SCRIPT', 1, 150), [(101, 150)])
+        self.assertListEqual(manifest.failed_ranges('CAIRO_STEPS_SCRIPT', 1, 150), [(101, 150)])
+
+    def test_empty_window(self):
+        df = pd.DataFrame({'BLOCK_NUMBER': [], 'TRACE_ID': [], 'CONTRACT': [], 'STEPS': []}).astype({'BLOCK_NUMBER': 'int64', 'STEPS': 'float64'})
+        cursor = FakeCursor([df])
+        manifest = Manifest(':memory:')
+        with mock.patch('writers.write_pandas', return_value=(True, 1, 0, None)):
+            failed_blocks, timer = process_range(mock.Mock(cursor=lambda: cursor), 1, 100, manifest=manifest)
+        self.assertListEqual(failed_blocks, [])
+        self.assertListEqual(manifest.missing_ranges('CAIRO_STEPS_SCRIPT', 1, 100), [])
+
+    def test_metrics(self):
+        df = pd.DataFrame({
+            'BLOCK_NUMBER': [1, 1],
+            'TRACE_ID': ['1_0', '1_0_1'],
+            'CONTRACT': ['0x1', '0x2'],
+            'STEPS': [100, 20]
+        })
+        cursor = FakeCursor([df, df])
+        cnx = mock.Mock(cursor=lambda: cursor)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.jsonl')
+            with mock.patch('writers.write_pandas', side_effect=[(True, 1, 2, None), (False, 0, 0, None)]):
+                process_range(cnx, 1, 150, metrics=Metrics(path, 'cairo_steps_script'))
+            with open(path) as f:
+                records = [json.loads(line) for line in f]
+        events = [(record['event'], record['start_block'], record['end_block']) for record in records]
+        self.assertCountEqual(events, [(event, start, end) for event in ('fetch', 'compute', 'write') for start, end in ((1, 100), (101, 150))])
+        fetches = [record for record in records if record['event'] == 'fetch']
+        self.assertListEqual([record['rows'] for record in fetches], [2, 2])
+        self.assertTrue(all(record['bytes'] > 0 for record in fetches))
+        self.assertListEqual([record['success'] for record in records if record['event'] == 'write'], [True, False])
+
+
+class LeanTests(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.DataFrame({
+            'BLOCK_NUMBER': [1, 1, 1, 2, 2],
+            'TRACE_ID': ['1_0', '1_0_1', '1_0_v', '2_3', '2_3_0'],
+            'TX_HASH': ['0xaa'] * 3 + ['0xbb'] * 2,
+            'TRACE_TYPE': ['CALL'] * 5,
+            'CALLER': ['0x5'] * 5,
+            'CONTRACT': ['0x1', '0x02', '0x1', None, '0x2'],
+            'FUNCTION': ['__execute__', 'transfer', '__validate__', 'swap', 'transfer'],
+            'STEPS': [100, 20.0, None, 50, 30]
+        })
+
+    def lean_frame(self) -> pd.DataFrame:
+        return self.df[['BLOCK_NUMBER', 'TRACE_ID', 'CONTRACT', 'STEPS']].copy()
+
+    def test_compact_traces(self):
+        df = compact_traces(self.lean_frame())
+        self.assertDictEqual({column: str(dtype) for column, dtype in df.dtypes.items()},
+                             {'BLOCK_NUMBER': 'int32', 'TRACE_ID': 'object', 'CONTRACT': 'category', 'STEPS': 'int64'})
+        self.assertListEqual(df['STEPS'].tolist(), [100, 20, 0, 50, 30])
+        self.assertListEqual(contract_keys(df['CONTRACT']).tolist(), contract_keys(self.df['CONTRACT']).tolist())
+        self.assertIsNone(contract_keys(df['CONTRACT'])[3])
+
+    def test_lean_matches_full(self):
+        for stream in (False, True):
+            full, lean = FakeCursor([self.df]), FakeCursor([self.lean_frame()])
+            with mock.patch('writers.write_pandas', return_value=(True, 1, 1, None)) as write:
+                process_range(mock.Mock(cursor=lambda: full), 1, 2, window=2, stream=stream)
+                process_range(mock.Mock(cursor=lambda: lean), 1, 2, window=2, stream=stream, lean=True)
+            self.assertIn('tx_hash', full.queries[0])
+            self.assertNotIn('tx_hash', lean.queries[0])
+            self.assertNotIn('function', lean.queries[0])
+            calls = write.call_args_list
+            full_rows = pd.concat([call.args[1] for call in calls[:len(calls) // 2]]).set_index('TRACE_ID')
+            lean_rows = pd.concat([call.args[1] for call in calls[len(calls) // 2:]]).set_index('TRACE_ID')
+            self.assertListEqual(list(lean_rows.columns), ['BLOCK_NUMBER', 'CONTRACT', 'STEPS', 'INDIVIDUAL_STEPS', 'CONTRACT_KEY'])
+            self.assertDictEqual(lean_rows['INDIVIDUAL_STEPS'].to_dict(), full_rows['INDIVIDUAL_STEPS'].to_dict())
+            self.assertDictEqual(lean_rows['CONTRACT_KEY'].to_dict(), full_rows['CONTRACT_KEY'].to_dict())
+
+    def test_lean_requires_full_table(self):
+        # A table created by a lean run would lack the other columns for the later full runs.
+        for column_count in (0, 1):
+            cursor = mock.Mock()
+            cursor.execute.return_value.fetch_pandas_all.return_value = pd.DataFrame({'COLUMN_COUNT': [column_count]})
+            if column_count:
+                check_lean_table(mock.Mock(cursor=lambda: cursor))
+            else:
+                with self.assertRaises(ValueError):
+                    check_lean_table(mock.Mock(cursor=lambda: cursor))
+            self.assertIn("column_name = upper('tx_hash')", cursor.execute.call_args.args[0])
+
+
+class ArrowTests(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.DataFrame({
+            'BLOCK_NUMBER': [1, 1, 1, 1, 2, 2, 2],
+            'TRACE_ID': ['1_0_10', '1_0', '1_0_9', '1_0_v', '2_3', '2_3_0', '2_3_0_1'],
+            'CONTRACT': ['0x0a', '0x1', '0xb', '0x01', None, '0x2', '0x02'],
+            'STEPS': [5, 100, 20.0, None, 50, 30, 10]
+        })
+
+    def test_infer_arrow_batch(self):
+        expected = infer_batch(self.df.copy())
+        table = infer_arrow_batch(pa.Table.from_pandas(self.df, preserve_index=False))
+        self.assertListEqual(table['TRACE_ID'].to_pylist(), expected['TRACE_ID'].tolist())
+        self.assertListEqual(table['STEPS'].to_pylist(), expected['STEPS'].tolist())
+        self.assertListEqual(table['INDIVIDUAL_STEPS'].to_pylist(), expected['INDIVIDUAL_STEPS'].tolist())
+        self.assertListEqual(table['CONTRACT_KEY'].to_pylist(), expected['CONTRACT_KEY'].tolist())
+        lean = infer_arrow_batch(pa.Table.from_pandas(self.df, preserve_index=False), lean=True)
+        self.assertEqual(lean.schema.field('BLOCK_NUMBER').type, pa.int32())
+        self.assertTrue(pa.types.is_dictionary(lean.schema.field('CONTRACT').type))
+        self.assertEqual(lean.schema.field('CONTRACT_KEY').type, pa.binary(32))
+        self.assertListEqual(lean['CONTRACT_KEY'].to_pylist(), table['CONTRACT_KEY'].to_pylist())
+
+    def test_empty_batch(self):
+        empty = self.df[:0].astype({'STEPS': 'float64'})
+        self.assertEqual(len(infer_batch(empty.copy())), 0)
+        table = infer_arrow_batch(pa.Table.from_pandas(empty, preserve_index=False))
+        self.assertEqual(len(table), 0)
+        self.assertListEqual(table.column_names[-2:], ['INDIVIDUAL_STEPS', 'CONTRACT_KEY'])
+
+    def test_complete_arrow_transactions(self):
+        tables = [pa.Table.from_pandas(self.df[i:i + 3], preserve_index=False) for i in range(0, len(self.df), 3)]
+        frames = [self.df[i:i + 3] for i in range(0, len(self.df), 3)]
+        self.assertListEqual([table['TRACE_ID'].to_pylist() for table in complete_arrow_transactions(tables)],
+                             [df['TRACE_ID'].tolist() for df in complete_transactions(frames)])
+        self.assertListEqual(list(complete_arrow_transactions([])), [])
+
+    def test_arrow_matches_pandas(self):
+        for stream in (False, True):
+            with mock.patch('writers.write_pandas', return_value=(True, 1, 1, None)) as write:
+                process_range(mock.Mock(cursor=lambda: FakeCursor([self.df])), 1, 2, window=2, stream=stream)
+            expected = pd.concat([call.args[1] for call in write.call_args_list]).set_index('TRACE_ID')
+            cursor = ArrowCursor([self.df])
+            manifest = Manifest(':memory:')
+            with mock.patch('writers.write_pandas') as write:
+                failed_blocks, _ = process_range(mock.Mock(cursor=lambda: cursor), 1, 2, window=2, stream=stream, arrow=True,
+                                                 manifest=manifest)
+            write.assert_not_called()
+            self.assertListEqual(failed_blocks, [])
+            self.assertListEqual(manifest.missing_ranges('CAIRO_STEPS_SCRIPT', 1, 2), [])
+            loaded = pa.concat_tables(cursor.loaded)
+            self.assertEqual(loaded.schema.field('CONTRACT_KEY').type, pa.binary(32))
+            steps = dict(zip(loaded['TRACE_ID'].to_pylist(), loaded['INDIVIDUAL_STEPS'].to_pylist()))
+            keys = dict(zip(loaded['TRACE_ID'].to_pylist(), loaded['CONTRACT_KEY'].to_pylist()))
+            self.assertDictEqual(steps, expected['INDIVIDUAL_STEPS'].to_dict())
+            self.assertDictEqual(keys, expected['CONTRACT_KEY'].to_dict())
+
+    def test_empty_window(self):
+        cursor = ArrowCursor([self.df[:0]])
+        manifest = Manifest(':memory:')
+        failed_blocks, _ = process_range(mock.Mock(cursor=lambda: cursor), 1, 2, window=2, arrow=True, manifest=manifest)
+        self.assertListEqual(failed_blocks, [])
+        self.assertListEqual(cursor.loaded, [])
+        self.assertListEqual(manifest.missing_ranges('CAIRO_STEPS_SCRIPT', 1, 2), [])
+
 
 class TableScriptTests(unittest.TestCase):
 
@@ -143,5 +427,71 @@ class TableScriptTests(unittest.TestCase):
             self.assertEqual(df['INDIVIDUAL_STEPS'].sum(), starkscan_steps[block])
         
 
+class StreamTests(unittest.TestCase):
+
+    def setUp(self):
+        # The traces of block 1, then 2, ordered by transaction but not within a transaction.
+        self.df = pd.DataFrame({
+            'BLOCK_NUMBER': [1, 1, 1, 1, 1, 1, 2, 2],
+            'TRACE_ID': ['1_0_1', '1_0', '1_2', '1_10_0', '1_10', '1_10_1', '2_1', '2_1_v'],
+            'CONTRACT': ['0x1'] * 8,
+            'STEPS': [10, 30, 5, 1, 4, 2, 7, 3]
+        })
+
+    def test_complete_transactions(self):
+        frames = [self.df[i:i + 4] for i in range(0, len(self.df), 4)]
+        batches = list(complete_transactions(frames))
+        self.assertListEqual([batch['TRACE_ID'].tolist() for batch in batches],
+                             [['1_0_1', '1_0', '1_2'], ['1_10_0', '1_10', '1_10_1'], ['2_1', '2_1_v']])
+        # A transaction spanning several frames is held back until it is complete.
+        frames = [self.df[i:i + 1] for i in range(len(self.df))]
+        batches = list(complete_transactions(frames))
+        self.assertListEqual([batch['TRACE_ID'].tolist() for batch in batches],
+                             [['1_0_1', '1_0'], ['1_2'], ['1_10_0', '1_10', '1_10_1'], ['2_1', '2_1_v']])
+        self.assertListEqual(list(complete_transactions([])), [])
+
+    def test_stream_matches_batch(self):
+        cursor = FakeCursor([self.df, self.df])
+        cnx = mock.Mock(cursor=lambda: cursor)
+        with mock.patch('writers.write_pandas', return_value=(True, 1, 1, None)) as write:
+            process_range(cnx, 1, 2, window=2)
+        expected = write.call_args_list[0].args[1].set_index('TRACE_ID')['INDIVIDUAL_STEPS']
+        manifest = Manifest(':memory:')
+        with mock.patch('writers.write_pandas', return_value=(True, 1, 1, None)) as write:
+            failed_blocks, timer = process_range(cnx, 1, 2, window=2, stream=True, manifest=manifest)
+        self.assertIn('order by', cursor.queries[-1])
+        self.assertListEqual(failed_blocks, [])
+        streamed = pd.concat([call.args[1] for call in write.call_args_list]).set_index('TRACE_ID')['INDIVIDUAL_STEPS']
+        self.assertDictEqual(streamed.to_dict(), expected.to_dict())
+        self.assertGreater(timer.batches['write'], 1)
+        self.assertListEqual(manifest.missing_ranges('CAIRO_STEPS_SCRIPT', 1, 2), [])
+
+    def test_stream_replace(self):
+        cursor = FakeCursor([self.df])
+        cnx = mock.Mock(cursor=lambda: cursor)
+        manifest = Manifest(':memory:')
+        with mock.patch('writers.write_pandas', return_value=(True, 1, 1, None)) as write:
+            process_range(cnx, 1, 2, window=2, stream=True, manifest=manifest, write_mode='replace')
+        # Only the first batch of the window replaces the rows of the window, the next ones are appended.
+        tables = [call.args[2] for call in write.call_args_list]
+        self.assertTrue(tables[0].startswith('CAIRO_STEPS_SCRIPT_STAGING_'))
+        self.assertListEqual(tables[1:], ['CAIRO_STEPS_SCRIPT'] * (len(tables) - 1))
+        self.assertEqual(sum('delete from CAIRO_STEPS_SCRIPT' in query for query in cursor.queries), 1)
+
+    def test_adaptive_windows(self):
+        # Block 1 has 6 traces, more than twice the target of 2 rows, so the first window of 2 blocks is shrunk.
+        cursor = FakeCursor([self.df[self.df['BLOCK_NUMBER'] == 1], self.df[self.df['BLOCK_NUMBER'] == 2]])
+        cnx = mock.Mock(cursor=lambda: cursor)
+        manifest = Manifest(':memory:')
+        scheduler = AdaptiveWindow(initial=2, target_rows=2)
+        with mock.patch('writers.write_pandas', return_value=(True, 1, 1, None)):
+            failed_blocks, timer = process_range(cnx, 1, 2, manifest=manifest, scheduler=scheduler)
+        traces_queries = [query for query in cursor.queries if 'count(*)' not in query]
+        self.assertEqual(len(traces_queries), 2)
+        self.assertIn('block_number <= 1', traces_queries[0])
+        self.assertListEqual(failed_blocks, [])
+        self.assertListEqual(manifest.missing_ranges('CAIRO_STEPS_SCRIPT', 1, 2), [])
+
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
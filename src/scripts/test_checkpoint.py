@@ -0,0 +1,68 @@
+import os
+import tempfile
+import unittest
+from argparse import Namespace
+from checkpoint import COMMITTED, FAILED, Manifest, merge_ranges, ranges_to_process, split_batches, subtract_ranges
+
+
+class RangesTests(unittest.TestCase):
+
+    def test_merge_ranges(self):
+        self.assertListEqual(merge_ranges([(5, 9), (1, 3), (4, 4), (20, 30), (25, 26)]), [(1, 9), (20, 30)])
+
+    def test_subtract_ranges(self):
+        self.assertListEqual(subtract_ranges([(1, 100)], [(10, 19), (50, 200)]), [(1, 9), (20, 49)])
+        self.assertListEqual(subtract_ranges([(1, 10)], []), [(1, 10)])
+        self.assertListEqual(subtract_ranges([(1, 10)], [(1, 10)]), [])
+
+    def test_split_batches(self):
+        self.assertListEqual(split_batches([(1, 25), (40, 40)], 10), [(1, 10), (11, 20), (21, 25), (40, 40)])
+
+
+class ManifestTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'manifest.sqlite')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_resume(self):
+        manifest = Manifest(self.path)
+        manifest.record('T', 1, 100, COMMITTED)
+        manifest.record('T', 101, 200, FAILED)
+        manifest.record('T', 201, 300, COMMITTED)
+        manifest.record('U', 301, 400, COMMITTED)
+        manifest.close()
+        # The manifest survives a restart.
+        manifest = Manifest(self.path)
+        self.assertListEqual(manifest.missing_ranges('T', 1, 500), [(101, 200), (301, 500)])
+        self.assertListEqual(manifest.failed_ranges('T', 1, 500), [(101, 200)])
+        self.assertListEqual(manifest.failed_ranges('T', 150, 500), [(150, 200)])
+        args = Namespace(start_block=1, end_block=500, resume=True, retry_failed=False)
+        self.assertListEqual(ranges_to_process(args, 'T', manifest), [(101, 200), (301, 500)])
+        args = Namespace(start_block=1, end_block=500, resume=False, retry_failed=True)
+        self.assertListEqual(ranges_to_process(args, 'T', manifest), [(101, 200)])
+        args = Namespace(start_block=1, end_block=500, resume=False, retry_failed=False)
+        self.assertListEqual(ranges_to_process(args, 'T', manifest), [(1, 500)])
+
+    def test_commit_clears_failures(self):
+        manifest = Manifest(self.path)
+        manifest.record('T', 1, 100, FAILED)
+        manifest.record('T', 21, 40, COMMITTED)
+        self.assertListEqual(manifest.failed_ranges('T', 1, 100), [(1, 20), (41, 100)])
+        self.assertListEqual(manifest.missing_ranges('T', 1, 100), [(1, 20), (41, 100)])
+
+    def test_commits(self):
+        manifest = Manifest(self.path)
+        manifest.record('T', 1, 100, COMMITTED)
+        manifest.record('T', 101, 101, FAILED)
+        self.assertEqual(manifest.commits('T'), 1)
+        manifest.record('T', 1, 100, COMMITTED)
+        self.assertEqual(manifest.commits('T'), 2)
+        self.assertEqual(manifest.commits('U'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import asyncio
+import unittest
+from starknet_py.net.full_node_client import ClientError
+from fetcher import StateUpdateFetcher
+
+
+class FakeClient:
+    """
+    Stand-in for FullNodeClient which fails a given number of times per block
+    and records how many requests are in flight.
+    """
+
+    def __init__(self, failures=None, always_fail=()):
+        self.failures = dict(failures or {})
+        self.always_fail = set(always_fail)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def get_state_update(self, block_number):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            # Later blocks answer faster, so that completion order differs from block order.
+            await asyncio.sleep(0.001 * (block_number % 3))
+            if block_number in self.always_fail:
+                raise ClientError('unavailable')
+            if self.failures.get(block_number, 0) > 0:
+                self.failures[block_number] -= 1
+                raise asyncio.TimeoutError()
+            return f'update_{block_number}'
+        finally:
+            self.in_flight -= 1
+
+
+class HangingClient(FakeClient):
+    """
+    Stand-in for FullNodeClient which never answers for the blocks after 'last_block'.
+    """
+
+    def __init__(self, last_block: int):
+        super().__init__()
+        self.last_block = last_block
+
+    async def get_state_update(self, block_number):
+        if block_number <= self.last_block:
+            return await super().get_state_update(block_number)
+        self.in_flight += 1
+        try:
+            await asyncio.Event().wait()
+        finally:
+            self.in_flight -= 1
+
+
+class FetcherTests(unittest.IsolatedAsyncioTestCase):
+
+    async def collect(self, fetcher, start_block, end_block, batch_size):
+        return [batch async for batch in fetcher.fetch_batches(start_block, end_block, batch_size)]
+
+    async def test_batches_in_block_order(self):
+        client = FakeClient()
+        fetcher = StateUpdateFetcher(client, concurrency=4, base_delay=0)
+        batches = await self.collect(fetcher, 1, 25, 10)
+        self.assertEqual([(start, end) for start, end, _ in batches], [(1, 10), (11, 20), (21, 25)])
+        blocks = [block for _, _, results in batches for block, _ in results]
+        self.assertEqual(blocks, list(range(1, 26)))
+        self.assertTrue(all(result == f'update_{block}' for _, _, results in batches for block, result in results))
+        self.assertLessEqual(client.max_in_flight, 4)
+
+    async def test_retries(self):
+        client = FakeClient(failures={3: 2}, always_fail={5})
+        fetcher = StateUpdateFetcher(client, concurrency=2, max_retries=2, base_delay=0)
+        (_, _, results), = await self.collect(fetcher, 1, 6, 10)
+        results = dict(results)
+        self.assertEqual(results[3], 'update_3')
+        self.assertIsInstance(results[5], ClientError)
+        self.assertEqual(fetcher.retries, 4)
+
+    async def test_windows_are_read_when_scheduled(self):
+        client = FakeClient()
+        fetcher = StateUpdateFetcher(client, concurrency=4, base_delay=0)
+        consumed = []
+
+        def windows():
+            # The size of each window is the number of windows consumed before it is read, plus 2.
+            start = 1
+            while start <= 20:
+                end = min(20, start + len(consumed) + 1)
+                yield start, end
+                start = end + 1
+
+        async for start, end, results in fetcher.fetch_windows(windows()):
+            consumed.append((start, end))
+            self.assertListEqual([block for block, _ in results], list(range(start, end + 1)))
+        self.assertListEqual(consumed, [(1, 2), (3, 4), (5, 6), (7, 9), (10, 13), (14, 19), (20, 20)])
+        self.assertLessEqual(client.max_in_flight, 4)
+
+    async def test_early_close_cancels_requests(self):
+        client = HangingClient(last_block=2)
+        fetcher = StateUpdateFetcher(client, concurrency=4, base_delay=0)
+        batches = fetcher.fetch_batches(1, 100, 2)
+        start, end, _ = await anext(batches)
+        self.assertEqual((start, end), (1, 2))
+        # The requests of the next batches are in flight.
+        self.assertGreater(client.in_flight, 0)
+        await batches.aclose()
+        self.assertEqual(client.in_flight, 0)
+        self.assertSetEqual(asyncio.all_tasks(), {asyncio.current_task()})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,12 @@
+import numpy as np
 import pandas as pd
+import re
 import unittest
+import queries.generators
+from attribution import attribute, ranking_l1_l2
+from final_tables_script import build_tables
+from queries.pipeline import DEFAULT_PER_DIFF, DEFAULT_PER_STEP, backfill_queries, pipeline_queries
+from test_attribution import random_inputs
 from utils import get_connection
 
 
@@ -7,6 +14,146 @@ MAX_BLOCK = 448500
 MIN_BLOCK = 1
 
 
+class IncrementalQueriesTests(unittest.TestCase):
+
+    def test_full_rebuild(self):
+        queries = pipeline_queries(1, 100)
+        for query in queries[:-1]:
+            self.assertIn('create or replace table', query)
+        # Only the tables read from the tokenflow database are restricted to the block range.
+        for query in queries[2:]:
+            self.assertNotIn('>= 1', query)
+
+    def test_incremental(self):
+        queries = pipeline_queries(448501, 450000, incremental=True)
+        # The per block tables are appended, for the new range only.
+        for query in queries[:-2]:
+            self.assertTrue(query.strip().startswith('insert into'))
+            self.assertIn('>= 448501', query)
+            self.assertIn('<= 450000', query)
+        # The per contract totals are updated with the fees of the new range.
+        self.assertTrue(queries[-2].strip().startswith('merge into final_fee_amounts_divided'))
+        self.assertIn('final_proportions.block_number >= 448501', queries[-2])
+        self.assertEqual(queries[-1], pipeline_queries(1, 100)[-1])
+
+
+def select_body(query: str) -> str:
+    """
+    The select statement materialized (or merged) by a query of pipeline_queries, with normalized whitespace
+    and without the block range filters of the incremental mode.
+    """
+    pattern = r'merge into \w+ using \((.*)\) as deltas' if 'merge into' in query else r'(?:as|select \* from) \((.*)\)'
+    body = re.search(pattern, query, re.S).group(1)
+    body = re.sub(r'\bwhere [\w.]+ >= \d+ and [\w.]+ <= \d+', '', body)
+    return ' '.join(body.split())
+
+
+class RecordingCursor:
+    """
+    Stand-in for a Snowflake cursor, which records the executed statements, and whose fetch_pandas_all
+    returns the statement it fetches the result of.
+    """
+
+    def __init__(self, last_block=448500, has_key=True):
+        self.statements = []
+        self.last_block = last_block
+        self.has_key = has_key
+        self.sfqid = None
+
+    def execute(self, statement):
+        self.statements.append(statement)
+        return self
+
+    def fetch_pandas_all(self):
+        if 'information_schema.columns' in self.statements[-1]:
+            return pd.DataFrame({'COLUMN_COUNT': [int(self.has_key)]})
+        if 'max(block_number)' in self.statements[-1]:
+            return pd.DataFrame({'MAX_BLOCK_NUMBER': [self.last_block]})
+        return pd.DataFrame({'STATEMENT': [self.statements[-1]]})
+
+
+class BuildTablesTests(unittest.TestCase):
+
+    def build(self, start_block, end_block, has_key=True, **options):
+        cursor = RecordingCursor(has_key=has_key)
+        df = build_tables(type('Connection', (), {'cursor': lambda self: cursor})(), start_block, end_block, **options)
+        return cursor, df
+
+    def test_incremental_fetches_ranking_after_commit(self):
+        cursor, df = self.build(448501, 450000, incremental=True)
+        statements = [statement.strip() for statement in cursor.statements]
+        self.assertEqual(statements[2], 'begin')
+        self.assertEqual(statements[-2], 'commit')
+        self.assertEqual(df.at[0, 'STATEMENT'], queries.generators.ranking_l1_l2())
+        # The checks of the tables, then the build queries in a transaction, then the ranking.
+        self.assertEqual(statements[3:-2], [query.strip() for query in pipeline_queries(448501, 450000, incremental=True)[:-1]])
+
+    def test_incremental_rejects_ingested_blocks(self):
+        with self.assertRaises(ValueError):
+            self.build(448500, 450000, incremental=True)
+
+    def test_incremental_requires_contract_keys(self):
+        # The totals built before the contract keys cannot be merged on them.
+        with self.assertRaises(ValueError):
+            self.build(448501, 450000, has_key=False, incremental=True)
+
+    def test_full_rebuild_fetches_ranking(self):
+        cursor, df = self.build(1, 448500)
+        self.assertListEqual(cursor.statements, pipeline_queries(1, 448500))
+        self.assertEqual(df.at[0, 'STATEMENT'], queries.generators.ranking_l1_l2())
+
+    def test_incremental_matches_full_rebuild(self):
+        # On the same blocks, each incremental query selects the same rows as the full rebuild,
+        # restricted to the new blocks (the tables read from the tokenflow database are restricted in both).
+        full = pipeline_queries(448501, 450000)
+        incremental = pipeline_queries(448501, 450000, incremental=True)
+        for full_query, incremental_query in zip(full[:-1], incremental[:-1], strict=True):
+            self.assertEqual(select_body(incremental_query), select_body(full_query))
+        self.assertIn('block_number >= 448501 and final_proportions.block_number <= 450000', incremental[-2])
+
+    def test_incremental_results_match_full_rebuild(self):
+        # The per block tables only depend on the rows of their block, so the incremental runs merge (as the
+        # merge into final_fee_amounts_divided: the matched totals are added, the new contracts inserted)
+        # the fees of each new range into the totals, which must equal the totals of a full rebuild.
+        inputs = random_inputs(90, 15, seed=5)
+
+        def fees(start_block, end_block):
+            blocks = {name: df[df['BLOCK_NUMBER'].between(start_block, end_block)] for name, df in inputs.items()}
+            return attribute(blocks, DEFAULT_PER_STEP, DEFAULT_PER_DIFF).set_index('CONTRACT')
+
+        columns = ['L1_FEE_PER_CONTRACT', 'L2_FEE_PER_CONTRACT']
+        totals = fees(1, 40)
+        for start_block, end_block in ((41, 41), (42, 75), (76, 90)):
+            deltas = fees(start_block, end_block)
+            matched = totals.index.intersection(deltas.index)
+            totals.loc[matched, columns] += deltas.loc[matched, columns]
+            totals = pd.concat([totals, deltas.loc[deltas.index.difference(totals.index)]])
+        expected = fees(1, 90)
+        self.assertCountEqual(totals.index, expected.index)
+        np.testing.assert_allclose(totals.loc[expected.index, columns].to_numpy(), expected[columns].to_numpy(), rtol=1e-9)
+        ranking, expected_ranking = ranking_l1_l2(totals.reset_index()), ranking_l1_l2(expected.reset_index())
+        self.assertListEqual(ranking['CONTRACT'].tolist(), expected_ranking['CONTRACT'].tolist())
+
+
+class ContractKeyQueriesTests(unittest.TestCase):
+
+    def test_joins_on_contract_key(self):
+        for incremental in (False, True):
+            for query in pipeline_queries(448501, 450000, incremental=incremental):
+                self.assertNotIn('regexp_replace', query)
+                self.assertNotIn("replace(", query)
+        join = pipeline_queries(1, 100)[4]
+        self.assertIn('steps_per_contract_per_block.contract_key = diffs_per_contract_per_block.contract_key', join)
+        self.assertIn('on final_fee_amounts_divided.contract_key = deltas.contract_key', pipeline_queries(1, 100, incremental=True)[-2])
+
+    def test_backfill(self):
+        queries = backfill_queries()
+        self.assertEqual(len(queries), 4)
+        self.assertIn('alter table if exists cairo_steps_script add column if not exists contract_key binary(32)', queries[0])
+        self.assertIn('update storage_diffs_script', queries[3])
+        self.assertIn('where contract_key is null', queries[3])
+
+
 class FinalTablesTests(unittest.TestCase):
     
     @classmethod
@@ -0,0 +1,135 @@
+import glob
+import json
+import os
+import tempfile
+import unittest
+import pandas as pd
+from loader import BulkLoader
+from metrics import Metrics
+from writers import REPLACE
+
+
+class RecordingCursor:
+    """
+    Stand-in for a Snowflake cursor, which records the executed statements
+    and the number of local files uploaded by each PUT.
+    """
+
+    def __init__(self, fail_on=None):
+        self.statements = []
+        self.uploaded = []
+        self.fail_on = fail_on
+
+    def execute(self, statement):
+        statement = ' '.join(statement.split())
+        self.statements.append(statement)
+        if statement.startswith('put'):
+            self.uploaded.append(len(glob.glob(statement.split("'")[1].removeprefix('file://'))))
+        if self.fail_on and statement.startswith(self.fail_on):
+            raise RuntimeError(statement)
+        return self
+
+
+class FakeConnection:
+
+    def __init__(self, cursor):
+        self.cursor = lambda: cursor
+
+
+def batch(start: int, end: int) -> pd.DataFrame:
+    return pd.DataFrame({'BLOCK_NUMBER': list(range(start, end + 1)), 'UPDATES_PER_BLOCK': [1] * (end - start + 1)})
+
+
+class BulkLoaderTests(unittest.TestCase):
+
+    def test_single_copy_per_flush(self):
+        cursor = RecordingCursor()
+        loader = BulkLoader(FakeConnection(cursor), 'STORAGE_DIFFS_SCRIPT', flush_bytes=10**9)
+        for start in range(0, 50, 10):
+            self.assertListEqual(loader.add(batch(start, start + 9), start, start + 9), [])
+        self.assertListEqual(cursor.statements, [])
+        results = loader.close()
+        self.assertListEqual(results, [(start, start + 9, True) for start in range(0, 50, 10)])
+        self.assertListEqual(cursor.uploaded, [5])
+        self.assertEqual(sum(statement.startswith('copy into STORAGE_DIFFS_SCRIPT') for statement in cursor.statements), 1)
+        self.assertEqual(sum(statement.startswith('put') for statement in cursor.statements), 1)
+        self.assertNotIn('delete', ' '.join(cursor.statements))
+        self.assertListEqual(cursor.statements[-2:], [f'copy into STORAGE_DIFFS_SCRIPT from @{loader.stage_name} match_by_column_name = case_sensitive purge = true on_error = abort_statement ;', 'commit'])
+        self.assertFalse(os.path.exists(loader.folder))
+
+    def test_size_threshold(self):
+        cursor = RecordingCursor()
+        loader = BulkLoader(FakeConnection(cursor), 'STORAGE_DIFFS_SCRIPT', flush_bytes=1)
+        self.assertListEqual(loader.add(batch(0, 9), 0, 9), [])
+        # More rows of the same range never start a flush, so that a range is loaded at once.
+        self.assertListEqual(loader.add(batch(0, 9), 0, 9), [])
+        self.assertListEqual(loader.add(batch(10, 19), 10, 19), [(0, 9, True)])
+        self.assertListEqual(cursor.uploaded, [2])
+        self.assertListEqual(loader.close(), [(10, 19, True)])
+        self.assertEqual(loader.flushes, 2)
+
+    def test_time_threshold(self):
+        cursor = RecordingCursor()
+        loader = BulkLoader(FakeConnection(cursor), 'STORAGE_DIFFS_SCRIPT', flush_bytes=10**9, flush_seconds=0)
+        loader.add(batch(0, 9), 0, 9)
+        self.assertListEqual(loader.add(batch(10, 19), 10, 19), [(0, 9, True)])
+        loader.close()
+
+    def test_replace(self):
+        cursor = RecordingCursor()
+        loader = BulkLoader(FakeConnection(cursor), 'STORAGE_DIFFS_SCRIPT', mode=REPLACE, flush_bytes=10**9)
+        for start in (0, 10, 30):
+            loader.add(batch(start, start + 9), start, start + 9)
+        loader.close()
+        begin = cursor.statements.index('begin')
+        # The rows of the ranges are deleted, and the files loaded, in the same transaction.
+        self.assertListEqual(cursor.statements[begin:begin + 3], [
+            'begin',
+            'delete from STORAGE_DIFFS_SCRIPT where block_number >= 0 and block_number <= 19 ;',
+            'delete from STORAGE_DIFFS_SCRIPT where block_number >= 30 and block_number <= 39 ;'
+        ])
+        self.assertEqual(cursor.statements[-1], 'commit')
+
+    def test_failed_load(self):
+        cursor = RecordingCursor(fail_on='copy into')
+        loader = BulkLoader(FakeConnection(cursor), 'STORAGE_DIFFS_SCRIPT', flush_bytes=1)
+        loader.add(batch(0, 9), 0, 9)
+        self.assertListEqual(loader.add(batch(10, 19), 10, 19), [(0, 9, False)])
+        self.assertIsInstance(loader.last_error, RuntimeError)
+        self.assertListEqual(cursor.statements[-2:], ['rollback', f'remove @{loader.stage_name} ;'])
+        # The files of the failed load are not uploaded again.
+        cursor.fail_on = None
+        self.assertListEqual(loader.close(), [(10, 19, True)])
+        self.assertListEqual(cursor.uploaded, [1, 1])
+
+    def test_failed_cleanup(self):
+        cursor = RecordingCursor(fail_on=('copy into', 'remove'))
+        loader = BulkLoader(FakeConnection(cursor), 'STORAGE_DIFFS_SCRIPT', flush_bytes=1)
+        loader.add(batch(0, 9), 0, 9)
+        failed_stage = loader.stage_name
+        self.assertListEqual(loader.add(batch(10, 19), 10, 19), [(0, 9, False)])
+        self.assertIsInstance(loader.last_error, RuntimeError)
+        # The files which could not be removed are left in the stage of the failed load, and the next loads use another stage.
+        self.assertNotEqual(loader.stage_name, failed_stage)
+        cursor.fail_on = None
+        self.assertListEqual(loader.close(), [(10, 19, True)])
+        self.assertIn(f'copy into STORAGE_DIFFS_SCRIPT from @{loader.stage_name}', cursor.statements[-2])
+
+    def test_metrics(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.jsonl')
+            loader = BulkLoader(FakeConnection(RecordingCursor(fail_on='copy into')), 'STORAGE_DIFFS_SCRIPT', metrics=Metrics(path))
+            loader.add(batch(0, 9), 0, 9)
+            loader.add(batch(10, 19), 10, 19)
+            loader.close()
+            with open(path) as f:
+                record, = [json.loads(line) for line in f]
+        self.assertEqual(record['event'], 'flush')
+        self.assertEqual((record['start_block'], record['end_block'], record['ranges']), (0, 19, 2))
+        self.assertGreater(record['bytes'], 0)
+        self.assertFalse(record['success'])
+        self.assertIn('RuntimeError', record['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import json
+import os
+import tempfile
+import unittest
+from metrics import Metrics, profiled
+
+
+def records(path: str) -> list[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+class MetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'metrics.jsonl')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_records(self):
+        metrics = Metrics(self.path, 'script')
+        metrics.emit('fetch', start_block=1, end_block=100, rows=10, seconds=2.0, query_id='01ab')
+        with metrics.stage('write', 1, 100, rows=10) as fields:
+            fields['success'] = True
+        fetch, write = records(self.path)
+        self.assertEqual(fetch['script'], 'script')
+        self.assertEqual(fetch['event'], 'fetch')
+        self.assertEqual(fetch['blocks_per_second'], 50.0)
+        self.assertEqual(fetch['query_id'], '01ab')
+        self.assertGreater(fetch['peak_rss'], 0)
+        self.assertEqual(write['rows'], 10)
+        self.assertTrue(write['success'])
+        self.assertGreaterEqual(write['seconds'], 0)
+
+    def test_failed_stage(self):
+        metrics = Metrics(self.path)
+        with self.assertRaises(ValueError):
+            with metrics.stage('compute', 1, 2):
+                raise ValueError('bad trace')
+        self.assertEqual(records(self.path)[0]['error'], "ValueError('bad trace')")
+
+    def test_disabled(self):
+        with Metrics().stage('write', 1, 2) as fields:
+            fields['rows'] = 1
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_profiled(self):
+        prefix = os.path.join(self.directory.name, 'script_profile_1_2')
+        with profiled('cpu', prefix):
+            sorted(range(1000))
+        self.assertTrue(os.path.exists(prefix + '.prof'))
+        with open(prefix + '.txt') as f:
+            self.assertIn('cumulative', f.read())
+        with profiled('memory', prefix):
+            data = [bytes(1000) for _ in range(100)]
+        with open(prefix + '_memory.txt') as f:
+            self.assertTrue(f.readline().startswith('peak traced memory'))
+        with profiled(None, prefix):
+            pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,199 @@
+import os
+import tempfile
+import threading
+import unittest
+from checkpoint import COMMITTED, Manifest
+from orchestrator import CANCELLED, DONE, FAILED, SKIPPED, FingerprintStore, Stage, fingerprints, pipeline_stages, run_stages
+
+
+def stage_name(query: str) -> str:
+    """
+    Name of the stage of a query of pipeline_stages: the table it builds, or the ingestion table
+    whose contract keys it adds or fills.
+    """
+    words = query.split()
+    if words[0] == 'alter':
+        return f'{words[4]}_contract_key_column'
+    if words[0] == 'update':
+        return f'{words[1]}_contract_keys'
+    return query.split('create or replace table ')[1].split()[0]
+
+
+class RecordingConnection:
+    """
+    Stand-in for a Snowflake connection, which records the table built by each executed query,
+    and fails on the tables of 'failing'.
+    """
+
+    def __init__(self, failing=(), barrier=None):
+        self.built = []
+        self.failing = set(failing)
+        self.barrier = barrier
+        self.lock = threading.Lock()
+
+    def cursor(self):
+        return self
+
+    def execute(self, query):
+        table_name = stage_name(query)
+        if self.barrier is not None and table_name in ('block_fee', 'builtin_gas_per_block'):
+            # Both stages must be running at the same time to pass the barrier.
+            self.barrier.wait()
+        if table_name in self.failing:
+            raise RuntimeError(table_name)
+        with self.lock:
+            self.built.append(table_name)
+        return self
+
+
+class AsyncConnection:
+    """
+    Stand-in for a Snowflake connection with asynchronous queries: each query runs for 'polls' polls of its status,
+    and the queries on the tables of 'failing' end with an error.
+    """
+
+    def __init__(self, polls=2, failing=()):
+        self.polls = polls
+        self.failing = set(failing)
+        self.submitted = []
+        self.remaining = {}
+        self.max_running = 0
+
+    def cursor(self):
+        return AsyncCursor(self)
+
+    def get_query_status_throw_if_error(self, query_id):
+        self.max_running = max(self.max_running, sum(polls > 0 for polls in self.remaining.values()))
+        self.remaining[query_id] -= 1
+        if self.remaining[query_id] > 0:
+            return 'RUNNING'
+        if query_id in self.failing:
+            raise RuntimeError(query_id)
+        return 'SUCCESS'
+
+    @staticmethod
+    def is_still_running(status) -> bool:
+        return status == 'RUNNING'
+
+
+class AsyncCursor:
+
+    def __init__(self, cnx):
+        self.cnx = cnx
+        self.sfqid = None
+
+    def execute_async(self, query):
+        self.sfqid = stage_name(query)
+        self.cnx.submitted.append(self.sfqid)
+        self.cnx.remaining[self.sfqid] = self.cnx.polls
+
+
+class OrchestratorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, 'manifest.sqlite')
+        self.manifest = Manifest(path)
+        self.manifest.record('CAIRO_STEPS_SCRIPT', 1, 100, COMMITTED)
+        self.manifest.record('STORAGE_DIFFS_SCRIPT', 1, 100, COMMITTED)
+        self.store = FingerprintStore(path)
+
+    def tearDown(self):
+        self.store.close()
+        self.manifest.close()
+        self.directory.cleanup()
+
+    def run_pipeline(self, cnx, **kwargs):
+        stage_options = {key: kwargs.pop(key) for key in ('gas_per_step', 'gas_per_diff') if key in kwargs}
+        return run_stages(cnx, pipeline_stages(1, 100, self.manifest, **stage_options), self.store, log=lambda message: None, **kwargs)
+
+    def test_up_to_date_stages_are_skipped(self):
+        cnx = RecordingConnection()
+        statuses = self.run_pipeline(cnx)
+        self.assertEqual(len(cnx.built), 12)
+        self.assertTrue(all(status == DONE for status in statuses.values()))
+        # The final tables come after their upstream tables, and the contract keys are filled before they are read.
+        self.assertLess(cnx.built.index('join_steps_and_diffs'), cnx.built.index('final'))
+        for table_name, stage in (('cairo_steps_script', 'steps_per_contract_per_block'), ('storage_diffs_script', 'diffs_per_contract_per_block')):
+            self.assertLess(cnx.built.index(f'{table_name}_contract_key_column'), cnx.built.index(f'{table_name}_contract_keys'))
+            self.assertLess(cnx.built.index(f'{table_name}_contract_keys'), cnx.built.index(stage))
+        self.assertEqual(cnx.built[-1], 'final_fee_amounts_divided')
+        cnx = RecordingConnection()
+        statuses = self.run_pipeline(cnx)
+        self.assertListEqual(cnx.built, [])
+        self.assertTrue(all(status == SKIPPED for status in statuses.values()))
+        self.assertEqual(len(self.run_pipeline(cnx, force=True)), 12)
+        self.assertEqual(len(cnx.built), 12)
+
+    def test_stale_stages(self):
+        self.run_pipeline(RecordingConnection())
+        cnx = RecordingConnection()
+        self.run_pipeline(cnx, gas_per_step=0.02)
+        self.assertListEqual(cnx.built, ['final_proportions', 'final_fee_amounts_divided'])
+        # New ingested blocks make the stages which read them stale.
+        self.manifest.record('STORAGE_DIFFS_SCRIPT', 101, 200, COMMITTED)
+        cnx = RecordingConnection()
+        statuses = self.run_pipeline(cnx, gas_per_step=0.02, dry_run=True)
+        self.assertListEqual(cnx.built, [])
+        self.assertSetEqual({name for name, status in statuses.items() if status == 'stale'},
+                            {'storage_diffs_script_contract_key_column', 'storage_diffs_script_contract_keys', 'diffs_per_contract_per_block',
+                             'join_steps_and_diffs', 'final', 'final_proportions', 'final_fee_amounts_divided'})
+
+    def test_rewritten_range_is_stale(self):
+        self.run_pipeline(RecordingConnection())
+        # A rerun of an ingested range, e.g. in the REPLACE mode, does not change the committed ranges.
+        self.manifest.record('CAIRO_STEPS_SCRIPT', 1, 100, COMMITTED)
+        self.assertListEqual(self.manifest.ranges('CAIRO_STEPS_SCRIPT', COMMITTED), [(1, 100)])
+        cnx = RecordingConnection()
+        self.run_pipeline(cnx)
+        self.assertListEqual(cnx.built, ['cairo_steps_script_contract_key_column', 'cairo_steps_script_contract_keys', 'steps_per_contract_per_block',
+                                         'join_steps_and_diffs', 'final', 'final_proportions', 'final_fee_amounts_divided'])
+
+    def test_failure_cancels_downstream(self):
+        cnx = RecordingConnection(failing=['final'])
+        statuses = self.run_pipeline(cnx, jobs=3)
+        self.assertEqual(statuses['final'], FAILED)
+        self.assertEqual(statuses['final_proportions'], CANCELLED)
+        self.assertEqual(statuses['final_fee_amounts_divided'], CANCELLED)
+        self.assertEqual(statuses['builtin_gas_per_block'], DONE)
+        # Only the failed stage and its downstream stages are run again.
+        cnx = RecordingConnection()
+        self.run_pipeline(cnx)
+        self.assertListEqual(cnx.built, ['final', 'final_proportions', 'final_fee_amounts_divided'])
+
+    def test_independent_stages_run_concurrently(self):
+        cnx = RecordingConnection(barrier=threading.Barrier(2, timeout=10))
+        statuses = self.run_pipeline(cnx, jobs=2)
+        self.assertTrue(all(status == DONE for status in statuses.values()))
+
+    def test_async_queries(self):
+        cnx = AsyncConnection(polls=3)
+        statuses = self.run_pipeline(cnx, jobs=4, async_queries=True, poll_interval=0)
+        self.assertTrue(all(status == DONE for status in statuses.values()))
+        # The four stages which read no other stage are submitted at once, before the contract keys and the joins.
+        self.assertSetEqual(set(cnx.submitted[:4]), {'block_fee', 'builtin_gas_per_block', 'cairo_steps_script_contract_key_column',
+                                                     'storage_diffs_script_contract_key_column'})
+        self.assertEqual(cnx.max_running, 4)
+        self.assertSetEqual(set(cnx.submitted[4:6]), {'cairo_steps_script_contract_keys', 'storage_diffs_script_contract_keys'})
+        self.assertSetEqual(set(cnx.submitted[6:8]), {'steps_per_contract_per_block', 'diffs_per_contract_per_block'})
+        self.assertListEqual(cnx.submitted[8:], ['join_steps_and_diffs', 'final', 'final_proportions', 'final_fee_amounts_divided'])
+        cnx = AsyncConnection(failing=['diffs_per_contract_per_block'])
+        statuses = self.run_pipeline(cnx, jobs=4, async_queries=True, poll_interval=0, force=True)
+        self.assertEqual(statuses['diffs_per_contract_per_block'], FAILED)
+        self.assertEqual(statuses['join_steps_and_diffs'], CANCELLED)
+        self.assertEqual(statuses['builtin_gas_per_block'], DONE)
+
+    def test_fingerprints(self):
+        stages = [Stage('a', 'select 1'), Stage('b', 'select * from a', ['a'])]
+        reformatted = [Stage('a', 'select\n    1'), Stage('b', 'select * from a', ['a'])]
+        changed = [Stage('a', 'select 2'), Stage('b', 'select * from a', ['a'])]
+        self.assertDictEqual(fingerprints(stages), fingerprints(reformatted))
+        self.assertNotEqual(fingerprints(stages)['b'], fingerprints(changed)['b'])
+        with self.assertRaises(ValueError):
+            fingerprints([Stage('a', 'select 1', ['b']), Stage('b', 'select 1', ['a'])])
+        with self.assertRaises(ValueError):
+            fingerprints([Stage('a', 'select 1', ['c'])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import threading
+import time
+import unittest
+from pipeline import run_pipeline
+
+
+class PipelineTests(unittest.TestCase):
+
+    def test_order_and_timing(self):
+        batches = [(i, i + 9) for i in range(0, 100, 10)]
+        written = []
+        timer = run_pipeline(
+            batches,
+            fetch=lambda start, end: list(range(start, end + 1)),
+            compute=lambda start, end, data: sum(data),
+            write=lambda start, end, total: written.append((start, total)),
+            queue_depth=1
+        )
+        self.assertListEqual(written, [(start, sum(range(start, end + 1))) for start, end in batches])
+        self.assertDictEqual(timer.batches, {'fetch': 10, 'compute': 10, 'write': 10})
+        self.assertIn('bottleneck', timer.report())
+
+    def test_bounded_queues(self):
+        lock = threading.Lock()
+        in_memory = [0, 0] # Current and maximal number of fetched batches not written yet.
+
+        def fetch(start, end):
+            with lock:
+                in_memory[0] += 1
+                in_memory[1] = max(in_memory[1], in_memory[0])
+            return start
+
+        def write(start, end, data):
+            time.sleep(0.005)
+            with lock:
+                in_memory[0] -= 1
+
+        run_pipeline([(i, i) for i in range(30)], fetch, lambda start, end, data: data, write, queue_depth=2)
+        # At most: one batch in each queue, one being fetched, computed and written, plus one extra per queue.
+        self.assertLessEqual(in_memory[1], 2 * 2 + 3)
+
+    def test_errors(self):
+        def failing(start, end, *args):
+            if start == 3:
+                raise ValueError(start)
+
+        for stage in ('fetch', 'compute', 'write'):
+            functions = {
+                'fetch': lambda start, end: None,
+                'compute': lambda start, end, data: None,
+                'write': lambda start, end, data: None
+            }
+            functions[stage] = failing
+            with self.assertRaises(ValueError):
+                run_pipeline([(i, i) for i in range(20)], **functions, queue_depth=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+import pandas as pd
+from scheduling import AdaptiveWindow
+
+
+class AdaptiveWindowTests(unittest.TestCase):
+
+    def test_windows_cover_the_range(self):
+        scheduler = AdaptiveWindow(initial=7)
+        windows = list(scheduler.windows(1, 30))
+        self.assertListEqual(windows, [(1, 7), (8, 14), (15, 21), (22, 28), (29, 30)])
+
+    def test_grows_on_sparse_blocks(self):
+        scheduler = AdaptiveWindow(initial=100, target_rows=10000, target_seconds=1000)
+        sizes = []
+        for start, end in scheduler.windows(1, 100000):
+            scheduler.observe(start, end, rows=10 * (end - start + 1), seconds=0.01)
+            sizes.append(end - start + 1)
+        # The growth between two windows is bounded, until the target of 1000 blocks is reached.
+        self.assertListEqual(sizes[:3], [100, 400, 1000])
+        self.assertEqual(scheduler.size, 1000)
+
+    def test_shrinks_on_dense_blocks(self):
+        scheduler = AdaptiveWindow(initial=1000, target_rows=10000, target_seconds=1000)
+        scheduler.observe(1, 1000, rows=1000000, seconds=1)
+        self.assertEqual(scheduler.size, 250)
+        scheduler.observe(1001, 1250, rows=250000, seconds=1)
+        self.assertEqual(scheduler.size, 62)
+
+    def test_latency_target(self):
+        scheduler = AdaptiveWindow(initial=100, target_rows=10**9, target_seconds=10)
+        # 100 rows per block, fetched at 1000 rows per second: 100 blocks take 10 seconds.
+        scheduler.observe(1, 100, rows=10000, seconds=10)
+        self.assertEqual(scheduler.size, 100)
+
+    def test_empty_blocks(self):
+        scheduler = AdaptiveWindow(initial=10, max_window=30)
+        scheduler.observe(1, 10, rows=0, seconds=0.1)
+        self.assertEqual(scheduler.size, 30)
+
+    def test_probe(self):
+        scheduler = AdaptiveWindow(initial=100, target_rows=100)
+        probed = []
+
+        def probe(start, end):
+            probed.append((start, end))
+            return 10 * (end - start + 1)
+
+        windows = list(scheduler.windows(1, 25, probe))
+        # The first window of 100 blocks has 250 rows, more than twice the target: it is shrunk to 10 blocks.
+        self.assertListEqual(windows, [(1, 10), (11, 20), (21, 25)])
+        self.assertListEqual(probed[:2], [(1, 25), (1, 10)])
+
+    def test_log(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'windows.csv')
+            scheduler = AdaptiveWindow(initial=10, target_rows=100, log_path=path)
+            scheduler.observe(1, 10, rows=500, seconds=2.0)
+            scheduler.observe(11, 12, rows=100, seconds=0.5)
+            log = pd.read_csv(path)
+        self.assertListEqual(log['start_block'].tolist(), [1, 11])
+        self.assertListEqual(log['next_window'].tolist(), [2, 2])
+        self.assertListEqual(log['decision'].tolist(), ['rows', 'rows'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import tempfile
+import time
+import unittest
+from email.utils import formatdate
+from unittest import mock
+from aiohttp import web
+from aiohttp.test_utils import TestServer as StubServer
+from starkscan_query import ERROR, StarkscanResolver, TagCache, retry_after
+
+
+class StubStarkscan:
+    """
+    Local stand-in for the Starkscan API. The first requests of the addresses of 'rate_limited'
+    are answered with 429 and a Retry-After header, and the unknown addresses with 404.
+    """
+
+    def __init__(self, tags, rate_limited=None, failing=()):
+        self.tags = tags
+        self.rate_limited = dict(rate_limited or {})
+        self.failing = set(failing)
+        self.retry_after = '0'
+        self.requests = []
+        self.api_keys = set()
+
+    async def handle(self, request):
+        address = request.match_info['address']
+        self.requests.append(address)
+        self.api_keys.add(request.headers.get('x-api-key'))
+        if address in self.failing:
+            return web.Response(status=503)
+        if self.rate_limited.get(address, 0) > 0:
+            self.rate_limited[address] -= 1
+            return web.Response(status=429, headers={'Retry-After': self.retry_after})
+        if address not in self.tags:
+            return web.Response(status=404)
+        return web.json_response({'address': address, 'name_tag': self.tags[address]})
+
+
+def padded(address: str) -> str:
+    return '0x' + address[2:].zfill(64)
+
+
+class RetryAfterTests(unittest.TestCase):
+
+    def test_retry_after(self):
+        self.assertEqual(retry_after(mock.Mock(headers={'Retry-After': '3'})), 3.0)
+        self.assertAlmostEqual(retry_after(mock.Mock(headers={'Retry-After': formatdate(time.time() + 60, usegmt=True)})), 60, delta=2)
+        self.assertIsNone(retry_after(mock.Mock(headers={})))
+        self.assertIsNone(retry_after(mock.Mock(headers={'Retry-After': 'soon'})))
+
+
+class StarkscanResolverTests(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.stub = StubStarkscan(
+            {padded('0x1'): 'One', padded('0x2'): 'Two', padded('0x3'): None},
+            rate_limited={padded('0x2'): 2},
+            failing=[padded('0x5')]
+        )
+        app = web.Application()
+        app.router.add_get('/api/v0/contract/{address}', self.stub.handle)
+        self.server = StubServer(app)
+        await self.server.start_server()
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.directory.name, 'cache.sqlite')
+
+    async def asyncTearDown(self):
+        await self.server.close()
+        self.directory.cleanup()
+
+    def resolver(self, cache, **kwargs) -> StarkscanResolver:
+        url = str(self.server.make_url('/api/v0/contract/'))
+        return StarkscanResolver('key', cache=cache, url=url, base_delay=0, **kwargs)
+
+    async def test_resolve(self):
+        resolver = self.resolver(None, max_retries=2)
+        tags = await resolver.resolve(['0x0001', '0x2', '0x3', '0x4', '0x5', '0x1'])
+        self.assertDictEqual(tags, {'0x1': 'One', '0x2': 'Two', '0x3': None, '0x4': ERROR, '0x5': ERROR})
+        # The rate limited address is retried, and the failing one until the retries are exhausted.
+        self.assertEqual(self.stub.requests.count(padded('0x2')), 3)
+        self.assertEqual(self.stub.requests.count(padded('0x5')), 3)
+        self.assertEqual(self.stub.requests.count(padded('0x1')), 1)
+        self.assertEqual(resolver.retries, 4)
+        self.assertSetEqual(self.stub.api_keys, {'key'})
+
+    async def test_cache(self):
+        cache = TagCache(self.cache_path)
+        await self.resolver(cache, max_retries=2).resolve(['0x1', '0x2', '0x4', '0x5'])
+        cache.close()
+        self.stub.requests.clear()
+        cache = TagCache(self.cache_path)
+        tags = await self.resolver(cache, max_retries=0).resolve(['0x1', '0x2', '0x3', '0x4', '0x5'])
+        cache.close()
+        # Only the new address, and the one which failed, are requested again: the unknown address is cached.
+        self.assertListEqual(sorted(self.stub.requests), [padded('0x3'), padded('0x5')])
+        self.assertDictEqual(tags, {'0x1': 'One', '0x2': 'Two', '0x3': None, '0x4': ERROR, '0x5': ERROR})
+
+    async def test_retry_after_is_capped(self):
+        self.stub.rate_limited = {padded('0x1'): 1}
+        self.stub.retry_after = '86400'
+        resolver = self.resolver(None, max_delay=0.01)
+        started_at = time.monotonic()
+        self.assertDictEqual(await resolver.resolve(['0x1']), {'0x1': 'One'})
+        self.assertLess(time.monotonic() - started_at, 5)
+
+    async def test_stale_tags(self):
+        cache = TagCache(self.cache_path, ttl=60)
+        cache.store('0x1', 'Old')
+        cache.connection.execute('update tags set resolved_at = ?', (time.time() - 120,))
+        tags = await self.resolver(cache).resolve(['0x1'])
+        self.assertDictEqual(tags, {'0x1': 'One'})
+        self.assertDictEqual(cache.fresh(['0x1']), {'0x1': 'One'})
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+import asyncio
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+import pandas as pd
+from fetcher import StateUpdateFetcher
+from scheduling import AdaptiveWindow
+from state_cache import StateCache, state_diff_batches
+
+
+def state_update(block: int):
+    """
+    State update with the contracts 1 to block % 3 (none when block % 3 == 0), and a diff without storage entries.
+    """
+    diffs = [SimpleNamespace(address=contract, storage_entries=[0] * (block + contract)) for contract in range(1, block % 3 + 1)]
+    diffs.append(SimpleNamespace(address=99, storage_entries=[]))
+    return SimpleNamespace(state_diff=SimpleNamespace(storage_diffs=diffs))
+
+
+def expected_rows(blocks) -> list[tuple]:
+    return [(block, hex(contract), block + contract) for block in blocks for contract in range(1, block % 3 + 1)]
+
+
+class FakeClient:
+    """
+    Stand-in for FullNodeClient which records the requested blocks, always times out on the blocks of 'failing',
+    and never answers for the blocks after 'last_block' (if it is given).
+    """
+
+    def __init__(self, failing=(), last_block=None):
+        self.failing = set(failing)
+        self.last_block = last_block
+        self.requested = []
+
+    async def get_state_update(self, block_number):
+        self.requested.append(block_number)
+        if self.last_block is not None and block_number > self.last_block:
+            await asyncio.Event().wait()
+        if block_number in self.failing:
+            raise asyncio.TimeoutError()
+        return state_update(block_number)
+
+
+def rows(df: pd.DataFrame) -> list[tuple]:
+    return list(df.itertuples(index=False, name=None))
+
+
+class StateCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = StateCache(self.directory.name, chunk_size=10)
+
+    def tearDown(self):
+        self.cache.close()
+        self.directory.cleanup()
+
+    def test_store_and_load(self):
+        df = pd.DataFrame(expected_rows(range(5, 26)), columns=['BLOCK_NUMBER', 'CONTRACT', 'UPDATES_PER_BLOCK'])
+        self.cache.store(df, 5, 25)
+        self.assertListEqual(rows(self.cache.load(8, 21)), expected_rows(range(8, 22)))
+        self.assertListEqual(self.cache.missing_ranges(1, 30), [(1, 4), (26, 30)])
+        stats = self.cache.stats()
+        self.assertEqual(stats['files'], 3)
+        self.assertEqual(stats['rows'], len(df))
+        self.assertEqual(stats['blocks'], 21)
+        self.assertListEqual(stats['ranges'], [(5, 25)])
+
+    def test_store_replaces_rows(self):
+        df = pd.DataFrame(expected_rows(range(0, 10)), columns=['BLOCK_NUMBER', 'CONTRACT', 'UPDATES_PER_BLOCK'])
+        self.cache.store(df, 0, 9)
+        self.cache.store(df, 3, 4)
+        self.assertListEqual(rows(self.cache.load(0, 9)), expected_rows(range(0, 10)))
+
+    def test_chunk_written_once(self):
+        df = pd.DataFrame(expected_rows(range(0, 25)), columns=['BLOCK_NUMBER', 'CONTRACT', 'UPDATES_PER_BLOCK'])
+        with mock.patch.object(pd.DataFrame, 'to_parquet', autospec=True, side_effect=pd.DataFrame.to_parquet) as write:
+            for start in range(0, 25, 2):
+                self.cache.store(df, start, min(start + 1, 24))
+            # Only the two complete chunks are written, and the buffered blocks are not recorded yet.
+            self.assertEqual(write.call_count, 2)
+            self.assertListEqual(self.cache.missing_ranges(0, 30), [(25, 30)])
+            self.assertListEqual(self.cache.cached_ranges(), [(0, 19)])
+            with mock.patch.object(pd, 'read_parquet', side_effect=pd.read_parquet) as read:
+                for start in range(0, 10, 2):
+                    self.assertListEqual(rows(self.cache.load(start, start + 1)), expected_rows(range(start, start + 2)))
+                self.assertEqual(read.call_count, 1)
+            self.cache.close()
+            self.assertEqual(write.call_count, 3)
+        cache = StateCache(self.directory.name, chunk_size=10)
+        self.assertListEqual(cache.cached_ranges(), [(0, 24)])
+        self.assertListEqual(rows(cache.load(0, 24)), expected_rows(range(0, 25)))
+        cache.close()
+
+    def test_empty(self):
+        self.assertEqual(len(self.cache.load(0, 100)), 0)
+        self.assertListEqual(list(self.cache.load(0, 100).columns), ['BLOCK_NUMBER', 'CONTRACT', 'UPDATES_PER_BLOCK'])
+
+
+class StateDiffBatchesTests(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = StateCache(self.directory.name, chunk_size=10)
+
+    def tearDown(self):
+        self.cache.close()
+        self.directory.cleanup()
+
+    async def collect(self, client, cache, start_block, end_block):
+        fetcher = StateUpdateFetcher(client, max_retries=0, base_delay=0)
+        return [batch async for batch in state_diff_batches(fetcher, cache, start_block, end_block, 4)]
+
+    async def test_without_cache(self):
+        client = FakeClient(failing=[3])
+        batches = await self.collect(client, None, 1, 10)
+        self.assertListEqual([(start, end) for start, end, _, _ in batches], [(1, 4), (5, 8), (9, 10)])
+        self.assertListEqual([row for _, _, df, _ in batches for row in rows(df)], expected_rows([1, 2, 4, 5, 6, 7, 8, 9, 10]))
+        self.assertListEqual([failures for _, _, _, failures in batches], [[(3, 3)], [], []])
+
+    async def test_cached_blocks_are_not_fetched(self):
+        await self.collect(FakeClient(failing=[3]), self.cache, 1, 12)
+        self.assertListEqual(self.cache.missing_ranges(1, 20), [(3, 3), (13, 20)])
+        client = FakeClient()
+        batches = await self.collect(client, self.cache, 1, 15)
+        # Only the failed block and the new blocks are fetched.
+        self.assertListEqual(sorted(client.requested), [3, 13, 14, 15])
+        self.assertListEqual([(start, end) for start, end, _, _ in batches], [(1, 2), (3, 3), (4, 7), (8, 11), (12, 12), (13, 15)])
+        self.assertListEqual([row for _, _, df, _ in batches for row in rows(df)], expected_rows(range(1, 16)))
+        self.assertListEqual(self.cache.missing_ranges(1, 20), [(16, 20)])
+
+    async def test_adaptive_windows_are_prefetched(self):
+        await self.collect(FakeClient(), self.cache, 5, 8)
+        client = FakeClient()
+        fetcher = StateUpdateFetcher(client, concurrency=2, max_retries=0, base_delay=0)
+        scheduler = AdaptiveWindow(initial=3, target_rows=6, target_seconds=1000)
+        batches = state_diff_batches(fetcher, self.cache, 1, 20, 4, scheduler)
+        start, end, df, _ = await anext(batches)
+        self.assertEqual((start, end), (1, 3))
+        # The next window is fetched while the first one is consumed.
+        self.assertIn(4, client.requested)
+        scheduler.observe(start, end, len(df), 0.1)
+        consumed = [(start, end, df)]
+        async for start, end, df, _ in batches:
+            scheduler.observe(start, end, len(df), 0.1)
+            consumed.append((start, end, df))
+        self.assertListEqual([row for _, _, df in consumed for row in rows(df)], expected_rows(range(1, 21)))
+        self.assertListEqual([start for start, _, _ in consumed[1:]], [end + 1 for _, end, _ in consumed[:-1]])
+        # The cached blocks are not fetched again.
+        self.assertNotIn(5, client.requested)
+        self.assertGreater(len({end - start for start, end, _ in consumed}), 1)
+
+    async def test_early_close_cancels_requests(self):
+        fetcher = StateUpdateFetcher(FakeClient(last_block=4), concurrency=8, max_retries=0, base_delay=0)
+        batches = state_diff_batches(fetcher, self.cache, 1, 100, 4)
+        await anext(batches)
+        self.assertGreater(len(asyncio.all_tasks()), 1)
+        await batches.aclose()
+        self.assertSetEqual(asyncio.all_tasks(), {asyncio.current_task()})
+
+
+if __name__ == '__main__':
+    unittest.main()
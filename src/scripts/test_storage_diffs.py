@@ -1,5 +1,7 @@
 import pandas as pd
+from storage_diffs_script import write_parts
 from utils import get_connection
+from writers import APPEND, REPLACE
 import unittest
 
 
@@ -7,6 +9,18 @@ MAX_BLOCK = 448500
 MIN_BLOCK = 1
 
 
+class WritePartsTests(unittest.TestCase):
+
+    def test_append(self):
+        self.assertListEqual(write_parts(1, 100, [(7, 7)], APPEND), [(1, 100, [(7, 7)])])
+
+    def test_replace_keeps_failed_blocks(self):
+        # The rows of the blocks which failed to be fetched must not be deleted.
+        self.assertListEqual(write_parts(1, 100, [(1, 1), (7, 7), (50, 50)], REPLACE), [(2, 6, []), (8, 49, []), (51, 100, [])])
+        self.assertListEqual(write_parts(1, 100, [], REPLACE), [(1, 100, [])])
+        self.assertListEqual(write_parts(7, 7, [(7, 7)], REPLACE), [])
+
+
 class TableScriptTests(unittest.TestCase):
     
     @classmethod
@@ -0,0 +1,45 @@
+import unittest
+import numpy as np
+import pandas as pd
+from attribution import attribute, ranking_l1_l2
+from sweep import compare, scenario_grid, sweep
+from test_attribution import random_inputs
+
+
+class SweepTests(unittest.TestCase):
+
+    def setUp(self):
+        self.inputs = random_inputs(150, 25, seed=2)
+        self.scenarios = scenario_grid([0.01, 0.05], [1024, 256], [1, 3])
+
+    def test_grid(self):
+        self.assertEqual(len(self.scenarios), 8)
+        self.assertListEqual(list(self.scenarios.iloc[0]), [0.01, 1024, 1])
+
+    def test_matches_attribution(self):
+        # Small chunks, so that the rows of some contracts are summed over several chunks.
+        contracts, l1, l2 = sweep(self.inputs, self.scenarios, chunk_rows=97)
+        for scenario, (gas_per_step, gas_per_diff, builtin_scale) in enumerate(self.scenarios.itertuples(index=False)):
+            inputs = dict(self.inputs)
+            inputs['builtin_gas'] = inputs['builtin_gas'].assign(BUILTIN_GAS=inputs['builtin_gas']['BUILTIN_GAS'] * builtin_scale)
+            expected = attribute(inputs, gas_per_step, gas_per_diff).set_index('CONTRACT').loc[contracts]
+            np.testing.assert_allclose(l1[scenario], expected['L1_FEE_PER_CONTRACT'], rtol=1e-9)
+            np.testing.assert_allclose(l2[scenario], expected['L2_FEE_PER_CONTRACT'], rtol=1e-9)
+
+    def test_compare(self):
+        contracts, l1, l2 = sweep(self.inputs, self.scenarios)
+        comparison = compare(contracts, l1, l2, self.scenarios, top=5)
+        for scenario, df in comparison.groupby('SCENARIO'):
+            ranking = ranking_l1_l2(pd.DataFrame({'CONTRACT': contracts, 'L1_FEE_PER_CONTRACT': l1[scenario], 'L2_FEE_PER_CONTRACT': l2[scenario]}), size=5)
+            self.assertListEqual(list(df['CONTRACT'].head(5)), list(ranking['CONTRACT']))
+            self.assertListEqual(list(df['RANK'].head(5)), [1, 2, 3, 4, 5])
+        baseline = comparison[comparison['SCENARIO'] == 0]
+        self.assertTrue((baseline['RANK_CHANGE'] == 0).all())
+        self.assertTrue((baseline['FEE_CHANGE'] == 0).all())
+        # The same contracts are compared in every scenario.
+        self.assertEqual(len(comparison), len(baseline) * len(self.scenarios))
+        self.assertTrue((comparison['BASELINE_RANK'] - comparison['RANK'] == comparison['RANK_CHANGE']).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import pandas as pd
+from tags import TagIndex
+
+
+class TagIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index = TagIndex(pd.Series(['0x0abc', '0x12', '0xABC']), pd.Series(['first', 'second', 'duplicate']))
+
+    def test_lookup_ignores_padding_and_case(self):
+        result = self.index.lookup(['0xabc', '0x0000012', '0xAbC'])
+        self.assertListEqual(list(result), ['first', 'second', 'first'])
+
+    def test_lookup_default(self):
+        result = self.index.lookup(pd.Series(['0x12', '0x34'], index=[5, 7]), default=0)
+        self.assertListEqual(list(result), ['second', 0])
+        self.assertListEqual(list(result.index), [5, 7])
+
+    def test_first_duplicate_wins(self):
+        self.assertEqual(len(self.index), 2)
+
+    def test_sources(self):
+        with tempfile.TemporaryDirectory() as directory:
+            names_path = os.path.join(directory, 'names.csv')
+            allocations_path = os.path.join(directory, 'allocations.csv')
+            pd.DataFrame({'CONTRACT': ['0x1', '0x2'], 'NAMES': ['one', None]}).to_csv(names_path)
+            pd.DataFrame({'ADDRESS': ['0x02', '0x001', '0x3'], 'AMOUNT': [1.0, 2.0, 3.0], 'TAG': ['two', 'other', 'three']}).to_csv(allocations_path, index=False)
+            sources = {'names': (names_path, 'CONTRACT', 'NAMES'), 'allocations': (allocations_path, 'ADDRESS', 'TAG')}
+            with mock.patch.dict('tags.TAG_SOURCES', sources):
+                index = TagIndex.from_sources()
+        # The names take precedence, and the addresses without a name are tagged from the allocations.
+        self.assertListEqual(list(index.lookup(['0x1', '0x2', '0x3', '0x4'])), ['one', 'two', 'three', None])
+
+
+if __name__ == '__main__':
+    unittest.main()
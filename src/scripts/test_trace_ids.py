@@ -0,0 +1,96 @@
+import random
+import unittest
+import numpy as np
+import pyarrow as pa
+from cairo_steps_script import ArrayTree, Tree
+from trace_ids import FEE, PAD, VALIDATE, TraceIds
+
+
+class TraceIdsTests(unittest.TestCase):
+
+    def test_from_strings(self):
+        trace_ids = TraceIds.from_strings(['10_7', '10_7_v', '9_12_f_0'])
+        self.assertListEqual(trace_ids.codes.tolist(), [
+            [10, 7, PAD, PAD],
+            [10, 7, VALIDATE, PAD],
+            [9, 12, FEE, 0]
+        ])
+        self.assertListEqual(trace_ids.depth.tolist(), [2, 3, 4])
+        self.assertListEqual(trace_ids.to_strings(), ['10_7', '10_7_v', '9_12_f_0'])
+        self.assertListEqual(trace_ids.codes.tolist(), TraceIds.from_tuples(trace_ids.to_tuples()).codes.tolist())
+        chunked = TraceIds.from_strings(['10_7', '10_7_v', '9_12_f_0'], chunk_size=2)
+        self.assertListEqual(chunked.codes.tolist(), trace_ids.codes.tolist())
+
+    def test_from_arrow(self):
+        strings = ['10_7', '10_7_v', '9_12_f_0', '123456_0_11']
+        for array in (pa.array(strings), pa.chunked_array([strings[:1], strings[1:]])):
+            trace_ids = TraceIds.from_arrow(array)
+            expected = TraceIds.from_strings(strings)
+            self.assertListEqual(trace_ids.codes.tolist(), expected.codes.tolist())
+            self.assertListEqual(trace_ids.depth.tolist(), expected.depth.tolist())
+        self.assertEqual(len(TraceIds.from_arrow(pa.array([], pa.string()))), 0)
+        for invalid in (['10_7', '10_x'], ['10__7'], ['10_7', None]):
+            with self.assertRaises(ValueError):
+                TraceIds.from_arrow(pa.array(invalid, pa.string()))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            TraceIds.from_strings(['10_7', '10_x'])
+        with self.assertRaises(ValueError):
+            TraceIds.from_strings(['10__7'])
+
+    def test_out_of_range(self):
+        # The numbers which would wrap in int32, or collide with the codes of 'f' and 'v', are rejected.
+        for invalid in ('1_99999999999', '1_2147483646', '1_2147483647', '1_' + '9' * 30):
+            with self.assertRaises(ValueError):
+                TraceIds.from_strings(['10_7', invalid])
+            with self.assertRaises(ValueError):
+                TraceIds.from_arrow(pa.array(['10_7', invalid]))
+            with self.assertRaises(ValueError):
+                TraceIds.from_tuples([invalid.split('_')])
+        largest = f'1_{FEE - 1}_0000000000000000000000001'
+        self.assertListEqual(TraceIds.from_strings([largest]).codes.tolist(), [[1, FEE - 1, 1]])
+        self.assertListEqual(TraceIds.from_arrow(pa.array([largest])).codes.tolist(), [[1, FEE - 1, 1]])
+
+    def test_numeric_sort(self):
+        trace_ids = TraceIds.from_strings(['10_7_10', '10_7_f', '10_7', '9_1', '10_7_9', '10_7_v', '10_7_9_0'])
+        sorted_ids = trace_ids.take(trace_ids.sort_order())
+        self.assertListEqual(sorted_ids.to_strings(), ['9_1', '10_7', '10_7_9', '10_7_9_0', '10_7_10', '10_7_f', '10_7_v'])
+        keys = sorted_ids.sort_key()
+        self.assertListEqual(list(np.argsort(keys, kind='stable')), list(range(len(keys))))
+
+    def test_empty(self):
+        for trace_ids in (TraceIds.from_strings([]), TraceIds.from_arrow(pa.array([], pa.string()))):
+            self.assertListEqual(trace_ids.sort_order().tolist(), [])
+            self.assertEqual(len(trace_ids.take(trace_ids.sort_order())), 0)
+            self.assertListEqual(trace_ids.parents().tolist(), [])
+
+    def test_parents(self):
+        trace_ids = TraceIds.from_strings(['10_7', '10_7_0', '10_7_0_3', '10_7_v', '10_8_1', '10_7_10'])
+        self.assertListEqual(trace_ids.parents().tolist(), [-1, 0, 1, 0, -1, 0])
+        self.assertListEqual(trace_ids.is_validate_or_fee().tolist(), [False, False, False, True, False, False])
+
+    def test_tree_equivalence(self):
+        rng = random.Random(1)
+        for _ in range(20):
+            nodes = set()
+            for tx in range(rng.randint(1, 15)):
+                frontier = [(str(rng.randint(1, 12)), str(tx))]
+                for suffix in ('v', 'f'):
+                    frontier.append(frontier[0] + (suffix,))
+                for _ in range(rng.randint(0, 40)):
+                    frontier.append(rng.choice(frontier) + (str(rng.randint(0, 11)),))
+                nodes.update(node for node in frontier if rng.random() < 0.95)
+            steps = {node: rng.randint(0, 10000) for node in nodes}
+            # The reference Tree receives the tuples in lexicographic order.
+            reference = Tree([(node, steps[node]) for node in sorted(nodes)])
+            reference.infer_all()
+            trace_ids = TraceIds.from_strings('_'.join(node) for node in nodes)
+            trace_ids = trace_ids.take(trace_ids.sort_order())
+            array_tree = ArrayTree.from_trace_ids(trace_ids, [steps[node] for node in trace_ids.to_tuples()])
+            array_tree.infer_all()
+            self.assertDictEqual(array_tree.dict_steps, reference.dict_steps)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from attribution import attribute, load_inputs, ranking_l1_l2
+from test_attribution import random_inputs
+from verify import diff_published, input_block_range, merge_fees, read_published, recompute
+
+
+class VerifyTests(unittest.TestCase):
+
+    def setUp(self):
+        self.inputs = random_inputs(120, 20, seed=3)
+        self.directory = tempfile.TemporaryDirectory()
+        self.folder = self.directory.name
+        for name, df in self.inputs.items():
+            df.to_parquet(os.path.join(self.folder, f'{name}.parquet'), index=False)
+        self.expected = attribute(self.inputs, 0.01, 1024).set_index('CONTRACT').sort_index()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def assertFeesEqual(self, fees: pd.DataFrame, expected: pd.DataFrame):
+        fees = fees.set_index('CONTRACT').sort_index()
+        self.assertListEqual(list(fees.index), list(expected.index))
+        for column in ('L1_FEE_PER_CONTRACT', 'L2_FEE_PER_CONTRACT'):
+            np.testing.assert_allclose(fees[column].to_numpy(), expected[column].to_numpy(), rtol=1e-9)
+
+    def test_load_block_range(self):
+        inputs = load_inputs(self.folder, 10, 19)
+        self.assertTrue(all(df['BLOCK_NUMBER'].between(10, 19).all() for df in inputs.values()))
+        self.assertEqual(len(inputs['steps']), self.inputs['steps']['BLOCK_NUMBER'].between(10, 19).sum())
+        self.assertEqual(input_block_range(self.folder), (1, 120))
+
+    def test_shards_add_up(self):
+        start, end = input_block_range(self.folder)
+        self.assertFeesEqual(recompute(self.folder, start, end, 0.01, 1024, shard_size=17), self.expected)
+        self.assertFeesEqual(recompute(self.folder, start, end, 0.01, 1024, workers=2, shard_size=25), self.expected)
+
+    def test_merge_no_shards(self):
+        self.assertEqual(len(merge_fees([])), 0)
+
+    def test_diff_published(self):
+        ranking = ranking_l1_l2(self.expected.reset_index())
+        path = os.path.join(self.folder, 'fee_amounts_v1.csv')
+        # The published addresses are padded, the second one is off, and the third one is missing.
+        published = ranking.drop(index=2).assign(CONTRACT=lambda df: '0x000' + df['CONTRACT'].str[2:])
+        published.loc[1, 'FEE_PER_CONTRACT'] += 1e-6
+        published.to_csv(path)
+        comparison = diff_published(read_published(path), self.expected.reset_index(), tolerance=1e-9)
+        mismatches = comparison[comparison['MISMATCH']]
+        self.assertCountEqual(mismatches['ADDRESS'], ranking.loc[[1, 2], 'CONTRACT'])
+        self.assertEqual(len(comparison), len(ranking))
+        missing = comparison.set_index('ADDRESS').loc[ranking.at[2, 'CONTRACT']]
+        self.assertTrue(np.isnan(missing['PUBLISHED']))
+        # The allocations are a share of the fees, with another column.
+        allocations = pd.DataFrame({'ADDRESS': ranking['CONTRACT'], 'AMOUNT': ranking['FEE_PER_CONTRACT'] * 0.1, 'TAG': None})
+        allocations.to_csv(path, index=False)
+        comparison = diff_published(read_published(path), self.expected.reset_index(), scale=0.1)
+        self.assertFalse(comparison['MISMATCH'].any())
+        with self.assertRaises(ValueError):
+            read_published(path, amount_column='FEE_PER_CONTRACT')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+from unittest import mock
+import pandas as pd
+from writers import APPEND, REPLACE, add_contract_key, write_range
+
+
+class RecordingCursor:
+    """
+    Stand-in for a Snowflake cursor, which records the executed statements.
+    """
+
+    def __init__(self, fail_on=None):
+        self.statements = []
+        self.fail_on = fail_on
+
+    def execute(self, statement):
+        statement = ' '.join(statement.split())
+        self.statements.append(statement)
+        if self.fail_on and statement.startswith(self.fail_on):
+            raise RuntimeError(statement)
+        return self
+
+
+class WriteRangeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.DataFrame({'BLOCK_NUMBER': [10, 11], 'CONTRACT': ['0x1', '0x2'], 'UPDATES_PER_BLOCK': [1, 2]})
+
+    def test_append(self):
+        cnx = mock.Mock()
+        with mock.patch('writers.write_pandas', return_value=(True, 1, 2, None)) as write:
+            self.assertTrue(write_range(cnx, self.df, 'STORAGE_DIFFS_SCRIPT', 10, 19, mode=APPEND))
+        self.assertEqual(write.call_args.args[2], 'STORAGE_DIFFS_SCRIPT')
+        cnx.cursor.assert_not_called()
+
+    def test_replace(self):
+        cursor = RecordingCursor()
+        cnx = mock.Mock(cursor=lambda: cursor)
+        with mock.patch('writers.write_pandas', return_value=(True, 1, 2, None)) as write:
+            self.assertTrue(write_range(cnx, self.df, 'STORAGE_DIFFS_SCRIPT', 10, 19, mode=REPLACE))
+        staging_table = write.call_args.args[2]
+        self.assertTrue(staging_table.startswith('STORAGE_DIFFS_SCRIPT_STAGING_'))
+        self.assertEqual(write.call_args.kwargs['table_type'], 'temporary')
+        self.assertListEqual(cursor.statements, [
+            f'create table if not exists STORAGE_DIFFS_SCRIPT like {staging_table} ;',
+            'begin',
+            'delete from STORAGE_DIFFS_SCRIPT where block_number >= 10 and block_number <= 19 ;',
+            f'insert into STORAGE_DIFFS_SCRIPT ("BLOCK_NUMBER", "CONTRACT", "UPDATES_PER_BLOCK") '
+            f'select "BLOCK_NUMBER", "CONTRACT", "UPDATES_PER_BLOCK" from {staging_table} ;',
+            'commit',
+            f'drop table if exists {staging_table}'
+        ])
+
+    def test_replace_rollback(self):
+        cursor = RecordingCursor(fail_on='insert')
+        cnx = mock.Mock(cursor=lambda: cursor)
+        with mock.patch('writers.write_pandas', return_value=(True, 1, 2, None)):
+            with self.assertRaises(RuntimeError):
+                write_range(cnx, self.df, 'STORAGE_DIFFS_SCRIPT', 10, 19, mode=REPLACE)
+        self.assertEqual(cursor.statements[-2], 'rollback')
+        self.assertTrue(cursor.statements[-1].startswith('drop table'))
+        self.assertNotIn('commit', cursor.statements)
+
+    def test_add_contract_key(self):
+        # The tables ingested before the contract keys are altered, and the missing tables are left to the first write.
+        cursor = RecordingCursor()
+        add_contract_key(mock.Mock(cursor=lambda: cursor), 'STORAGE_DIFFS_SCRIPT')
+        self.assertListEqual(cursor.statements, ['alter table if exists STORAGE_DIFFS_SCRIPT add column if not exists contract_key binary(32) ;'])
+
+    def test_staging_failure(self):
+        cnx = mock.Mock()
+        with mock.patch('writers.write_pandas', return_value=(False, 0, 0, None)):
+            self.assertFalse(write_range(cnx, self.df, 'STORAGE_DIFFS_SCRIPT', 10, 19, mode=REPLACE))
+        cnx.cursor.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
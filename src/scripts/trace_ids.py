@@ -0,0 +1,196 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+PAD = -1 # Fills the components after the end of a trace id, so that a call sorts before its sub-calls.
+FEE = 2**31 - 2 # Encodes the 'f' component (fee payment call).
+VALIDATE = 2**31 - 1 # Encodes the 'v' component (validation call).
+LETTERS = {'f': FEE, 'v': VALIDATE}
+CHUNK_SIZE = 2**14 # Number of trace ids parsed at once.
+
+
+class TraceIds:
+    """
+    Compact encoding of a batch of trace ids, e.g. '10_7_v_0', as a fixed-width int32 matrix:
+    row i contains the components of the i-th trace id, the letters 'v' and 'f' are encoded
+    by the reserved values VALIDATE and FEE, and the row is filled with PAD after its last component.
+    The numbers are compared numerically, so '9' sorts before '10', and 'f' and 'v' sort
+    after all the numbers, as in the lexicographic order.
+    """
+
+    def __init__(self, codes: np.ndarray, depth: np.ndarray):
+        self.codes = codes # Matrix of shape (number of trace ids, maximal number of components).
+        self.depth = depth # Number of components of each trace id.
+
+    def __len__(self) -> int:
+        return self.codes.shape[0]
+
+    @classmethod
+    def from_strings(cls, trace_ids, chunk_size=CHUNK_SIZE) -> 'TraceIds':
+        """
+        Parses an iterable of trace id strings in bulk, without splitting the strings one by one.
+        The strings are parsed by chunks of 'chunk_size', which bounds the temporary memory.
+        """
+        trace_ids = list(trace_ids)
+        chunks = [cls.parse(trace_ids[i:i + chunk_size]) for i in range(0, len(trace_ids), chunk_size)]
+        if not chunks:
+            return cls(np.full((0, 0), PAD, dtype=np.int32), np.zeros(0, dtype=np.int32))
+        width = max(chunk.codes.shape[1] for chunk in chunks)
+        codes = np.full((len(trace_ids), width), PAD, dtype=np.int32)
+        offset = 0
+        for chunk in chunks:
+            codes[offset:offset + len(chunk), :chunk.codes.shape[1]] = chunk.codes
+            offset += len(chunk)
+        return cls(codes, np.concatenate([chunk.depth for chunk in chunks]))
+
+    @classmethod
+    def parse(cls, trace_ids: list) -> 'TraceIds':
+        """
+        Parses a non-empty list of trace id strings at once.
+        """
+        # All the trace ids are parsed as a single buffer, where each component ends with '_' or '\n'.
+        buffer = np.frombuffer(('\n'.join(trace_ids) + '\n').encode('ascii'), dtype=np.uint8)
+        is_end = (buffer == ord('_')) | (buffer == ord('\n'))
+        ends = np.flatnonzero(is_end)
+        starts = np.concatenate(([0], ends[:-1] + 1))
+        lengths = ends - starts
+        token = np.cumsum(is_end, dtype=np.int32) - is_end # Index of the component of each character.
+        digit_position = np.flatnonzero((buffer >= ord('0')) & (buffer <= ord('9')))
+        digit_token = token[digit_position]
+        del token
+        # Value of a number component: sum of its digits times the powers of 10 given by their position.
+        powers = 10.0 ** (ends[digit_token] - digit_position - 1)
+        weights = (buffer[digit_position] - ord('0')) * powers
+        values = np.bincount(digit_token, weights=weights, minlength=ends.size)
+        n_digits = np.bincount(digit_token, minlength=ends.size)
+        first_char = buffer[np.minimum(starts, buffer.size - 1)]
+        # The numbers must fit below the codes of the letters, which are the largest int32 values.
+        is_number = (lengths > 0) & (n_digits == lengths) & (values < FEE)
+        values = np.where(is_number, values, 0).round().astype(np.int64)
+        for letter, code in LETTERS.items():
+            is_letter = (lengths == 1) & (first_char == ord(letter))
+            values[is_letter] = code
+            is_number |= is_letter
+        # Place each component in the row of its trace id.
+        is_last = buffer[ends] == ord('\n')
+        row = np.cumsum(is_last) - is_last
+        if not is_number.all():
+            raise ValueError(f'Invalid trace id: {trace_ids[row[~is_number][0]]!r}')
+        first_of_row = np.flatnonzero(np.concatenate(([True], is_last[:-1])))
+        column = np.arange(ends.size) - first_of_row[row]
+        depth = np.bincount(row, minlength=len(trace_ids)).astype(np.int32)
+        codes = np.full((len(trace_ids), depth.max()), PAD, dtype=np.int32)
+        codes[row, column] = values
+        return cls(codes, depth)
+
+    @classmethod
+    def from_arrow(cls, trace_ids) -> 'TraceIds':
+        """
+        Parses an Arrow array (or chunked array) of trace id strings, e.g. a column of fetch_arrow_all,
+        with the Arrow compute kernels, so the strings are never converted to Python objects.
+        """
+        if isinstance(trace_ids, pa.ChunkedArray):
+            trace_ids = trace_ids.combine_chunks()
+        if len(trace_ids) == 0:
+            return cls(np.full((0, 0), PAD, dtype=np.int32), np.zeros(0, dtype=np.int32))
+        if trace_ids.null_count:
+            raise ValueError('Invalid trace id: None')
+        components = pc.split_pattern(trace_ids, '_')
+        tokens = pc.list_flatten(components)
+        row = pc.list_parent_indices(components).to_numpy()
+        # The digits which do not fit in an int64 are not cast, and the numbers must fit below the codes of the letters.
+        is_number = pc.and_(pc.utf8_is_digit(tokens), pc.less_equal(pc.utf8_length(pc.utf8_ltrim(tokens, '0')), 18))
+        values = pc.cast(pc.if_else(is_number, tokens, '0'), pa.int64()).to_numpy(zero_copy_only=False, writable=True)
+        is_number = is_number.to_numpy(zero_copy_only=False) & (values < FEE)
+        values[~is_number] = 0
+        for letter, code in LETTERS.items():
+            is_letter = pc.equal(tokens, letter).to_numpy(zero_copy_only=False)
+            values[is_letter] = code
+            is_number |= is_letter
+        if not is_number.all():
+            raise ValueError(f'Invalid trace id: {trace_ids[int(row[~is_number][0])].as_py()!r}')
+        # Place each component in the row of its trace id, after the components of the previous rows.
+        depth = pc.list_value_length(components).to_numpy().astype(np.int32)
+        column = np.arange(len(tokens)) - (np.cumsum(depth) - depth)[row]
+        codes = np.full((len(trace_ids), depth.max()), PAD, dtype=np.int32)
+        codes[row, column] = values
+        return cls(codes, depth)
+
+    @classmethod
+    def from_tuples(cls, nodes) -> 'TraceIds':
+        """
+        Encodes trace ids given as tuples of components, e.g. ('10', '7', 'v').
+        """
+        nodes = [tuple(node) for node in nodes]
+        depth = np.array([len(node) for node in nodes], dtype=np.int32)
+        codes = np.full((len(nodes), depth.max() if len(nodes) else 0), PAD, dtype=np.int32)
+        for i, node in enumerate(nodes):
+            row = [LETTERS[x] if x in LETTERS else int(x) for x in node]
+            if any(not 0 <= code < FEE for x, code in zip(node, row) if x not in LETTERS):
+                raise ValueError(f'Invalid trace id: {node!r}')
+            codes[i, :len(node)] = row
+        return cls(codes, depth)
+
+    def to_tuples(self) -> list:
+        """
+        Decodes the trace ids as tuples of string components.
+        """
+        letters = {code: letter for letter, code in LETTERS.items()}
+        return [
+            tuple(letters.get(x, str(x)) for x in row[:depth])
+            for row, depth in zip(self.codes.tolist(), self.depth.tolist())
+        ]
+
+    def to_strings(self) -> list:
+        """
+        Decodes the trace ids as strings.
+        """
+        return ['_'.join(node) for node in self.to_tuples()]
+
+    def take(self, indices) -> 'TraceIds':
+        return TraceIds(self.codes[indices], self.depth[indices])
+
+    def sort_order(self) -> np.ndarray:
+        """
+        Indices which sort the trace ids numerically, component by component.
+        """
+        if self.codes.size == 0:
+            # lexsort needs at least one key, and an empty window has no components.
+            return np.arange(len(self))
+        return np.lexsort(self.codes.T[::-1])
+
+    def sort_key(self, codes=None) -> np.ndarray:
+        """
+        Packs each row of 'codes' (by default, the trace ids) into a single fixed-width key,
+        such that comparing the keys compares the trace ids numerically.
+        """
+        codes = self.codes if codes is None else codes
+        # Flipping the sign bit maps int32 to uint32 preserving the order, and in big-endian
+        # the byte order of the unsigned integers matches their numeric order.
+        shifted = (codes.view(np.uint32) ^ np.uint32(2**31)).astype('>u4')
+        return shifted.view(f'V{4 * codes.shape[1]}').ravel()
+
+    def is_validate_or_fee(self) -> np.ndarray:
+        """
+        Whether the last component of each trace id is 'v' or 'f'.
+        """
+        last = self.codes[np.arange(len(self)), np.maximum(self.depth - 1, 0)]
+        return (self.depth > 0) & ((last == VALIDATE) | (last == FEE))
+
+    def parents(self) -> np.ndarray:
+        """
+        Index of the parent of each trace id (the trace id without its last component),
+        or -1 if the parent is not in the batch.
+        """
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64)
+        keys = self.sort_key()
+        parent_codes = self.codes.copy()
+        has_parent = self.depth > 1
+        parent_codes[np.arange(len(self)), np.maximum(self.depth - 1, 0)] = PAD
+        parent_keys = self.sort_key(parent_codes)
+        order = np.argsort(keys, kind='stable')
+        position = np.minimum(np.searchsorted(keys[order], parent_keys), len(self) - 1)
+        found = has_parent & (keys[order][position] == parent_keys)
+        return np.where(found, order[position], -1)
@@ -1,6 +1,9 @@
 import snowflake.connector
 import argparse
 import os
+from checkpoint import MANIFEST_PATH
+from metrics import add_metrics_arguments
+from writers import APPEND, WRITE_MODES
 
 
 BLAST_API_URL = 'https://starknet-mainnet.public.blastapi.io/'
@@ -22,10 +25,30 @@ def get_connection():
 
 
 def parser():
+    """
+    Parser of the scripts which process a range of blocks, with the options of the metrics and of the profilers.
+    """
     parser = argparse.ArgumentParser()
     parser.add_argument('start_block', type=int)
     parser.add_argument('end_block', type=int)
+    add_metrics_arguments(parser)
     return parser
 
 
-    
+def ingestion_parser():
+    """
+    Parser of the ingestion scripts (cairo_steps_script and storage_diffs_script),
+    with the options to resume from the checkpoint manifest, to choose the write mode and to load in bulk.
+    """
+    ingestion_parser = parser()
+    mode = ingestion_parser.add_mutually_exclusive_group()
+    mode.add_argument('--resume', action='store_true', help='Only process the blocks not committed yet.')
+    mode.add_argument('--retry-failed', action='store_true', help='Only process the blocks whose last attempt failed.')
+    ingestion_parser.add_argument('--manifest', default=MANIFEST_PATH, help='Path of the checkpoint manifest.')
+    ingestion_parser.add_argument('--write-mode', choices=WRITE_MODES, default=APPEND,
+                                  help="'replace' atomically replaces the rows of each batch, so that reruns do not duplicate rows.")
+    ingestion_parser.add_argument('--bulk-load', action='store_true',
+                                  help='Buffer the batches as local Parquet files, and load them with one PUT and one COPY INTO per flush.')
+    ingestion_parser.add_argument('--flush-mb', type=float, default=256, help='Size of the buffered files which triggers a flush, in MiB.')
+    ingestion_parser.add_argument('--flush-seconds', type=float, default=600, help='Age of the buffered files which triggers a flush.')
+    return ingestion_parser
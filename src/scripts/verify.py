@@ -0,0 +1,138 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+import pandas as pd
+from addresses import normalize_addresses
+from attribution import DATA_FOLDER_PATH, attribute, load_inputs
+from checkpoint import split_batches
+
+
+SHARD_SIZE = 25000 # Blocks per task of the process pool.
+TOLERANCE = 1e-9 # Absolute tolerance of the comparison, in ETH.
+ADDRESS_COLUMNS = ('CONTRACT', 'ADDRESS') # Address column of fee_amounts_v{version}.csv, or of allocations.csv.
+AMOUNT_COLUMNS = ('FEE_PER_CONTRACT', 'AMOUNT') # Amount column (in ETH) of fee_amounts_v{version}.csv, or of allocations.csv.
+FEE_COLUMNS = ['L1_FEE_PER_CONTRACT', 'L2_FEE_PER_CONTRACT']
+
+
+def input_block_range(data_folder=DATA_FOLDER_PATH) -> tuple[int, int]:
+    """
+    First and last blocks of the local inputs (see attribution.export_inputs), i.e. of their block fees.
+    """
+    blocks = pd.read_parquet(os.path.join(data_folder, 'block_fee.parquet'), columns=['BLOCK_NUMBER'])['BLOCK_NUMBER']
+    return int(blocks.min()), int(blocks.max())
+
+
+def shard_fees(shard: tuple[int, int], data_folder, gas_per_step, gas_per_diff) -> pd.DataFrame:
+    """
+    Fees per contract in wei (see attribution.attribute) of the blocks of the shard (start, end) only,
+    read from the local inputs.
+    """
+    return attribute(load_inputs(data_folder, *shard), gas_per_step, gas_per_diff)
+
+
+def merge_fees(partials: list[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Sums the fees per contract of the shards. The fees of a block only depend on the rows of that block,
+    so the sums over disjoint shards add up to the fees over their union.
+    """
+    if not partials:
+        return pd.DataFrame({'CONTRACT': pd.Series(dtype=object), **{column: pd.Series(dtype=np.float64) for column in FEE_COLUMNS}})
+    df = pd.concat(partials, ignore_index=True)
+    return df.groupby('CONTRACT', sort=False, as_index=False)[FEE_COLUMNS].sum()
+
+
+def recompute(data_folder, start_block: int, end_block: int, gas_per_step, gas_per_diff, workers=1, shard_size=SHARD_SIZE) -> pd.DataFrame:
+    """
+    Fees per contract in wei of the blocks in [start_block, end_block], as in the final_fee_amounts_divided table,
+    computed from the local inputs by shards of 'shard_size' blocks, in a pool of 'workers' processes
+    which each read the blocks of their shards only.
+    """
+    shards = split_batches([(start_block, end_block)], shard_size)
+    task = partial(shard_fees, data_folder=data_folder, gas_per_step=gas_per_step, gas_per_diff=gas_per_diff)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            partials = list(executor.map(task, shards))
+    else:
+        partials = [task(shard) for shard in shards]
+    return merge_fees(partials)
+
+
+def find_column(df: pd.DataFrame, column, candidates) -> str:
+    """
+    The column 'column' of a published file, or, if it is None, the first of 'candidates' which the file has.
+    """
+    if column is None:
+        column = next((candidate for candidate in candidates if candidate in df.columns), None)
+    if column not in df.columns:
+        raise ValueError(f"The published file has no column {column or ' or '.join(candidates)}.")
+    return column
+
+
+def read_published(path: str, address_column=None, amount_column=None) -> pd.DataFrame:
+    """
+    The normalized addresses (see addresses.normalize_address) and the amounts in ETH of a published file,
+    by default from the columns of fee_amounts_v{version}.csv or of allocations.csv.
+    """
+    df = pd.read_csv(path)
+    address_column = find_column(df, address_column, ADDRESS_COLUMNS)
+    amount_column = find_column(df, amount_column, AMOUNT_COLUMNS)
+    return pd.DataFrame({
+        'ADDRESS': normalize_addresses(df[address_column]).to_numpy(dtype=object),
+        'PUBLISHED': df[amount_column].to_numpy(np.float64)
+    })
+
+
+def diff_published(published: pd.DataFrame, fees: pd.DataFrame, scale=1.0, tolerance=TOLERANCE, relative_tolerance=0.0) -> pd.DataFrame:
+    """
+    Per address comparison of the published amounts (see read_published) with the recomputed fees (see recompute),
+    in ETH and multiplied by 'scale' (e.g. the share of the fees which is allocated). The rows are the published
+    addresses, and the recomputed contracts missing from the file whose amount reaches the smallest published one
+    (the cutoff of the file). An address is a MISMATCH if its DIFFERENCE (recomputed minus published) exceeds
+    tolerance + relative_tolerance * |recomputed amount|. The rows are sorted by decreasing absolute difference.
+    """
+    recomputed = pd.DataFrame({
+        'ADDRESS': fees['CONTRACT'].to_numpy(dtype=object),
+        'RECOMPUTED': (fees['L1_FEE_PER_CONTRACT'].to_numpy() + fees['L2_FEE_PER_CONTRACT'].to_numpy()) / 10**18 * scale
+    })
+    df = published.merge(recomputed, on='ADDRESS', how='outer')
+    df = df[df['PUBLISHED'].notna() | (df['RECOMPUTED'] >= published['PUBLISHED'].min())].copy()
+    df['DIFFERENCE'] = df['RECOMPUTED'].fillna(0) - df['PUBLISHED'].fillna(0)
+    df['MISMATCH'] = df['DIFFERENCE'].abs() > tolerance + relative_tolerance * df['RECOMPUTED'].fillna(0).abs()
+    return df.sort_values('DIFFERENCE', key=np.abs, ascending=False, kind='stable').reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    from queries.pipeline import DEFAULT_PER_DIFF, DEFAULT_PER_STEP
+    parser = argparse.ArgumentParser(description='Recompute the fees per contract from the local inputs and diff them against a published file.')
+    parser.add_argument('published', help='Published file, e.g. ../csv/allocations.csv or ../csv/fee_amounts_v2.csv.')
+    parser.add_argument('--data-folder', default=DATA_FOLDER_PATH, help='Folder of the Parquet inputs (see attribution.py export).')
+    parser.add_argument('--start-block', type=int, default=None, help='First block (default: the first block of the inputs).')
+    parser.add_argument('--end-block', type=int, default=None, help='Last block (default: the last block of the inputs).')
+    parser.add_argument('--gas-per-step', type=float, default=DEFAULT_PER_STEP)
+    parser.add_argument('--gas-per-diff', type=float, default=DEFAULT_PER_DIFF)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of processes computing the shards.')
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE, help='Blocks per shard.')
+    parser.add_argument('--address-column', default=None, help='Address column of the published file (default: CONTRACT or ADDRESS).')
+    parser.add_argument('--column', default=None, help='Amount column of the published file, in ETH (default: FEE_PER_CONTRACT or AMOUNT).')
+    parser.add_argument('--scale', type=float, default=1.0, help='Factor from the fees to the published amounts, e.g. the allocated share of the fees.')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='Absolute tolerance, in ETH.')
+    parser.add_argument('--relative-tolerance', type=float, default=0.0, help='Tolerance relative to the recomputed amount.')
+    parser.add_argument('--output', default=None, help='CSV file where the comparison of every address is written.')
+    args = parser.parse_args()
+
+    start_block, end_block = input_block_range(args.data_folder)
+    start_block = start_block if args.start_block is None else args.start_block
+    end_block = end_block if args.end_block is None else args.end_block
+    fees = recompute(args.data_folder, start_block, end_block, args.gas_per_step, args.gas_per_diff, args.workers, args.shard_size)
+    published = read_published(args.published, args.address_column, args.column)
+    comparison = diff_published(published, fees, args.scale, args.tolerance, args.relative_tolerance)
+    if args.output:
+        comparison.to_csv(args.output, index=False, float_format='{:.20f}'.format)
+    mismatches = comparison[comparison['MISMATCH']]
+    print(f'blocks {start_block}-{end_block}: {len(comparison)} addresses compared, {len(mismatches)} mismatches, '
+          f"largest difference {comparison['DIFFERENCE'].abs().max() if len(comparison) else 0:.3g} ETH")
+    if len(mismatches):
+        print(mismatches.head(20).to_string(index=False))
+        raise SystemExit(1)
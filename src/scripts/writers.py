@@ -0,0 +1,47 @@
+import uuid
+from snowflake.connector.pandas_tools import write_pandas
+import queries.generators
+
+
+APPEND = 'append' # Write mode which appends the rows of each batch to the table.
+REPLACE = 'replace' # Write mode which replaces the rows of the block range of each batch.
+WRITE_MODES = (APPEND, REPLACE)
+
+
+def add_contract_key(cnx, table_name: str) -> None:
+    """
+    Adds the 'contract_key' column to 'table_name', if the table exists without it. The tables are created
+    from the first rows written (by write_pandas, or from the files of a BulkLoader) and never altered afterwards,
+    so a table ingested before the column existed must be altered before the first write.
+    """
+    cnx.cursor().execute(queries.generators.add_contract_key(table_name))
+
+
+def write_range(cnx, df, table_name: str, start_block: int, end_block: int, mode=APPEND) -> bool:
+    """
+    Writes the rows of the blocks in [start_block, end_block] to 'table_name', and returns whether it succeeded.
+    In the REPLACE mode, the rows are first staged in a temporary table, and then the rows of the
+    block range are deleted from 'table_name' and the staged rows inserted in a single transaction.
+    Rerunning a range then costs work proportional to the range and never duplicates rows.
+    """
+    if mode == APPEND:
+        success, _, _, _ = write_pandas(cnx, df, table_name, auto_create_table=True)
+        return success
+    staging_table = f'{table_name}_STAGING_{uuid.uuid4().hex[:12].upper()}'
+    success, _, _, _ = write_pandas(cnx, df, staging_table, auto_create_table=True, table_type='temporary')
+    if not success:
+        return False
+    cs = cnx.cursor()
+    try:
+        cs.execute(queries.generators.create_table_like(table_name, staging_table))
+        cs.execute('begin')
+        try:
+            cs.execute(queries.generators.delete_block_range(table_name, start_block, end_block))
+            cs.execute(queries.generators.insert_from(table_name, staging_table, df.columns))
+            cs.execute('commit')
+        except Exception:
+            cs.execute('rollback')
+            raise
+    finally:
+        cs.execute(f'drop table if exists {staging_table}')
+    return True